@@ -0,0 +1,336 @@
+import abc
+import json
+import time
+import threading
+from decimal import Decimal
+from datetime import datetime
+from collections import OrderedDict
+
+from .sample import Sample, SampleFunction, SampleSection, SampleResource, SampleExport, SampleImport, \
+    SampleDebugDirectory
+
+CACHE_FORMAT_VERSION = 1
+# model classes which may be decoded from cache entries
+CACHED_MODELS = {
+    cls.__name__: cls for cls in (
+        Sample, SampleFunction, SampleSection, SampleResource, SampleExport, SampleImport, SampleDebugDirectory
+    )
+}
+
+
+class LruCache(object):
+    """
+    Thread-safe, size-bounded mapping which evicts the least recently used entry first. With a `ttl` (in seconds),
+    entries also expire that long after they were set.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()  # key => (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            expires_at, value = self._entries[key]
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._entries[key] = (None if ttl is None else time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def contains(self, key):
+        """
+        Like `key in cache`, but without counting a hit or miss and without making the entry the most recently used.
+        """
+        with self._lock:
+            if key not in self._entries:
+                return False
+            expires_at, _ = self._entries[key]
+            return expires_at is None or expires_at > time.monotonic()
+
+    def update(self, items):
+        for key, value in items:
+            self.set(key, value)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / float(lookups) if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class CacheBackend(abc.ABC):
+    """
+    Storage of a SampleCache. Values are bytes, so backends may be shared between processes.
+    """
+
+    @abc.abstractmethod
+    def get(self, key):
+        pass
+
+    @abc.abstractmethod
+    def set(self, key, value, ttl=None):
+        """
+        :param ttl: overrides the TTL of the backend for this entry
+        """
+        pass
+
+    @abc.abstractmethod
+    def exists(self, key):
+        pass
+
+    @abc.abstractmethod
+    def delete_many(self, keys):
+        pass
+
+    @abc.abstractmethod
+    def stats(self):
+        pass
+
+
+class LocalCacheBackend(CacheBackend):
+    """
+    In-process backend, e.g. for single processes or as stand-in for a shared backend.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.cache = LruCache(max_size, ttl)
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, ttl=None):
+        self.cache.set(key, value, ttl)
+
+    def exists(self, key):
+        return self.cache.contains(key)
+
+    def delete_many(self, keys):
+        for key in keys:
+            self.cache.delete(key)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Backend shared by all processes using the same redis server. Size is bounded by the maxmemory policy of the
+    server, which should be one of the LRU ones.
+    """
+
+    def __init__(self, client, ttl=None, prefix='kurasuta:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        self.client.set(self.prefix + key, value, ex=None if ttl is None else max(1, int(ttl)))
+
+    def exists(self, key):
+        return bool(self.client.exists(self.prefix + key))
+
+    def delete_many(self, keys):
+        keys = [self.prefix + key for key in keys]
+        if keys:
+            self.client.delete(*keys)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / float(lookups) if lookups else 0.0,
+        }
+
+
+def _encode_value(value):
+    # JSON objects are only used for tagged values, so they cannot be confused with data
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_encode_value(item) for item in value]
+    if isinstance(value, dict):
+        return {'dict': [[key, _encode_value(item)] for key, item in value.items()]}
+    if type(value).__name__ in CACHED_MODELS and isinstance(value, CACHED_MODELS[type(value).__name__]):
+        return {'model': type(value).__name__, 'slots': {
+            name: _encode_value(getattr(value, name)) for name in type(value).__slots__
+        }}
+    if isinstance(value, datetime):
+        return {'datetime': value.isoformat()}
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return {'bytes': bytes(value).hex()}
+    if isinstance(value, Decimal):
+        return {'decimal': str(value)}
+    if hasattr(value, 'tolist') and hasattr(value, 'dtype'):
+        # NumPy arrays like code_histogram
+        return {'array': [value.dtype.str, value.tolist()]}
+    raise TypeError('%s values cannot be cached' % type(value).__name__)
+
+
+def _decode_value(value):
+    if not isinstance(value, dict):
+        return [_decode_value(item) for item in value] if isinstance(value, list) else value
+    if 'dict' in value:
+        return {key: _decode_value(item) for key, item in value['dict']}
+    if 'model' in value:
+        cls = CACHED_MODELS[value['model']]
+        if set(value['slots']) != set(cls.__slots__):
+            raise ValueError('layout of %s changed' % cls.__name__)
+        model = cls.__new__(cls)
+        for name, item in value['slots'].items():
+            setattr(model, name, _decode_value(item))
+        return model
+    if 'datetime' in value:
+        return datetime.fromisoformat(value['datetime'])
+    if 'bytes' in value:
+        return bytes.fromhex(value['bytes'])
+    if 'decimal' in value:
+        return Decimal(value['decimal'])
+    if 'array' in value:
+        import numpy as np
+
+        return np.array(value['array'][1], dtype=np.dtype(value['array'][0]))
+    raise ValueError('unknown cached value %r' % list(value))
+
+
+def dump_sample(sample):
+    """
+    Serializes a sample as JSON with tagged values for types JSON lacks. Unlike pickle, loading it cannot run code.
+
+    :rtype: bytes
+    """
+    return json.dumps({'version': CACHE_FORMAT_VERSION, 'sample': _encode_value(sample)}).encode('utf-8')
+
+
+def load_sample(data):
+    """
+    :return: Sample, None for entries of another format version or model layout
+    """
+    try:
+        d = json.loads(data.decode('utf-8'))
+        if d.get('version') != CACHE_FORMAT_VERSION:
+            return None
+        return _decode_value(d['sample'])
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+class SampleCache(object):
+    """
+    Caches samples by SHA256. MD5 and SHA1 are stored as aliases of the SHA256, so invalidating the SHA256 of a sample
+    is enough for lookups by any hash to miss.
+
+    Invalidation leaves a tombstone for `tombstone_ttl` seconds. Entries are checked for it after being set and
+    removed again if there is one, so a reader which read a sample before a change was committed cannot keep the old
+    version in the cache. Changed samples are therefore not cached for `tombstone_ttl` seconds, which has to exceed
+    the time between reading a sample from the database and setting it.
+    """
+    HASH_TYPES = ('sha256', 'md5', 'sha1')
+
+    def __init__(self, backend, tombstone_ttl=60):
+        """
+        :type backend: CacheBackend
+        """
+        self.backend = backend
+        self.tombstone_ttl = tombstone_ttl
+
+    def get(self, hash_type, hash_value):
+        """
+        :rtype: lib.sample.Sample|None
+        """
+        hash_value = hash_value.lower()
+        if hash_type != 'sha256':
+            hash_value = self.backend.get('%s:%s' % (hash_type, hash_value))
+            if hash_value is None:
+                return None
+            hash_value = hash_value.decode('ascii')
+        data = self.backend.get('sha256:%s' % hash_value)
+        # every lookup gets its own copy, so callers may modify it
+        return None if data is None else load_sample(data)
+
+    def set(self, sample):
+        sha256 = sample.hash_sha256.lower()
+        for hash_type in ('md5', 'sha1'):
+            hash_value = getattr(sample, 'hash_%s' % hash_type)
+            if hash_value:
+                self.backend.set('%s:%s' % (hash_type, hash_value.lower()), sha256.encode('ascii'))
+        self.backend.set('sha256:%s' % sha256, dump_sample(sample))
+        # checked after setting: an invalidation after this check also deletes the entry set above
+        if self.backend.exists('invalidated:%s' % sha256):
+            self.backend.delete_many(['sha256:%s' % sha256])
+
+    def invalidate(self, hashes_sha256):
+        hashes_sha256 = [sha256.lower() for sha256 in hashes_sha256]
+        # tombstones first, see set()
+        for sha256 in hashes_sha256:
+            self.backend.set('invalidated:%s' % sha256, b'1', self.tombstone_ttl)
+        self.backend.delete_many(['sha256:%s' % sha256 for sha256 in hashes_sha256])
+
+    def stats(self):
+        return self.backend.stats()
+
+
+def create_sample_cache(url, max_size=10000, ttl=None, tombstone_ttl=60):
+    """
+    :param url: "local" for an in-process cache, "redis://..." for a shared one, empty to disable caching
+    :rtype: SampleCache|None
+    """
+    if not url:
+        return None
+    if url == 'local':
+        return SampleCache(LocalCacheBackend(max_size, ttl), tombstone_ttl)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        import redis
+
+        return SampleCache(RedisCacheBackend(redis.Redis.from_url(url), ttl), tombstone_ttl)
+    raise Exception('Unsupported sample cache "%s"' % url)
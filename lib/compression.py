@@ -0,0 +1,125 @@
+import gzip
+import io
+import zlib
+
+from .flask import InvalidUsage
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def supported_encodings():
+    """
+    :return: content codings in order of preference
+    """
+    return ['zstd', 'gzip'] if zstandard else ['gzip']
+
+
+def compress(data, encoding, level=None):
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6 if level is None else level)
+    if encoding == 'zstd' and zstandard:
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    raise Exception('unsupported content encoding "%s"' % encoding)
+
+
+def compressing_writer(stream, encoding, level=None):
+    """
+    Compresses everything written to the returned file object into `stream`. Closing it finishes the compressed data
+    but leaves `stream` open.
+    """
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=stream, mode='wb', compresslevel=6 if level is None else level)
+    if encoding == 'zstd' and zstandard:
+        return zstandard.ZstdCompressor(level=3 if level is None else level).stream_writer(stream, closefd=False)
+    raise Exception('unsupported content encoding "%s"' % encoding)
+
+
+def decompressing_reader(stream, encoding):
+    if encoding == 'gzip':
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if encoding == 'zstd' and zstandard:
+        return zstandard.ZstdDecompressor().stream_reader(stream)
+    raise InvalidUsage('Unsupported Content-Encoding "%s"' % encoding, status_code=415)
+
+
+class BoundedReader(io.RawIOBase):
+    """
+    Reads at most `length` bytes from a stream, e.g. the body of a WSGI request with a Content-Length.
+    """
+
+    def __init__(self, stream, length):
+        self.stream = stream
+        self.remaining = length
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.remaining <= 0:
+            return 0
+        data = self.stream.read(min(len(b), self.remaining))
+        self.remaining -= len(data)
+        b[:len(data)] = data
+        return len(data)
+
+
+class DecompressedStream(io.RawIOBase):
+    """
+    Decompresses a request body while it is read. Raises InvalidUsage (413) once more than `max_size` bytes were
+    decompressed and InvalidUsage (400) for corrupt input.
+    """
+
+    def __init__(self, reader, max_size):
+        self.reader = reader
+        self.max_size = max_size
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        try:
+            data = self.reader.read(len(b))
+        except (OSError, EOFError, zlib.error) as e:
+            raise InvalidUsage('Request body could not be decompressed (%s)' % e, status_code=400)
+        except Exception as e:
+            if zstandard and isinstance(e, zstandard.ZstdError):
+                raise InvalidUsage('Request body could not be decompressed (%s)' % e, status_code=400)
+            raise
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise InvalidUsage('Decompressed request body exceeds %i bytes' % self.max_size, status_code=413)
+        b[:len(data)] = data
+        return len(data)
+
+
+class DecompressionMiddleware(object):
+    """
+    WSGI middleware which transparently decompresses request bodies sent with Content-Encoding gzip or zstd.
+    """
+
+    def __init__(self, app, max_size):
+        self.app = app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding in ('', 'identity'):
+            return self.app(environ, start_response)
+        if encoding not in supported_encodings():
+            start_response('415 Unsupported Media Type', [('Content-Type', 'text/plain')])
+            return [('Unsupported Content-Encoding "%s"' % encoding).encode('utf-8')]
+
+        stream = environ['wsgi.input']
+        if environ.get('CONTENT_LENGTH'):
+            stream = BoundedReader(stream, int(environ['CONTENT_LENGTH']))
+        environ['wsgi.input'] = io.BufferedReader(
+            DecompressedStream(decompressing_reader(stream, encoding), self.max_size)
+        )
+        environ['wsgi.input_terminated'] = True
+        environ.pop('CONTENT_LENGTH', None)
+        del environ['HTTP_CONTENT_ENCODING']
+        return self.app(environ, start_response)
@@ -3,8 +3,35 @@ import socket
 import json
 import os
 import errno
-from datetime import datetime
-from lib.sample import SampleMeta
+from contextlib import contextmanager
+from collections import Counter
+from datetime import datetime, timezone
+from lib.sample import SampleMeta, SampleFactory
+from lib.task import TaskFactory
+from lib.flask import InvalidUsage, validate_sha256
+from lib.cache import LruCache
+from lib.postgres import copy_rows
+
+
+PERSIST_MODE_REPLACE = 'replace'
+PERSIST_MODE_UPDATE = 'update'
+PERSIST_MODES = (PERSIST_MODE_REPLACE, PERSIST_MODE_UPDATE)
+
+
+def diff_key(values):
+    """
+    Normalizes a row for comparing values written by KurasutaDatabase with the values read back from the database.
+    """
+    key = []
+    for value in values:
+        if isinstance(value, float):
+            value = float('%.6g' % value)  # entropies may be stored with single precision
+        elif isinstance(value, datetime) and value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        elif isinstance(value, (bytearray, memoryview)):
+            value = bytes(value)
+        key.append(value)
+    return tuple(key)
 
 
 class DateTimeEncoder(json.JSONEncoder):
@@ -63,50 +90,526 @@ class KurasutaSystem(object):
 
 
 class KurasutaDatabase(object):
-    def __init__(self, connection):
+    # shared by all instances of a process, maps (table, field, value) and resource pairs to ids of committed rows
+    lookup_cache = LruCache(100000)
+    # shared by all instances of a process, samples changed by this class are invalidated in it after commit
+    sample_cache = None  # type: lib.cache.SampleCache|None
+
+    def __init__(self, connection, insert_page_size=1000, persist_mode=PERSIST_MODE_REPLACE):
+        if persist_mode not in PERSIST_MODES:
+            raise Exception('Unknown persist mode "%s"' % persist_mode)
         self.connection = connection
+        self.insert_page_size = insert_page_size  # rows per multi-row INSERT of child tables
+        self.persist_mode = persist_mode  # how new PEMetadata of existing samples is stored
+        self._pending_lookups = {}  # resolved within the current transaction, cached only after commit
+        self._changed_samples = set()  # SHA256 of samples changed within the current transaction
+
+    def commit(self):
+        self.connection.commit()
+        self.lookup_cache.update(self._pending_lookups.items())
+        self._pending_lookups = {}
+        if self.sample_cache is not None and self._changed_samples:
+            self.sample_cache.invalidate(self._changed_samples)
+        self._changed_samples = set()
+
+    def rollback(self):
+        self.connection.rollback()
+        self._pending_lookups = {}
+        self._changed_samples = set()
+
+    @contextmanager
+    def savepoint(self):
+        """
+        Runs the enclosed statements in a savepoint. On errors only they are rolled back, the surrounding transaction
+        stays usable.
+        """
+        pending_lookups = dict(self._pending_lookups)
+        with self.connection.cursor() as cursor:
+            cursor.execute('SAVEPOINT kurasuta_database')
+        try:
+            yield
+        except Exception:
+            with self.connection.cursor() as cursor:
+                cursor.execute('ROLLBACK TO SAVEPOINT kurasuta_database')
+            self._pending_lookups = pending_lookups
+            raise
+        with self.connection.cursor() as cursor:
+            cursor.execute('RELEASE SAVEPOINT kurasuta_database')
+
+    def _cached_lookup(self, key):
+        if key in self._pending_lookups:
+            return self._pending_lookups[key]
+        return self.lookup_cache.get(key)
+
+    # tables referencing sample.id by sample_id, deleted before the sample rows themselves
+    SAMPLE_CHILD_TABLES = (
+        'sample_has_peyd',
+        'sample_has_heuristic_ioc',
+        'debug_directory',
+        'section',
+        'resource',
+        'guid',
+        'export_symbol',
+        'import',
+        'sample_function',
+        'sample_has_file_name',
+        'sample_has_tag',
+        'sample_has_source',
+    )
 
     def delete_sample(self, hash_sha256):
+        self.delete_samples(hashes_sha256=[hash_sha256])
+
+    def delete_samples(self, hashes_sha256=None, ids=None):
+        """
+        Deletes samples given by SHA256 and/or id with one statement per table, without committing.
+
+        :return: dict of table name => number of deleted rows
+        """
         with self.connection.cursor() as cursor:
-            cursor.execute('SELECT id FROM sample WHERE (hash_sha256 = %s)', (hash_sha256,))
-            sample_id = cursor.fetchone()[0]
-            cursor.execute('DELETE FROM sample_has_peyd WHERE (sample_id = %s)', (sample_id,))
-            cursor.execute('DELETE FROM sample_has_heuristic_ioc WHERE (sample_id = %s)', (sample_id,))
-            cursor.execute('DELETE FROM debug_directory WHERE (sample_id = %s)', (sample_id,))
-            cursor.execute('DELETE FROM section WHERE (sample_id = %s)', (sample_id,))
-            cursor.execute('DELETE FROM resource WHERE (sample_id = %s)', (sample_id,))
-            cursor.execute('DELETE FROM guid WHERE (sample_id = %s)', (sample_id,))
-            cursor.execute('DELETE FROM export_symbol WHERE (sample_id = %s)', (sample_id,))
-            cursor.execute('DELETE FROM import WHERE (sample_id = %s)', (sample_id,))
-            cursor.execute('DELETE FROM sample_function WHERE (sample_id = %s)', (sample_id,))
-            cursor.execute('DELETE FROM sample_has_file_name WHERE (sample_id = %s)', (sample_id,))
-            cursor.execute('DELETE FROM sample_has_tag WHERE (sample_id = %s)', (sample_id,))
-            cursor.execute('DELETE FROM sample_has_source WHERE (sample_id = %s)', (sample_id,))
-            cursor.execute('DELETE FROM sample WHERE (id = %s)', (sample_id,))
+            cursor.execute(
+                'SELECT id, hash_sha256 FROM sample WHERE (id = ANY(%s)) OR (hash_sha256 = ANY(%s))',
+                (list(ids or []), list(hashes_sha256 or []))
+            )
+            rows = cursor.fetchall()
+            sample_ids = [row[0] for row in rows]
+            self._changed_samples.update(row[1] for row in rows)
+
+            deleted = {}
+            for table in self.SAMPLE_CHILD_TABLES + ('sample',):
+                if not sample_ids:
+                    deleted[table] = 0
+                    continue
+                cursor.execute(
+                    'DELETE FROM %s WHERE (%s = ANY(%%s))' % (table, 'id' if table == 'sample' else 'sample_id'),
+                    (sample_ids,)
+                )
+                deleted[table] = cursor.rowcount
+        return deleted
 
     def ensure_row(self, table, field, value):
-        select_sql = 'SELECT id FROM %s WHERE %s = %%s' % (table, field)
-        insert_sql = 'INSERT INTO %s (%s) VALUES(%%s) RETURNING id' % (table, field)
+        return self.ensure_rows(table, field, [value])[value]
+
+    def ensure_rows(self, table, field, values):
+        """
+        Resolves the ids of all values in a lookup table, creating missing rows. Needs one SELECT for the existing and
+        one INSERT ... ON CONFLICT for the new values, regardless of the number of values.
+
+        :type table: str
+        :type field: str
+        :type values: collections.Iterable
+        :return: dict mapping each value to its id
+        """
+        ids = {}
+        missing = []
+        for value in set(values):
+            row_id = self._cached_lookup((table, field, value))
+            if row_id is None:
+                missing.append(value)
+            else:
+                ids[value] = row_id
+        if None in missing:
+            missing.remove(None)
+            ids[None] = self._ensure_null_row(table, field)
+            self._pending_lookups[(table, field, None)] = ids[None]
+        if not missing:
+            return ids
+
+        select_sql = 'SELECT %s, id FROM %s WHERE (%s = ANY(%%s))' % (field, table, field)
+        insert_sql = '''
+            INSERT INTO %s (%s) SELECT UNNEST(%%s)
+            ON CONFLICT (%s) DO NOTHING
+            RETURNING %s, id
+        ''' % (table, field, field, field)
+        found = {}
         with self.connection.cursor() as cursor:
-            cursor.execute(select_sql, (value,))
-            result = cursor.fetchone()
-        if not result:
-            with self.connection.cursor() as cursor:
-                cursor.execute(insert_sql, (value,))
-                result = cursor.fetchone()
-        return result[0]
+            # the second SELECT picks up values inserted by concurrent transactions in the meantime
+            for sql in (select_sql, insert_sql, select_sql):
+                remaining = [value for value in missing if value not in found]
+                if not remaining:
+                    break
+                cursor.execute(sql, (remaining,))
+                found.update(cursor.fetchall())
+
+        for value, row_id in found.items():
+            self._pending_lookups[(table, field, value)] = row_id
+            ids[value] = row_id
+        return ids
+
+    def _ensure_null_row(self, table, field):
+        # rows without value (e.g. imports by ordinal) share one row, the unique index does not apply to NULL
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT MIN(id) FROM %s WHERE (%s IS NULL)' % (table, field))
+            row_id = cursor.fetchone()[0]
+            if row_id is None:
+                cursor.execute('INSERT INTO %s (%s) VALUES (NULL) RETURNING id' % (table, field))
+                row_id = cursor.fetchone()[0]
+        return row_id
 
     def ensure_resource_pair(self, pair_name, content_id, content_str):
-        select_sql = 'SELECT id FROM resource_%s_pair WHERE (content_id = %%s) AND (content_str = %%s)' % (pair_name,)
-        insert_sql = 'INSERT INTO resource_%s_pair (content_id, content_str) VALUES(%%s) RETURNING id' % (pair_name,)
+        return self.ensure_resource_pairs(pair_name, [(content_id, content_str)])[(content_id, content_str)]
+
+    def ensure_resource_pairs(self, pair_name, pairs):
+        """
+        Resolves the ids of (content_id, content_str) pairs in resource_<pair_name>_pair, creating missing rows.
+
+        :type pair_name: str
+        :type pairs: collections.Iterable
+        :return: dict mapping each pair to its id
+        """
+        table = 'resource_%s_pair' % pair_name
+        ids = {}
+        missing = {}  # keyed by the string representation, content_id may come back from the database as another type
+        for pair in set(pairs):
+            row_id = self._cached_lookup((table,) + pair)
+            if row_id is None:
+                missing[(str(pair[0]), str(pair[1]))] = pair
+            else:
+                ids[pair] = row_id
+        if not missing:
+            return ids
+
+        select_sql = '''
+            SELECT content_id, content_str, id FROM %s
+            WHERE ((content_id, content_str) IN (SELECT UNNEST(%%s), UNNEST(%%s)))
+        ''' % table
+        insert_sql = '''
+            INSERT INTO %s (content_id, content_str) SELECT UNNEST(%%s), UNNEST(%%s)
+            ON CONFLICT (content_id, content_str) DO NOTHING
+            RETURNING content_id, content_str, id
+        ''' % table
+        found = {}
         with self.connection.cursor() as cursor:
-            cursor.execute(select_sql, (content_id, content_str))
-            result = cursor.fetchone()
-        if not result:
-            with self.connection.cursor() as cursor:
-                cursor.execute(insert_sql, (content_id, content_str))
-                result = cursor.fetchone()
-        return result[0]
+            for sql in (select_sql, insert_sql, select_sql):
+                remaining = [pair for key, pair in missing.items() if key not in found]
+                if not remaining:
+                    break
+                cursor.execute(sql, ([pair[0] for pair in remaining], [pair[1] for pair in remaining]))
+                found.update(((str(row[0]), str(row[1])), row[2]) for row in cursor.fetchall())
+
+        for key, row_id in found.items():
+            self._pending_lookups[(table,) + missing[key]] = row_id
+            ids[missing[key]] = row_id
+        return ids
+
+    def _insert_rows(self, cursor, table, columns, rows):
+        """
+        Inserts rows with multi-row VALUES statements of at most `insert_page_size` rows each.
+        """
+        from psycopg2.extras import execute_values
+
+        if not rows:
+            return
+        execute_values(
+            cursor,
+            'INSERT INTO %s (%s) VALUES %%s' % (table, ', '.join(columns)),
+            rows,
+            page_size=self.insert_page_size
+        )
+
+    def store_assembly(self, sample, sample_id):
+        """
+        Replaces all functions of the sample, the function rows are streamed into the table with COPY.
+        """
+        self._changed_samples.add(sample.hash_sha256)
+        with self.connection.cursor() as cursor:
+            cursor.execute('DELETE FROM sample_function WHERE (sample_id = %s)', (sample_id,))
+            copy_rows(
+                cursor,
+                'sample_function',
+                [
+                    'sample_id', '"offset"', '"size"', '"real_size"', 'name', 'calltype', 'cc', 'cost', 'ebbs',
+                    'edges', 'indegree', 'nargs', 'nbbs', 'nlocals', 'outdegree', '"type"', 'opcodes_sha256',
+                    'opcodes_crc32', 'cleaned_opcodes_sha256', 'cleaned_opcodes_crc32', 'opcodes'
+                ],
+                (
+                    (
+                        sample_id, f.offset, f.size, f.real_size, f.name, f.calltype, f.cc, f.cost, f.ebbs, f.edges,
+                        f.indegree, f.nargs, f.nbbs, f.nlocals, f.outdegree, f.type, f.opcodes_sha256,
+                        f.opcodes_crc32, f.cleaned_opcodes_sha256, f.cleaned_opcodes_crc32, json.dumps(f.opcodes)
+                    )
+                    for f in sample.functions
+                )
+            )
+
+    # columns of "sample" written by store_metadata and update_metadata, in the order of _metadata_rows
+    SAMPLE_COLUMNS = [
+        'hash_sha256',
+        'hash_md5',
+        'hash_sha1',
+        'size',
+        'code_histogram_packed',
+        'magic_id',
+        'ssdeep',
+        'imphash',
+        'entropy',
+        'file_size',
+        'entry_point',
+        'first_kb',
+        'overlay_sha256',
+        'overlay_size',
+        'overlay_ssdeep',
+        'overlay_entropy',
+        'build_timestamp',
+        'strings_count_of_length_at_least_10',
+        'strings_count',
+        'export_name_id'
+    ]
+
+    def _metadata_rows(self, sample):
+        """
+        Resolves all dictionary values of the sample with one bulk lookup per table.
+
+        :return: tuple of the values of SAMPLE_COLUMNS and a list of (table, columns, rows) of the child tables, the
+        rows without sample_id
+        """
+        from lib.histogram import pack_histogram
+
+        magic_id = self.ensure_row('magic', 'description', sample.magic) if sample.magic else None
+        export_name_id = self.ensure_row('export_name', 'content', sample.export_name) if sample.export_name else None
+        code_histogram_packed = pack_histogram(sample.code_histogram) \
+            if sample.code_histogram is not None and len(sample.code_histogram) \
+            else None
+        sample_values = (
+            sample.hash_sha256,
+            sample.hash_md5,
+            sample.hash_sha1,
+            sample.size,
+            code_histogram_packed,
+            magic_id,
+            sample.ssdeep,
+            sample.imphash,
+            sample.entropy,
+            sample.file_size,
+            sample.entry_point,
+            bytearray(sample.first_kb),
+            sample.overlay_sha256,
+            sample.overlay_size,
+            sample.overlay_ssdeep,
+            sample.overlay_entropy,
+            sample.build_timestamp,
+            sample.strings_count_of_length_at_least_10,
+            sample.strings_count,
+            export_name_id
+        )
+
+        debug_directories = sample.debug_directories or []
+        exports = sample.exports or []
+        imports = sample.imports or []
+        sections = sample.sections or []
+        resources = sample.resources or []
+        peyd_ids = self.ensure_rows('peyd', 'description', sample.peyd or [])
+        path_ids = self.ensure_rows('path', 'content', [d.path for d in debug_directories])
+        export_symbol_name_ids = self.ensure_rows('export_symbol_name', 'content', [e.name for e in exports])
+        import_name_ids = self.ensure_rows('import_name', 'content', [i.name for i in imports])
+        dll_name_ids = self.ensure_rows('dll_name', 'content', [i.dll_name for i in imports])
+        ioc_ids = self.ensure_rows('ioc', 'content', sample.heuristic_iocs or [])
+        section_name_ids = self.ensure_rows('section_name', 'content', [s.name for s in sections])
+        type_pair_ids = self.ensure_resource_pairs('type', [
+            (r.type_id, r.type_str) for r in resources if r.type_id and r.type_str
+        ])
+        name_pair_ids = self.ensure_resource_pairs('name', [
+            (r.name_id, r.name_str) for r in resources if r.name_id and r.name_str
+        ])
+        language_pair_ids = self.ensure_resource_pairs('language', [
+            (r.language_id, r.language_str) for r in resources if r.language_id and r.language_str
+        ])
+        tag_ids = self.ensure_rows('sample_tag', 'name', sample.tags or [])
+        file_name_ids = self.ensure_rows('sample_file_name', 'name', sample.file_names or [])
+
+        child_rows = [
+            ('sample_has_peyd', ['peyd_id'], [
+                (peyd_ids[peyd_description],) for peyd_description in sample.peyd or []
+            ]),
+            ('debug_directory', ['timestamp', 'path_id', 'age', 'signature', 'guid'], [
+                (d.timestamp, path_ids[d.path], d.age, d.signature, d.guid) for d in debug_directories
+            ]),
+            ('export_symbol', ['address', 'ordinal', 'name_id'], [
+                (export.address, export.ordinal, export_symbol_name_ids[export.name]) for export in exports
+            ]),
+            ('import', ['dll_name_id', 'address', 'name_id'], [
+                (dll_name_ids[imp.dll_name], imp.address, import_name_ids[imp.name]) for imp in imports
+            ]),
+            ('sample_has_heuristic_ioc', ['ioc_id'], [
+                (ioc_ids[ioc],) for ioc in sample.heuristic_iocs or []
+            ]),
+            (
+                'section',
+                [
+                    'hash_sha256', 'name_id', 'virtual_address', 'virtual_size', 'raw_size', 'entropy', 'ssdeep',
+                    'sort_order'
+                ],
+                [
+                    (
+                        section.hash_sha256,
+                        section_name_ids[section.name],
+                        section.virtual_address,
+                        section.virtual_size,
+                        section.raw_size,
+                        section.entropy,
+                        section.ssdeep,
+                        i
+                    )
+                    for i, section in enumerate(sections)
+                ]
+            ),
+            (
+                'resource',
+                [
+                    'hash_sha256', '"offset"', '"size"', 'actual_size', 'entropy', 'ssdeep', 'type_pair_id',
+                    'name_pair_id', 'language_pair_id', 'sort_order'
+                ],
+                [
+                    (
+                        resource.hash_sha256,
+                        resource.offset,
+                        resource.size,
+                        resource.actual_size,
+                        resource.entropy,
+                        resource.ssdeep,
+                        type_pair_ids[(resource.type_id, resource.type_str)]
+                        if resource.type_id and resource.type_str else None,
+                        name_pair_ids[(resource.name_id, resource.name_str)]
+                        if resource.name_id and resource.name_str else None,
+                        language_pair_ids[(resource.language_id, resource.language_str)]
+                        if resource.language_id and resource.language_str else None,
+                        i
+                    )
+                    for i, resource in enumerate(resources)
+                ]
+            ),
+            ('sample_has_source', ['source_id'], [(sample.source_id,)] if sample.source_id else []),
+            ('sample_has_tag', ['tag_id'], [(tag_ids[tag],) for tag in sample.tags or []]),
+            ('sample_has_file_name', ['file_name_id'], [
+                (file_name_ids[file_name],) for file_name in sample.file_names or []
+            ]),
+        ]
+        return sample_values, child_rows
+
+    def store_metadata(self, sample):
+        """
+        :type sample: lib.sample.Sample
+        :return: id of the new sample row
+        """
+        self._changed_samples.add(sample.hash_sha256)
+        sample_values, child_rows = self._metadata_rows(sample)
+
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO sample (%s) VALUES(%s) RETURNING id' % (
+                    ', '.join(self.SAMPLE_COLUMNS), ', '.join(['%s'] * len(self.SAMPLE_COLUMNS))
+                ),
+                sample_values
+            )
+            sample_id = cursor.fetchone()[0]
+
+            for table, columns, rows in child_rows:
+                self._insert_rows(cursor, table, ['sample_id'] + columns, [(sample_id,) + row for row in rows])
+
+        return sample_id
+
+    def update_metadata(self, sample, sample_id):
+        """
+        Brings an existing sample in line with new metadata by writing only the differences: the sample row is
+        updated if any of its values changed, child rows are matched by their values and only missing ones are
+        inserted and surplus ones deleted. Functions of the sample are kept.
+
+        :type sample: lib.sample.Sample
+        :return: dict of table name => number of written rows
+        """
+        sample_values, child_rows = self._metadata_rows(sample)
+        written = {}
+
+        with self.connection.cursor() as cursor:
+            # compared in Python like the child rows, as entropies read back may differ in precision
+            columns = self.SAMPLE_COLUMNS[1:]
+            cursor.execute('SELECT %s FROM sample WHERE (id = %%s)' % ', '.join(columns), (sample_id,))
+            existing = cursor.fetchone()
+            written['sample'] = 0
+            if existing is None or diff_key(existing) != diff_key(sample_values[1:]):
+                cursor.execute(
+                    'UPDATE sample SET (%s) = (%s) WHERE (id = %%s)' % (
+                        ', '.join(columns), ', '.join(['%s'] * len(columns))
+                    ),
+                    sample_values[1:] + (sample_id,)
+                )
+                written['sample'] = cursor.rowcount
+
+            for table, columns, rows in child_rows:
+                cursor.execute(
+                    'SELECT ctid, %s FROM %s WHERE (sample_id = %%s)' % (', '.join(columns), table),
+                    (sample_id,)
+                )
+                missing = Counter(diff_key(row) for row in rows)
+                surplus_ctids = []
+                for existing in cursor.fetchall():
+                    key = diff_key(existing[1:])
+                    if missing[key] > 0:
+                        missing[key] -= 1
+                    else:
+                        surplus_ctids.append(existing[0])
+
+                if surplus_ctids:
+                    cursor.execute(
+                        'DELETE FROM %s WHERE (sample_id = %%s) AND (ctid = ANY(%%s::tid[]))' % table,
+                        (sample_id, surplus_ctids)
+                    )
+                inserted = []
+                for row in rows:
+                    key = diff_key(row)
+                    if missing[key] > 0:
+                        missing[key] -= 1
+                        inserted.append((sample_id,) + row)
+                self._insert_rows(cursor, table, ['sample_id'] + columns, inserted)
+                written[table] = len(surplus_ctids) + len(inserted)
+
+        if any(written.values()):
+            self._changed_samples.add(sample.hash_sha256)
+        return written
+
+    def persist_sample(self, sha256, json_data):
+        """
+        Stores the result of a task for one sample, without committing.
+
+        :type sha256: str
+        :type json_data: dict
+        :return: str status
+        """
+        validate_sha256(sha256)
+
+        task = TaskFactory(self.connection).mark_as_completed(int(json_data['task_id'])) \
+            if 'task_id' in json_data \
+            else None
+        # TODO check if task.consumer_name matches client
+
+        sample = SampleFactory().from_json(json_data)
+        if sha256 != sample.hash_sha256:
+            raise InvalidUsage('SHA256 in URL and body mismatch', status_code=400)
+
+        with self.connection.cursor() as cursor:
+            cursor.execute('''SELECT id FROM sample WHERE (hash_sha256 = %s)''', (sample.hash_sha256,))
+            row = cursor.fetchone()
+        if row:
+            sample_id = row[0]
+            if not task:
+                return 'EXISTS'
+            if task.type == 'PEMetadata' and self.persist_mode == PERSIST_MODE_UPDATE:
+                self.update_metadata(sample, sample_id)
+                return 'ok'
+            if task.type == 'PEMetadata':  # in case of new PE metadata, delete existing database entry
+                self.delete_sample(sample.hash_sha256)
+        else:
+            sample_id = None
+        if not task:
+            raise InvalidUsage('Key "task_id" missing, a new sample can only be stored as the result of a task')
+
+        if task.type == 'PEMetadata':
+            self.store_metadata(sample)
+        elif task.type == 'R2Disassembly':
+            if sample_id is None:
+                raise InvalidUsage('sample does not exist in database, no R2Disassembly can be stored')
+            self.store_assembly(sample, sample_id)
+        return 'ok'
 
     def create_task(self, task_type, hash_sha256, meta=None):
         """
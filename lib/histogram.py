@@ -0,0 +1,40 @@
+import numpy as np
+
+# packed histograms start with a version byte followed by 256 little-endian counts
+HISTOGRAM_VERSION_UINT32 = 1
+HISTOGRAM_VERSION_UINT64 = 2
+HISTOGRAM_DTYPES = {
+    HISTOGRAM_VERSION_UINT32: np.dtype('<u4'),
+    HISTOGRAM_VERSION_UINT64: np.dtype('<u8'),
+}
+
+
+def histogram_to_array(histogram):
+    """
+    :param histogram: dict keyed by byte value (as int or str, like in sample JSON) or sequence of 256 counts
+    :rtype: np.ndarray
+    """
+    if isinstance(histogram, dict):
+        histogram = [histogram['%s' % i] if '%s' % i in histogram else histogram[i] for i in range(256)]
+    counts = np.asarray(histogram, dtype=np.uint64)
+    if counts.shape != (256,):
+        raise ValueError('byte histogram needs exactly 256 counts, got %s' % (counts.shape,))
+    return counts
+
+
+def pack_histogram(histogram):
+    counts = histogram_to_array(histogram)
+    version = HISTOGRAM_VERSION_UINT32 if counts.max() < 2 ** 32 else HISTOGRAM_VERSION_UINT64
+    return bytes([version]) + counts.astype(HISTOGRAM_DTYPES[version]).tobytes()
+
+
+def unpack_histogram(data):
+    """
+    :type data: bytes|memoryview
+    :rtype: np.ndarray
+    """
+    data = bytes(data)
+    version = data[0]
+    if version not in HISTOGRAM_DTYPES:
+        raise ValueError('unknown byte histogram version %i' % version)
+    return np.frombuffer(data, dtype=HISTOGRAM_DTYPES[version], count=256, offset=1)
@@ -0,0 +1,107 @@
+import json
+import tempfile
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+START_EVENTS = ('start_map', 'start_array')
+END_EVENTS = ('end_map', 'end_array')
+
+
+class SpooledJsonArray(object):
+    """
+    Items of a JSON array, kept as one JSON document per line in memory up to `spool_size` bytes and in a temporary
+    file beyond that. Can be iterated several times, each iteration decodes the items one by one.
+    """
+
+    def __init__(self, spool_size):
+        self._file = tempfile.SpooledTemporaryFile(max_size=spool_size, mode='w+b')
+        self._count = 0
+
+    def append(self, item):
+        self._file.seek(0, 2)
+        self._file.write(json.dumps(item).encode('utf-8') + b'\n')
+        self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        position = 0
+        for _ in range(self._count):
+            self._file.seek(position)
+            line = self._file.readline()
+            position = self._file.tell()
+            yield json.loads(line.decode('utf-8'))
+
+    def map(self, func):
+        return MappedJsonArray(self, func)
+
+    def close(self):
+        self._file.close()
+
+
+class MappedJsonArray(object):
+    def __init__(self, array, func):
+        self.array = array
+        self.func = func
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        for item in self.array:
+            yield self.func(item)
+
+
+def _build_value(event, value, events):
+    if event not in START_EVENTS:
+        return value
+
+    builder = ijson.ObjectBuilder()
+    builder.event(event, value)
+    depth = 1
+    for event, value in events:
+        builder.event(event, value)
+        if event in START_EVENTS:
+            depth += 1
+        elif event in END_EVENTS:
+            depth -= 1
+            if not depth:
+                break
+    return builder.value
+
+
+def parse_object_stream(stream, spooled_keys, spool_size=16 * 1024 * 1024):
+    """
+    Incrementally parses a JSON object from a file-like object. Arrays under the top-level keys in `spooled_keys` are
+    decoded item by item into a SpooledJsonArray, so their size does not affect peak memory.
+
+    :type spooled_keys: collections.Container
+    :rtype: dict
+    """
+    if ijson is None:
+        raise Exception('parsing JSON streams requires the ijson package')
+
+    events = iter(ijson.basic_parse(stream, use_float=True))
+    event, _ = next(events)
+    if event != 'start_map':
+        raise ValueError('JSON object expected')
+
+    d = {}
+    for event, key in events:
+        if event == 'end_map':
+            break
+        event, value = next(events)
+        if key in spooled_keys and event == 'start_array':
+            array = SpooledJsonArray(spool_size)
+            for event, value in events:
+                if event == 'end_array':
+                    break
+                array.append(_build_value(event, value, events))
+            d[key] = array
+        else:
+            d[key] = _build_value(event, value, events)
+    return d
@@ -0,0 +1,166 @@
+import os
+import select
+import asyncio
+import logging
+import threading
+import psycopg2
+from psycopg2 import extensions
+
+TASK_CHANNEL = 'kurasuta_task'
+
+logger = logging.getLogger('KurasutaBackendApi')
+
+
+class TaskSubscription(object):
+    """
+    Interest of one waiting request in new tasks of some types. Register it before looking for tasks, so that a task
+    inserted between the lookup and the wait is not missed.
+    """
+
+    def __init__(self, notifier, task_types, event):
+        self.notifier = notifier
+        self.task_types = frozenset(task_types)
+        self.event = event
+
+    def __enter__(self):
+        self.notifier._subscribe(self)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.notifier._unsubscribe(self)
+
+    def clear(self):
+        self.event.clear()
+
+    def wait(self, timeout):
+        """
+        :return: True if a task of a subscribed type may have been created since the last clear()
+        """
+        return self.event.wait(timeout)
+
+
+class AsyncTaskSubscription(TaskSubscription):
+    async def wait(self, timeout):
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class TaskNotifier(object):
+    """
+    Listens for NOTIFY on TASK_CHANNEL (see sql/0004-task-notify.sql) on a dedicated connection in a background thread
+    and wakes subscriptions for the notified task type. If the connection is lost, all subscriptions are woken, as
+    notifications might have been missed in the meantime.
+    """
+
+    def __init__(self, dsn, reconnect_delay=1.0):
+        self.dsn = dsn
+        self.reconnect_delay = reconnect_delay
+        self.pid = os.getpid()
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._notifications = 0
+        self._thread = threading.Thread(target=self._run, name='TaskNotifier', daemon=True)
+        self._thread.start()
+
+    def subscribe(self, task_types):
+        return TaskSubscription(self, task_types, threading.Event())
+
+    def _subscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.add(subscription)
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def _wake(self, task_type=None):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            if task_type is None or task_type in subscription.task_types:
+                subscription.event.set()
+
+    def _run(self):
+        while not self._closed.is_set():
+            connection = None
+            try:
+                connection = psycopg2.connect(self.dsn)
+                connection.set_isolation_level(extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                with connection.cursor() as cursor:
+                    cursor.execute('LISTEN %s' % TASK_CHANNEL)
+                self._wake()
+                while not self._closed.is_set():
+                    if select.select([connection], [], [], self.reconnect_delay) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        self._notifications += 1
+                        self._wake(connection.notifies.pop(0).payload)
+            except Exception:
+                # any failure ends in a reconnect, a dead listener would leave waiting requests to their timeout
+                logger.exception('Listening for task notifications failed')
+                self._wake()
+                self._closed.wait(self.reconnect_delay)
+            finally:
+                if connection is not None:
+                    connection.close()
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            return {'subscriptions': len(self._subscriptions), 'notifications': self._notifications}
+
+
+class AsyncTaskNotifier(TaskNotifier):
+    """
+    TaskNotifier for asyncio, listening on a psycopg 3 async connection. Start it with `await notifier.start()` from
+    within the running event loop.
+    """
+
+    def __init__(self, dsn, reconnect_delay=1.0):
+        self.dsn = dsn
+        self.reconnect_delay = reconnect_delay
+        self.pid = os.getpid()
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self._notifications = 0
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def subscribe(self, task_types):
+        return AsyncTaskSubscription(self, task_types, asyncio.Event())
+
+    async def _run(self):
+        import psycopg
+
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(self.dsn, autocommit=True) as connection:
+                    await connection.execute('LISTEN %s' % TASK_CHANNEL)
+                    self._wake()
+                    async for notify in connection.notifies():
+                        self._notifications += 1
+                        self._wake(notify.payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Listening for task notifications failed')
+                self._wake()
+                await asyncio.sleep(self.reconnect_delay)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
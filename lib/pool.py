@@ -0,0 +1,176 @@
+import os
+import time
+import threading
+import psycopg2
+from psycopg2 import extensions
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnectionMeta(object):
+    def __init__(self):
+        self.created_at = time.monotonic()
+        self.returned_at = self.created_at
+        self.use_count = 0
+
+
+class ConnectionPool(object):
+    """
+    Thread-safe pool of psycopg2 connections shared by all requests of one process.
+
+    Connections idle for longer than `check_after` seconds are health checked before they are handed out, connections
+    older than `max_age` seconds are closed instead of being reused.
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=30.0, max_age=3600.0, check_after=30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise Exception('Invalid pool size %s..%s' % (min_size, max_size))
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_age = max_age
+        self.check_after = check_after
+        self.pid = os.getpid()
+
+        self._condition = threading.Condition()
+        self._idle = []  # type: list[psycopg2.extensions.connection]
+        self._meta = {}  # type: dict[int, PooledConnectionMeta]
+        self._size = 0
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._recycled = 0
+        self._discarded = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+
+        for _ in range(self.min_size):
+            self._reserve_slot()
+            self._idle.append(self._connect())
+
+    def _reserve_slot(self):
+        self._size += 1
+
+    def _release_slot(self):
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def _connect(self):
+        try:
+            connection = psycopg2.connect(self.dsn)
+        except Exception:
+            self._release_slot()
+            raise
+        self._meta[id(connection)] = PooledConnectionMeta()
+        return connection
+
+    def _discard(self, connection, recycled=False):
+        self._meta.pop(id(connection), None)
+        if recycled:
+            self._recycled += 1
+        else:
+            self._discarded += 1
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+        self._release_slot()
+
+    def _is_healthy(self, connection, meta):
+        if connection.closed:
+            return False
+        if time.monotonic() - meta.returned_at < self.check_after:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        while True:
+            connection = None
+            with self._condition:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout('No database connection available after %.1f seconds' % self.timeout)
+                    self._condition.wait(remaining)
+                if self._idle:
+                    connection = self._idle.pop()
+                else:
+                    self._reserve_slot()
+
+            # connecting and health checks happen outside of the lock
+            if connection is None:
+                connection = self._connect()
+            else:
+                meta = self._meta[id(connection)]
+                if time.monotonic() - meta.created_at > self.max_age:
+                    self._discard(connection, recycled=True)
+                    continue
+                if not self._is_healthy(connection, meta):
+                    self._discard(connection)
+                    continue
+
+            waited = time.monotonic() - start
+            with self._condition:
+                self._checkouts += 1
+                self._wait_time_total += waited
+                self._wait_time_max = max(self._wait_time_max, waited)
+            self._meta[id(connection)].use_count += 1
+            return connection
+
+    def putconn(self, connection):
+        if connection.closed:
+            self._discard(connection)
+            return
+        try:
+            if connection.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except psycopg2.Error:
+            self._discard(connection)
+            return
+
+        meta = self._meta[id(connection)]
+        meta.returned_at = time.monotonic()
+        if meta.returned_at - meta.created_at > self.max_age:
+            self._discard(connection, recycled=True)
+            return
+        with self._condition:
+            self._idle.append(connection)
+            self._condition.notify()
+
+    def closeall(self):
+        with self._condition:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            self._discard(connection)
+
+    def stats(self):
+        with self._condition:
+            in_use = self._size - len(self._idle)
+            return {
+                'size': self._size,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'idle': len(self._idle),
+                'in_use': in_use,
+                'utilisation': in_use / float(self.max_size),
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'recycled': self._recycled,
+                'discarded': self._discarded,
+                'wait_time_total': self._wait_time_total,
+                'wait_time_avg': self._wait_time_total / self._checkouts if self._checkouts else 0.0,
+                'wait_time_max': self._wait_time_max,
+            }
@@ -0,0 +1,43 @@
+import json
+import tempfile
+from datetime import datetime, date
+
+COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\n': '\\n', '\r': '\\r', '\t': '\\t'})
+
+
+def copy_value(value):
+    """
+    Encodes a value for the text format of COPY ... FROM STDIN, lists and dicts are encoded as JSON.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\\\x' + bytes(value).hex()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (list, dict)):
+        value = json.dumps(value)
+    return str(value).translate(COPY_ESCAPES)
+
+
+def copy_rows(cursor, table, columns, rows, spool_size=16 * 1024 * 1024):
+    """
+    Writes rows into a table with a single COPY statement. The encoded rows are buffered in memory up to `spool_size`
+    bytes and spill over into a temporary file beyond that.
+
+    :return: number of rows written
+    """
+    count = 0
+    with tempfile.SpooledTemporaryFile(max_size=spool_size, mode='w+b') as buffer:
+        for row in rows:
+            buffer.write(('\t'.join(copy_value(value) for value in row) + '\n').encode('utf-8'))
+            count += 1
+        if not count:
+            return 0
+        buffer.seek(0)
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table, ', '.join(columns)), buffer)
+    return count
@@ -1,6 +1,8 @@
 from .sample import SampleFactory, Sample
-import random
-from datetime import datetime
+from .histogram import unpack_histogram, histogram_to_array
+from .sampling import TableSampleSampler, IdArraySampler
+from .postgres import copy_rows
+from dateutil import parser as date_parser
 
 
 class PostgresRepository(object):
@@ -13,75 +15,253 @@ class PostgresRepository(object):
             return int(cursor.fetchall()[0][0])
 
 
+HYDRATION_PER_TABLE = 'per_table'
+HYDRATION_SINGLE_QUERY = 'single_query'
+HYDRATIONS = (HYDRATION_PER_TABLE, HYDRATION_SINGLE_QUERY)
+
+# samples stored before code_histogram_packed existed reference a 256 column byte_histogram row
+LEGACY_HISTOGRAM_SQL = 'CASE WHEN byte_histogram.id IS NULL THEN NULL ELSE ARRAY[%s] END' % ', '.join(
+    ['byte_histogram.byte_%02x' % i for i in range(256)]
+)
+
+
 class SampleRepository(PostgresRepository):
-    def __init__(self, db):
+    BASE_FIELD_NAMES = [
+        'id',
+        'hash_sha256',
+        'hash_md5',
+        'hash_sha1',
+        'size',
+        'ssdeep',
+        'imphash',
+        'entropy',
+        'file_size',
+        'entry_point',
+        'overlay_sha256',
+        'overlay_size',
+        'overlay_ssdeep',
+        'overlay_entropy',
+        'build_timestamp',
+        'strings_count_of_length_at_least_10',
+        'strings_count'
+    ]
+    # further columns can be inserted for %s (starting with a comma)
+    BASE_SQL = '''
+        SELECT
+            sample.id,
+            sample.hash_sha256,
+            sample.hash_md5,
+            sample.hash_sha1,
+            sample.size,
+            sample.ssdeep,
+            sample.imphash,
+            sample.entropy,
+            sample.file_size,
+            sample.entry_point,
+            sample.overlay_sha256,
+            sample.overlay_size,
+            sample.overlay_ssdeep,
+            sample.overlay_entropy,
+            sample.build_timestamp,
+            sample.strings_count_of_length_at_least_10,
+            sample.strings_count,
+            sample.first_kb,
+            magic.description,
+            export_name.content,
+            sample.code_histogram_packed,
+            ''' + LEGACY_HISTOGRAM_SQL + '''%s
+        FROM sample
+        LEFT JOIN magic ON (sample.magic_id = magic.id)
+        LEFT JOIN export_name ON (sample.export_name_id = export_name.id)
+        LEFT JOIN byte_histogram ON (byte_histogram.id = sample.code_histogram_id)
+        WHERE (sample.id = ANY(%%s))
+    '''
+    # child rows as JSON arrays in the argument order of the SampleFactory.create_* methods, NULL without children
+    CHILDREN_JSON_SQL = ''',
+            (
+                SELECT json_agg(json_build_array(
+                    debug_directory.timestamp,
+                    path.content,
+                    debug_directory.age,
+                    debug_directory.signature,
+                    debug_directory.guid
+                ))
+                FROM debug_directory
+                LEFT JOIN path ON (path.id = debug_directory.path_id)
+                WHERE (debug_directory.sample_id = sample.id)
+            ),
+            (
+                SELECT json_agg(json_build_array(
+                    export_symbol.address,
+                    export_symbol_name.content,
+                    export_symbol.ordinal
+                ))
+                FROM export_symbol
+                LEFT JOIN export_symbol_name ON (export_symbol.name_id = export_symbol_name.id)
+                WHERE (export_symbol.sample_id = sample.id)
+            ),
+            (
+                SELECT json_agg(json_build_array(
+                    dll_name.content,
+                    import.address,
+                    import_name.content
+                ))
+                FROM import
+                LEFT JOIN dll_name ON (dll_name.id = import.dll_name_id)
+                LEFT JOIN import_name ON (import_name.id = import.name_id)
+                WHERE (import.sample_id = sample.id)
+            ),
+            (
+                SELECT json_agg(json_build_array(
+                    resource.hash_sha256,
+                    resource.offset,
+                    resource.size,
+                    resource.actual_size,
+                    resource.ssdeep,
+                    resource.entropy,
+                    resource_type_pair.content_id,
+                    resource_type_pair.content_str,
+                    resource_name_pair.content_id,
+                    resource_name_pair.content_str,
+                    resource_language_pair.content_id,
+                    resource_language_pair.content_str
+                ) ORDER BY resource.sort_order)
+                FROM resource
+                LEFT JOIN resource_type_pair ON (resource_type_pair.id = resource.type_pair_id)
+                LEFT JOIN resource_name_pair ON (resource_name_pair.id = resource.name_pair_id)
+                LEFT JOIN resource_language_pair ON (resource_language_pair.id = resource.language_pair_id)
+                WHERE (resource.sample_id = sample.id)
+            ),
+            (
+                SELECT json_agg(json_build_array(
+                    section.hash_sha256,
+                    section_name.content,
+                    section.virtual_address,
+                    section.virtual_size,
+                    section.raw_size,
+                    section.entropy,
+                    section.ssdeep
+                ))
+                FROM section
+                LEFT JOIN section_name ON (section_name.id = section.name_id)
+                WHERE (section.sample_id = sample.id)
+            ),
+            (
+                SELECT array_agg(ioc.content)
+                FROM sample_has_heuristic_ioc
+                LEFT JOIN ioc ON (sample_has_heuristic_ioc.ioc_id = ioc.id)
+                WHERE (sample_has_heuristic_ioc.sample_id = sample.id)
+            )'''
+
+    def __init__(self, db, hydration=HYDRATION_PER_TABLE, sample_cache=None):
+        """
+        :type sample_cache: lib.cache.SampleCache|None
+        """
         super().__init__(db)
+        if hydration not in HYDRATIONS:
+            raise Exception('Unknown hydration mode "%s"' % hydration)
         self.factory = SampleFactory()
+        self.hydration = hydration
+        self.sample_cache = sample_cache  # read-through cache of by_hash_type
 
     def by_ids(self, ids):
-        ids = tuple(ids)
-
-        # read base samples
+        return list(self.iter_by_ids(ids))
+
+    def iter_ids(self, after_id=0, chunk_size=10000):
+        """
+        Yields the ids of all samples above `after_id` in ascending order. They are streamed from a server-side cursor
+        `chunk_size` at a time, so a stopped iteration can be resumed by passing the last id as `after_id`.
+        """
+        with self.db.cursor(name='sample_ids') as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute('SELECT id FROM sample WHERE (id > %s) ORDER BY id', (after_id,))
+            for row in cursor:
+                yield row[0]
+
+    def ids_between(self, first_id, last_id):
+        """
+        :return: ids of all samples from `first_id` to `last_id` (both inclusive) in ascending order
+        """
+        with self.db.cursor() as cursor:
+            cursor.execute('SELECT id FROM sample WHERE (id BETWEEN %s AND %s) ORDER BY id', (first_id, last_id))
+            return [row[0] for row in cursor.fetchall()]
+
+    def iter_all(self, chunk_size=1000, after_id=0):
+        """
+        Yields all samples above `after_id`, fully hydrated, in ascending order of their ids.
+        """
+        return self.iter_by_ids(self.iter_ids(after_id, chunk_size * 10), chunk_size)
+
+    def iter_by_ids(self, ids, chunk_size=1000):
+        """
+        Yields fully hydrated samples, reading `chunk_size` of them at a time. Only one chunk is held in memory, so
+        `ids` may be arbitrarily large or a generator.
+
+        :type ids: collections.Iterable[int]
+        """
+        chunk = []
+        for sample_id in ids:
+            chunk.append(sample_id)
+            if len(chunk) >= chunk_size:
+                yield from self._hydrate(chunk)
+                chunk = []
+        if chunk:
+            yield from self._hydrate(chunk)
+
+    def _hydrate(self, ids):
+        ids = sorted(set(ids))
+        if self.hydration == HYDRATION_SINGLE_QUERY:
+            samples = self._hydrate_single_query(ids)
+        else:
+            samples = self._hydrate_per_table(ids)
+        return [samples[sample_id] for sample_id in ids if sample_id in samples]
+
+    def _sample_from_base_row(self, row):
+        sample = self.factory.from_row(row, self.BASE_FIELD_NAMES)
+        sample.first_kb = row[17]
+        sample.magic = row[18]
+        sample.export_name = row[19]
+        if row[20] is not None:
+            sample.code_histogram = unpack_histogram(row[20])
+        elif row[21] is not None:
+            sample.code_histogram = histogram_to_array(row[21])
+        return sample
+
+    def _hydrate_single_query(self, ids):
+        """
+        Reads samples and all their children in one query, each child table aggregated into one JSON array per sample.
+        """
         samples = {}
         with self.db.cursor() as cursor:
-            histogram_sql = ', '.join(['byte_histogram.byte_%02x' % i for i in range(256)])
-            cursor.execute('''
-                SELECT
-                    sample.id,
-                    sample.hash_sha256,
-                    sample.hash_md5,
-                    sample.hash_sha1,
-                    sample.size,
-                    sample.ssdeep,
-                    sample.imphash,
-                    sample.entropy,
-                    sample.file_size,
-                    sample.entry_point,
-                    sample.overlay_sha256,
-                    sample.overlay_size,
-                    sample.overlay_ssdeep,
-                    sample.overlay_entropy,
-                    sample.build_timestamp,
-                    sample.strings_count_of_length_at_least_10,
-                    sample.strings_count,
-                    sample.first_kb,
-                    magic.description,
-                    export_name.content,
-                    %s
-                FROM sample
-                LEFT JOIN magic ON (sample.magic_id = magic.id)
-                LEFT JOIN export_name ON (sample.magic_id = export_name.id)
-                LEFT JOIN byte_histogram ON (byte_histogram.id = sample.code_histogram_id)
-                WHERE (sample.id IN %%s)
-            ''' % histogram_sql, (ids,))
+            cursor.execute(self.BASE_SQL % self.CHILDREN_JSON_SQL, (ids,))
             for row in cursor.fetchall():
-                sample = self.factory.from_row(
-                    row,
-                    [
-                        'id',
-                        'hash_sha256',
-                        'hash_md5',
-                        'hash_sha1',
-                        'size',
-                        'ssdeep',
-                        'imphash',
-                        'entropy',
-                        'file_size',
-                        'entry_point',
-                        'overlay_sha256',
-                        'overlay_size',
-                        'overlay_ssdeep',
-                        'overlay_entropy',
-                        'build_timestamp',
-                        'strings_count_of_length_at_least_10',
-                        'strings_count'
+                sample = self._sample_from_base_row(row)
+                if row[22] is not None:
+                    sample.debug_directories = [
+                        self.factory.create_debug_directory(
+                            date_parser.parse(timestamp) if timestamp else None, path, age, signature, guid
+                        )
+                        for timestamp, path, age, signature, guid in row[22]
                     ]
-                )
-                sample.first_kb = row[17]
-                sample.magic = row[18]
-                sample.export_name = row[19]
-                sample.code_histogram = dict((i, row[20 + i]) for i in range(256))
+                if row[23] is not None:
+                    sample.exports = [self.factory.create_export(*export) for export in row[23]]
+                if row[24] is not None:
+                    sample.imports = [self.factory.create_import(*sample_import) for sample_import in row[24]]
+                if row[25] is not None:
+                    sample.resources = [self.factory.create_resource(*resource) for resource in row[25]]
+                if row[26] is not None:
+                    sample.sections = [self.factory.create_section(*section) for section in row[26]]
+                sample.heuristic_iocs = row[27]
                 samples[row[0]] = sample
+        return samples
+
+    def _hydrate_per_table(self, ids):
+        # read base samples
+        samples = {}
+        with self.db.cursor() as cursor:
+            cursor.execute(self.BASE_SQL % '', (ids,))
+            for row in cursor.fetchall():
+                samples[row[0]] = self._sample_from_base_row(row)
 
             # read debug directories
             cursor.execute('''
@@ -94,7 +274,7 @@ class SampleRepository(PostgresRepository):
                     debug_directory.sample_id
                 FROM debug_directory
                 LEFT JOIN path ON (path.id = debug_directory.path_id)
-                WHERE (sample_id IN %s)
+                WHERE (sample_id = ANY(%s))
             ''', (ids,))
             for row in cursor.fetchall():
                 if samples[row[5]].debug_directories is None:
@@ -110,7 +290,7 @@ class SampleRepository(PostgresRepository):
                     export_symbol.sample_id
                 FROM export_symbol
                 LEFT JOIN export_symbol_name ON (export_symbol.name_id = export_symbol_name.id)
-                WHERE (sample_id IN %s)
+                WHERE (sample_id = ANY(%s))
             ''', (ids,))
             for row in cursor.fetchall():
                 if samples[row[3]].exports is None:
@@ -127,7 +307,7 @@ class SampleRepository(PostgresRepository):
                 FROM import
                 LEFT JOIN dll_name ON (dll_name.id = import.dll_name_id)
                 LEFT JOIN import_name ON (import_name.id = import.name_id)
-                WHERE (sample_id IN %s)
+                WHERE (sample_id = ANY(%s))
             ''', (ids,))
             for row in cursor.fetchall():
                 if samples[row[3]].imports is None:
@@ -141,8 +321,8 @@ class SampleRepository(PostgresRepository):
                     resource.offset,
                     resource.size,
                     resource.actual_size,
-                    resource.entropy,
                     resource.ssdeep,
+                    resource.entropy,
                     resource_type_pair.content_id,
                     resource_type_pair.content_str,
                     resource_name_pair.content_id,
@@ -154,7 +334,7 @@ class SampleRepository(PostgresRepository):
                 LEFT JOIN resource_type_pair ON (resource_type_pair.id = resource.type_pair_id)
                 LEFT JOIN resource_name_pair ON (resource_name_pair.id = resource.name_pair_id)
                 LEFT JOIN resource_language_pair ON (resource_language_pair.id = resource.language_pair_id)
-                WHERE (resource.sample_id IN %s)
+                WHERE (resource.sample_id = ANY(%s))
                 ORDER BY resource.sort_order
             ''', (ids,))
             for row in cursor.fetchall():
@@ -175,7 +355,7 @@ class SampleRepository(PostgresRepository):
                     section.sample_id
                 FROM section
                 LEFT JOIN section_name ON (section_name.id = section.name_id)
-                WHERE (section.sample_id IN %s)
+                WHERE (section.sample_id = ANY(%s))
             ''', (ids,))
             for row in cursor.fetchall():
                 if samples[row[7]].sections is None:
@@ -189,14 +369,13 @@ class SampleRepository(PostgresRepository):
                     ioc.content
                 FROM ioc
                 LEFT JOIN sample_has_heuristic_ioc ON (sample_has_heuristic_ioc.ioc_id = ioc.id)
-                WHERE (sample_has_heuristic_ioc.sample_id IN %s)
+                WHERE (sample_has_heuristic_ioc.sample_id = ANY(%s))
             ''', (ids,))
             for row in cursor.fetchall():
                 if samples[row[0]].heuristic_iocs is None:
                     samples[row[0]].heuristic_iocs = []
                 samples[row[0]].heuristic_iocs.append(row[1])
-
-        return [sample for sample in samples.values()]
+        return samples
 
     def by_section_hash(self, sha256):
         with self.db.cursor() as cursor:
@@ -224,6 +403,21 @@ class SampleRepository(PostgresRepository):
         return self.by_hash_type('sha1', sha1)
 
     def by_hash_type(self, hash_type, sha256):
+        """
+        :param hash_type: "sha256", "md5" or "sha1"
+        :param sha256: hash of the given type
+        """
+        if self.sample_cache is not None:
+            sample = self.sample_cache.get(hash_type, sha256)
+            if sample is not None:
+                return sample
+
+        sample = self._read_by_hash_type(hash_type, sha256)
+        if sample is not None and self.sample_cache is not None:
+            self.sample_cache.set(sample)
+        return sample
+
+    def _read_by_hash_type(self, hash_type, sha256):
         with self.db.cursor() as cursor:
             cursor.execute('''
                 SELECT
@@ -333,70 +527,95 @@ class SampleRepository(PostgresRepository):
             return ret
 
     def random_by_offset(self, output_count):
-        random.seed(datetime.now())
-        with self.db.cursor() as cursor:
-            approximate_row_count = self.approx_count('sample')
-            ret = []
-            while len(ret) < output_count:
-                rand = random.randint(0, approximate_row_count)
-                cursor.execute('SELECT id, hash_sha256, build_timestamp FROM sample LIMIT 1 OFFSET %s', (rand,))
-                ret += [
-                    self.factory.from_row(row, ['id', 'hash_sha256', 'build_timestamp'])
-                    for row in cursor.fetchall()
-                ]
-
-            return ret[:output_count]
+        """
+        Random samples drawn with TABLESAMPLE, see lib.sampling.TableSampleSampler.
+        """
+        return self._summaries_by_ids(TableSampleSampler(self.db).sample_ids(output_count))
 
     def random_by_id(self, output_count):
-        random.seed(datetime.now())
+        """
+        Uniformly drawn random samples from the id array snapshot, see lib.sampling.IdArraySampler.
+        """
+        return self._summaries_by_ids(IdArraySampler(self.db).sample_ids(output_count))
+
+    def random_stratified(self, count_per_stratum, stratify_by):
+        """
+        Uniformly drawn random samples of each stratum, see lib.sampling.IdArraySampler.
+
+        :param stratify_by: one of the lib.sampling.STRATIFY_* constants
+        :return: dict stratum => list of samples
+        """
+        strata = IdArraySampler(self.db).sample_stratified_ids(count_per_stratum, stratify_by)
+        samples = {sample.id: sample for sample in self._summaries_by_ids(
+            [sample_id for sample_ids in strata.values() for sample_id in sample_ids]
+        )}
+        return {
+            stratum: [samples[sample_id] for sample_id in sample_ids if sample_id in samples]
+            for stratum, sample_ids in strata.items()
+        }
+
+    def _summaries_by_ids(self, ids):
+        if not ids:
+            return []
         with self.db.cursor() as cursor:
-            cursor.execute('SELECT MIN(id), MAX(id) FROM sample')
-            min_id, max_id = cursor.fetchall()[0]
-            random_ids = []
-            while len(random_ids) < output_count:
-                random_potential_ids = random.sample(range(min_id, max_id), output_count)
-                cursor.execute('SELECT id FROM sample WHERE (id IN %s)', (tuple(random_potential_ids),))
-                random_ids += [row[0] for row in cursor.fetchall()]
-                random_ids = list(set(random_ids))
-
-            cursor.execute(
-                'SELECT id, hash_sha256, build_timestamp FROM sample WHERE (id IN %s)',
-                (tuple(random_ids[:output_count]),)
-            )
-
-            return [
-                self.factory.from_row(row, ['id', 'hash_sha256', 'build_timestamp'])
+            cursor.execute('SELECT id, hash_sha256, build_timestamp FROM sample WHERE (id = ANY(%s))', (list(ids),))
+            samples = {
+                row[0]: self.factory.from_row(row, ['id', 'hash_sha256', 'build_timestamp'])
                 for row in cursor.fetchall()
-            ]
+            }
+        return [samples[sample_id] for sample_id in ids if sample_id in samples]
 
     def ids_by_hashes(self, hashes):
-        sha256 = []
-        md5 = []
-        sha1 = []
-        for line in hashes:
-            hash = line.strip().decode('utf-8')
-            if len(hash) == 64:
-                sha256.append(hash)
-            elif len(hash) == 32:
-                md5.append(hash)
-            elif len(hash) == 40:
-                sha1.append(hash)
-        where = []
-        args = []
-        if sha256:
-            where.append('(hash_sha256 IN %s)')
-            args.append(tuple(sha256))
-        if md5:
-            where.append('(hash_md5 IN %s)')
-            args.append(tuple(md5))
-        if sha1:
-            where.append('(hash_sha1 IN %s)')
-            args.append(tuple(sha1))
-
+        sample_ids = {}
+        for chunk in self.resolve_hashes(hashes):
+            sample_ids.update((sample_id, None) for _, sample_id, _ in chunk if sample_id is not None)
+        return list(sample_ids)
+
+    def resolve_hashes(self, hashes, chunk_size=10000):
+        """
+        Resolves SHA256, MD5 and SHA1 hashes to samples, memory use does not depend on the number of hashes. The hashes
+        are streamed into a temporary table with COPY and joined against the hash indexes of "sample". Runs within the
+        current transaction of the connection, which must not be committed while iterating.
+
+        :param hashes: iterable of hashes as str or bytes, e.g. the lines of a file
+        :return: generator of lists of up to `chunk_size` (input hash, sample id, sample SHA256) tuples in input order,
+            id and SHA256 are None for hashes without sample
+        """
         with self.db.cursor() as cursor:
-            cursor.execute('SELECT sample.id FROM sample WHERE (%s)' % (' OR '.join(where)), args)
-            ids = [row[0] for row in cursor]
-        return ids
+            cursor.execute('DROP TABLE IF EXISTS pg_temp.resolve_hash')
+            cursor.execute('CREATE TEMPORARY TABLE resolve_hash (position bigint, hash text) ON COMMIT DROP')
+            copy_rows(cursor, 'resolve_hash', ['position', 'hash'], (
+                (position, hash_value)
+                for position, hash_value in enumerate(
+                    (line.decode('utf-8') if isinstance(line, bytes) else line).strip().lower() for line in hashes
+                )
+                if hash_value
+            ))
+            cursor.execute('ANALYZE resolve_hash')
+
+        # each branch of the lateral union can use the index of its hash column
+        with self.db.cursor(name='resolve_hashes') as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute('''
+                SELECT resolve_hash.hash, found.id, found.hash_sha256
+                FROM resolve_hash
+                LEFT JOIN LATERAL (
+                    SELECT id, hash_sha256 FROM sample
+                    WHERE (LENGTH(resolve_hash.hash) = 64) AND (sample.hash_sha256 = resolve_hash.hash)
+                    UNION ALL
+                    SELECT id, hash_sha256 FROM sample
+                    WHERE (LENGTH(resolve_hash.hash) = 32) AND (sample.hash_md5 = resolve_hash.hash)
+                    UNION ALL
+                    SELECT id, hash_sha256 FROM sample
+                    WHERE (LENGTH(resolve_hash.hash) = 40) AND (sample.hash_sha1 = resolve_hash.hash)
+                ) found ON TRUE
+                ORDER BY resolve_hash.position
+            ''')
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield [tuple(row) for row in rows]
 
 
 class ApiKeyRepository(PostgresRepository):
@@ -1,19 +1,70 @@
+import re
+import json
+import time
+from itertools import islice
+from datetime import datetime
+from json.encoder import encode_basestring_ascii as encode_json_string
 from dateutil import parser as date_parser
+from dateutil import tz
+
+# "2018-01-31 12:34:56", optionally with T as separator, milli- or microseconds and a UTC designator or offset
+ISO_TIMESTAMP = re.compile(
+    r'(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})(?:\.(\d{3}|\d{6}))?(Z| UTC|[+-]\d{2}:\d{2})?$'
+)
+
+UTC_NAMES = frozenset(('UTC', 'UCT', 'Z', 'GMT', 'UT', 'Universal', 'Zulu'))
+
+
+def parse_timestamp(value):
+    """
+    Parses timestamps like dateutil.parser.parse, with a fast path for the ISO 8601 format emitted by the workers.
+    """
+    match = ISO_TIMESTAMP.match(value)
+    if not match:
+        return date_parser.parse(value)
+    year, month, day, hour, minute, second, fraction, zone = match.groups()
+    if zone is None:
+        tzinfo = None
+    else:
+        offset = 0 if zone in ('Z', ' UTC') else (int(zone[1:3]) * 60 + int(zone[4:6])) * 60
+        if zone[0] == '-':
+            offset = -offset
+        if offset:
+            tzinfo = tz.tzoffset(None, offset)
+        elif UTC_NAMES.isdisjoint(time.tzname):
+            tzinfo = tz.tzutc()
+        else:
+            # dateutil returns tzlocal() for UTC if that is the local time zone
+            return date_parser.parse(value)
+    return datetime(
+        int(year), int(month), int(day), int(hour), int(minute), int(second),
+        int(fraction.ljust(6, '0')) if fraction else 0,
+        tzinfo
+    )
 
 
 class FrozenClass(object):
-    __isfrozen = False
+    """
+    Base of the model classes. Subclasses list their attributes in __slots__, so instances have no __dict__ and
+    setting any other attribute raises AttributeError, without a check on every assignment.
+    """
+    __slots__ = ()
 
-    def __setattr__(self, key, value):
-        if self.__isfrozen and not hasattr(self, key):
-            raise TypeError('%r is a frozen class, cannot set "%s" to "%s"' % (self, key, value))
-        object.__setattr__(self, key, value)
-
-    def _freeze(self):
-        self.__isfrozen = True
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if '__slots__' not in cls.__dict__:
+            raise TypeError('%s needs to declare __slots__' % cls.__name__)
 
 
 class Sample(FrozenClass):
+    __slots__ = (
+        'id', 'hash_sha256', 'hash_md5', 'hash_sha1', 'size', 'peyd', 'magic', 'ssdeep', 'imphash', 'entropy',
+        'file_size', 'entry_point', 'first_kb', 'overlay_sha256', 'overlay_size', 'overlay_ssdeep', 'overlay_entropy',
+        'build_timestamp', 'debug_directories', 'export_name', 'exports', 'imports',
+        'strings_count_of_length_at_least_10', 'strings_count', 'heuristic_iocs', 'sections', 'resources', 'functions',
+        'code_histogram', 'source_id', 'tags', 'file_names', 'processed_at'
+    )
+
     def __init__(self):
         self.id = None  # type: int
         self.hash_sha256 = None  # type: str
@@ -49,20 +100,25 @@ class Sample(FrozenClass):
         self.resources = []  # type: list[SampleResource]
 
         self.functions = []  # type: list[SampleFunction]
-        self.code_histogram = None
+        self.code_histogram = None  # type: dict|numpy.ndarray
 
         self.source_id = None  # type: int
         self.tags = None  # type: list[str]
         self.file_names = None  # type: list[str]
 
         self.processed_at = None  # type DateTime
-        self._freeze()
 
     def __repr__(self):
         return '<Sample %s,%s,%s>' % (self.hash_sha256, self.hash_md5, self.hash_sha1)
 
 
 class SampleFunction(FrozenClass):
+    __slots__ = (
+        'offset', 'size', 'real_size', 'name', 'calltype', 'cc', 'cost', 'ebbs', 'edges', 'indegree', 'nargs', 'nbbs',
+        'nlocals', 'outdegree', 'type', 'opcodes_sha256', 'opcodes_crc32', 'cleaned_opcodes_sha256',
+        'cleaned_opcodes_crc32', 'opcodes'
+    )
+
     def __init__(self):
         self.offset = None  # type: int
         self.size = None  # type: int
@@ -88,10 +144,10 @@ class SampleFunction(FrozenClass):
 
         self.opcodes = None  # type: list
 
-        self._freeze()
-
 
 class SampleSection(FrozenClass):
+    __slots__ = ('hash_sha256', 'virtual_address', 'virtual_size', 'raw_size', 'name', 'entropy', 'ssdeep')
+
     def __init__(self):
         self.hash_sha256 = None  # type: str
         self.virtual_address = None  # type: int
@@ -102,8 +158,6 @@ class SampleSection(FrozenClass):
         self.entropy = None  # type: float
         self.ssdeep = None  # type: str
 
-        self._freeze()
-
     def __repr__(self):
         return '<Section %s,%s,%s,%s,%s>' % (
             self.hash_sha256,
@@ -115,13 +169,13 @@ class SampleSection(FrozenClass):
 
 
 class SampleMeta(FrozenClass):
+    __slots__ = ('source_id', 'tags', 'file_names')
+
     def __init__(self):
         self.source_id = None  # type: None|int
         self.tags = []  # type: list[str]
         self.file_names = []  # type: list[str]
 
-        self._freeze()
-
     def to_dict(self):
         data = {}
         if self.tags:
@@ -134,6 +188,11 @@ class SampleMeta(FrozenClass):
 
 
 class SampleResource(FrozenClass):
+    __slots__ = (
+        'hash_sha256', 'offset', 'size', 'actual_size', 'ssdeep', 'entropy', 'type_id', 'type_str', 'name_id',
+        'name_str', 'language_id', 'language_str'
+    )
+
     def __init__(self):
         self.hash_sha256 = None  # type: str
         self.offset = None  # type: int
@@ -149,8 +208,6 @@ class SampleResource(FrozenClass):
         self.language_id = None  # type: str
         self.language_str = None  # type: str
 
-        self._freeze()
-
     def __repr__(self):
         return '<Resource %s offset=%s,size=%s,actual_size=%s,type=%s:%s,name=%s:%s,language=%s:%s>' % (
             self.hash_sha256,
@@ -164,29 +221,32 @@ class SampleResource(FrozenClass):
 
 
 class SampleExport(FrozenClass):
+    __slots__ = ('address', 'name', 'ordinal')
+
     def __init__(self):
         self.address = None  # type: int
         self.name = None  # type: str
         self.ordinal = None  # type: str
-        self._freeze()
 
 
 class SampleImport(FrozenClass):
+    __slots__ = ('dll_name', 'address', 'name')
+
     def __init__(self):
         self.dll_name = None  # type: str
         self.address = None  # type: int
         self.name = None  # type: str
-        self._freeze()
 
 
 class SampleDebugDirectory(FrozenClass):
+    __slots__ = ('timestamp', 'path', 'age', 'signature', 'guid')
+
     def __init__(self):
         self.timestamp = None
         self.path = None  # type: str
         self.age = None  # type: int
         self.signature = None  # type: str
         self.guid = None  # type: str
-        self._freeze()
 
     def __repr__(self):
         return '<SampleDebugDirectory path=%s,age=%s,signature=%s,guid=%s>' % (
@@ -198,6 +258,9 @@ class SampleDebugDirectory(FrozenClass):
 
 
 class SampleFactory(object):
+    def __init__(self):
+        self._fields = None  # decoding table of from_json, built on first use
+
     @staticmethod
     def create_export(address, name, ordinal):
         export = SampleExport()
@@ -285,123 +348,142 @@ class SampleFactory(object):
         func.opcodes = opcodes
         return func
 
+    @staticmethod
+    def _map_items(items, func):
+        # arrays of streamed requests (see lib/json_stream.py) are converted lazily on iteration
+        if hasattr(items, 'map'):
+            return items.map(func)
+        return [func(item) for item in items]
+
+    def debug_directory_from_json(self, debug_directory):
+        directory = SampleDebugDirectory.__new__(SampleDebugDirectory)
+        directory.timestamp = parse_timestamp(debug_directory['timestamp']) if debug_directory['timestamp'] else None
+        directory.path = debug_directory['path']
+        directory.age = int(debug_directory['age']) if debug_directory['age'] else None
+        directory.signature = debug_directory['signature']
+        directory.guid = debug_directory['guid']
+        return directory
+
+    def export_from_json(self, export):
+        sample_export = SampleExport.__new__(SampleExport)
+        sample_export.address = export['address']
+        sample_export.name = export['name']
+        sample_export.ordinal = export['ordinal']
+        return sample_export
+
+    def import_from_json(self, sample_import):
+        imp = SampleImport.__new__(SampleImport)
+        imp.dll_name = sample_import['dll_name']
+        imp.address = sample_import['address']
+        imp.name = sample_import['name']
+        return imp
+
+    def section_from_json(self, section):
+        sample_section = SampleSection.__new__(SampleSection)
+        sample_section.hash_sha256 = section['hash_sha256']
+        sample_section.name = section['name']
+        sample_section.virtual_address = section['virtual_address']
+        sample_section.virtual_size = section['virtual_size']
+        sample_section.raw_size = section['raw_size']
+        sample_section.entropy = section['entropy']
+        sample_section.ssdeep = section['ssdeep']
+        return sample_section
+
+    def resource_from_json(self, resource):
+        sample_resource = SampleResource.__new__(SampleResource)
+        sample_resource.hash_sha256 = resource['hash_sha256']
+        sample_resource.offset = resource['offset']
+        sample_resource.size = resource['size']
+        sample_resource.actual_size = resource['actual_size']
+        sample_resource.ssdeep = resource['ssdeep']
+        sample_resource.entropy = resource['entropy']
+        sample_resource.type_id = resource.get('type_id')
+        sample_resource.type_str = resource.get('type_str')
+        sample_resource.name_id = resource.get('name_id')
+        sample_resource.name_str = resource.get('name_str')
+        sample_resource.language_id = resource.get('language_id')
+        sample_resource.language_str = resource.get('language_str')
+        return sample_resource
+
+    def function_from_json(self, func):
+        # all slots are assigned below, so the defaults of __init__ are skipped
+        function = SampleFunction.__new__(SampleFunction)
+        function.offset = func['offset']
+        function.size = func['size']
+        function.real_size = func['real_size']
+        function.name = func['name']
+        function.calltype = func['calltype']
+        function.cc = func['cc']
+        function.cost = func['cost']
+        function.ebbs = func['ebbs']
+        function.edges = func['edges']
+        function.indegree = func['indegree']
+        function.nargs = func['nargs']
+        function.nbbs = func['nbbs']
+        function.nlocals = func['nlocals']
+        function.outdegree = func['outdegree']
+        function.type = func['type']
+        function.opcodes_sha256 = func['opcodes_sha256']
+        function.opcodes_crc32 = func['opcodes_crc32']
+        function.cleaned_opcodes_sha256 = func['cleaned_opcodes_sha256']
+        function.cleaned_opcodes_crc32 = func['cleaned_opcodes_crc32']
+        function.opcodes = func['opcodes']
+        return function
+
+    def _json_fields(self):
+        """
+        :return: dict of JSON key => (Sample attribute, conversion or None)
+        """
+        if self._fields is None:
+            def items(func):
+                return lambda value: self._map_items(value, func)
+
+            self._fields = {
+                'hash_sha256': ('hash_sha256', None),
+                'hash_md5': ('hash_md5', None),
+                'hash_sha1': ('hash_sha1', None),
+                'size': ('size', int),
+                'code_histogram': ('code_histogram', None),
+                'magic': ('magic', None),
+                'peyd': ('peyd', None),
+                'ssdeep': ('ssdeep', None),
+                'imphash': ('imphash', None),
+                'entropy': ('entropy', float),
+                'file_size': ('file_size', int),
+                'entry_point': ('entry_point', int),
+                'first_kb': ('first_kb', None),
+                'overlay_sha256': ('overlay_sha256', None),
+                'overlay_size': ('overlay_size', int),
+                'overlay_ssdeep': ('overlay_ssdeep', None),
+                'overlay_entropy': ('overlay_entropy', float),
+                'build_timestamp': ('build_timestamp', parse_timestamp),
+                'debug_directories': ('debug_directories', items(self.debug_directory_from_json)),
+                'strings_count_of_length_at_least_10': ('strings_count_of_length_at_least_10', int),
+                'strings_count': ('strings_count', int),
+                'heuristic_iocs': ('heuristic_iocs', None),
+                'export_name': ('export_name', None),
+                'exports': ('exports', items(self.export_from_json)),
+                'imports': ('imports', items(self.import_from_json)),
+                'sections': ('sections', items(self.section_from_json)),
+                'resources': ('resources', items(self.resource_from_json)),
+                'functions': ('functions', items(self.function_from_json)),
+                'source_id': ('source_id', None),
+                'tags': ('tags', None),
+                'file_names': ('file_names', None),
+            }
+        return self._fields
+
     def from_json(self, d):
         """
         :param d:
         :return: Sample
         """
         sample = Sample()
-
-        if 'hash_sha256' in d.keys(): sample.hash_sha256 = d['hash_sha256']
-        if 'hash_md5' in d.keys(): sample.hash_md5 = d['hash_md5']
-        if 'hash_sha1' in d.keys(): sample.hash_sha1 = d['hash_sha1']
-        if 'size' in d.keys(): sample.size = int(d['size'])
-        if 'code_histogram' in d.keys(): sample.code_histogram = d['code_histogram']
-        if 'magic' in d.keys(): sample.magic = d['magic']
-        if 'peyd' in d.keys(): sample.peyd = d['peyd']
-
-        if 'ssdeep' in d.keys(): sample.ssdeep = d['ssdeep']
-        if 'imphash' in d.keys(): sample.imphash = d['imphash']
-        if 'entropy' in d.keys(): sample.entropy = float(d['entropy'])
-
-        if 'file_size' in d.keys(): sample.file_size = int(d['file_size'])
-        if 'entry_point' in d.keys(): sample.entry_point = int(d['entry_point'])
-        if 'first_kb' in d.keys(): sample.first_kb = d['first_kb']
-
-        if 'overlay_sha256' in d.keys(): sample.overlay_sha256 = d['overlay_sha256']
-        if 'overlay_size' in d.keys(): sample.overlay_size = int(d['overlay_size'])
-        if 'overlay_ssdeep' in d.keys(): sample.overlay_ssdeep = d['overlay_ssdeep']
-        if 'overlay_entropy' in d.keys(): sample.overlay_entropy = float(d['overlay_entropy'])
-
-        if 'build_timestamp' in d.keys(): sample.build_timestamp = date_parser.parse(d['build_timestamp'])
-
-        if 'debug_directories' in d.keys():
-            sample.debug_directories = [
-                self.create_debug_directory(
-                    date_parser.parse(debug_directory['timestamp']) if debug_directory['timestamp'] else None,
-                    debug_directory['path'],
-                    int(debug_directory['age']) if debug_directory['age'] else None,
-                    debug_directory['signature'],
-                    debug_directory['guid']
-                )
-                for debug_directory in d['debug_directories']
-            ]
-
-        if 'strings_count_of_length_at_least_10' in d.keys():
-            sample.strings_count_of_length_at_least_10 = int(d['strings_count_of_length_at_least_10'])
-        if 'strings_count' in d.keys(): sample.strings_count = int(d['strings_count'])
-        if 'heuristic_iocs' in d.keys(): sample.heuristic_iocs = d['heuristic_iocs']
-
-        if 'export_name' in d.keys(): sample.export_name = d['export_name']
-        if 'exports' in d.keys():
-            sample.exports = [
-                self.create_export(export['address'], export['name'], export['ordinal'])
-                for export in d['exports']
-            ]
-        if 'imports' in d.keys():
-            sample.imports = [
-                self.create_import(sample_import['dll_name'], sample_import['address'], sample_import['name'])
-                for sample_import in d['imports']
-            ]
-
-        if 'sections' in d.keys():
-            sample.sections = [
-                self.create_section(
-                    section['hash_sha256'], section['name'], section['virtual_address'],
-                    section['virtual_size'], section['raw_size'], section['entropy'], section['ssdeep'],
-                )
-                for section in d['sections']
-            ]
-
-        if 'resources' in d.keys():
-            sample.resources = [
-                self.create_resource(
-                    resource['hash_sha256'], resource['offset'], resource['size'], resource['actual_size'],
-                    resource['ssdeep'], resource['entropy'],
-                    resource['type_id'] if 'type_id' in resource else None,
-                    resource['type_str'] if 'type_str' in resource else None,
-                    resource['name_id'] if 'name_id' in resource else None,
-                    resource['name_str'] if 'name_str' in resource else None,
-                    resource['language_id'] if 'language_id' in resource else None,
-                    resource['language_str'] if 'language_str' in resource else None
-                )
-                for resource in d['resources']
-            ]
-
-        if 'functions' in d.keys():
-            sample.functions = [
-                self.create_function(
-                    func['offset'],
-                    func['size'],
-                    func['real_size'],
-                    func['name'],
-                    func['calltype'],
-                    func['cc'],
-                    func['cost'],
-                    func['ebbs'],
-                    func['edges'],
-                    func['indegree'],
-                    func['nargs'],
-                    func['nbbs'],
-                    func['nlocals'],
-                    func['outdegree'],
-                    func['type'],
-                    func['opcodes_sha256'],
-                    func['opcodes_crc32'],
-                    func['cleaned_opcodes_sha256'],
-                    func['cleaned_opcodes_crc32'],
-                    func['opcodes']
-                )
-                for func in d['functions']
-            ]
-
-        if 'source_id' in d.keys():
-            sample.source_id = d['source_id']
-        if 'tags' in d.keys():
-            sample.tags = d['tags']
-        if 'file_names' in d.keys():
-            sample.file_names = d['file_names']
-
+        fields = self._json_fields()
+        for key, value in d.items():
+            if key in fields:
+                attribute, conversion = fields[key]
+                setattr(sample, attribute, value if conversion is None else conversion(value))
         return sample
 
     def from_row(self, row, field_names):
@@ -411,9 +493,98 @@ class SampleFactory(object):
         return sample
 
 
+def encode_json_value(value):
+    """
+    Encodes a value like json.dumps, with shortcuts for the types most fields have.
+    """
+    value_type = type(value)
+    if value_type is str:
+        return encode_json_string(value)
+    if value_type is int:
+        return int.__repr__(value)
+    if value is None:
+        return 'null'
+    return json.dumps(value)
+
+
 class JsonFactory(object):
-    def __init__(self, filter=None):
+    """
+    Converts samples to the JSON layout read by SampleFactory.from_json, either as dict (from_sample) or as JSON text
+    written piecewise (iter_json, write_sample) without building the dict of the whole sample first.
+    Only top level keys containing `filter` are converted.
+    """
+
+    def __init__(self, filter=None, raw_bytes=False, items_per_chunk=25):
         self.filter = filter
+        self.raw_bytes = raw_bytes  # keep binary fields as bytes for binary formats like MessagePack instead of hex
+        self.items_per_chunk = items_per_chunk
+        # (key, whether falsy values are left out, conversion, whether the conversion applies to each list item)
+        self._plan = [
+            field for field in (
+                ('id', False, None, False),
+                ('hash_sha256', False, None, False),
+                ('hash_md5', False, None, False),
+                ('hash_sha1', False, None, False),
+                ('size', False, None, False),
+                ('code_histogram', False, self._code_histogram, False),
+                ('magic', False, None, False),
+                ('peyd', False, None, False),
+                ('ssdeep', False, None, False),
+                ('imphash', False, None, False),
+                ('entropy', False, None, False),
+                ('file_size', False, None, False),
+                ('entry_point', False, None, False),
+                ('first_kb', False, self._first_kb, False),
+                ('overlay_sha256', False, None, False),
+                ('overlay_size', False, None, False),
+                ('overlay_ssdeep', False, None, False),
+                ('overlay_entropy', False, None, False),
+                ('build_timestamp', False, self._timestamp, False),
+                ('debug_directories', True, self.from_debug_directory, True),
+                ('strings_count_of_length_at_least_10', False, None, False),
+                ('strings_count', False, None, False),
+                ('heuristic_iocs', False, None, False),
+                ('export_name', False, None, False),
+                ('exports', True, self.from_export, True),
+                ('imports', True, self.from_import, True),
+                ('sections', True, self.from_section, True),
+                ('resources', True, self.from_resource, True),
+                ('functions', True, self.from_function, True),
+                ('processed_at', True, None, False),
+            ) if not filter or filter in field[0]
+        ]
+
+    @staticmethod
+    def _code_histogram(code_histogram):
+        # histograms read from the database are NumPy arrays, JSON uses the dict layout of SampleFactory.from_json
+        if hasattr(code_histogram, 'tolist'):
+            return dict(('%s' % i, count) for i, count in enumerate(code_histogram.tolist()))
+        return code_histogram
+
+    def _first_kb(self, first_kb):
+        return bytes(first_kb) if self.raw_bytes else bytes(first_kb).hex()
+
+    @staticmethod
+    def _timestamp(timestamp):
+        return '%s UTC' % timestamp
+
+    @staticmethod
+    def from_debug_directory(debug_directory):
+        return {
+            'timestamp': '%s UTC' % debug_directory.timestamp,
+            'path': debug_directory.path,
+            'age': debug_directory.age,
+            'signature': debug_directory.signature,
+            'guid': debug_directory.guid
+        }
+
+    @staticmethod
+    def from_export(export):
+        return {'address': export.address, 'name': export.name, 'ordinal': export.ordinal}
+
+    @staticmethod
+    def from_import(sample_import):
+        return {'dll_name': sample_import.dll_name, 'address': sample_import.address, 'name': sample_import.name}
 
     @staticmethod
     def from_section(section):
@@ -446,95 +617,80 @@ class JsonFactory(object):
 
         return ret
 
+    @staticmethod
+    def from_function(func):
+        return {
+            'offset': func.offset,
+            'size': func.size,
+            'real_size': func.real_size,
+            'name': func.name,
+            'calltype': func.calltype,
+            'cc': func.cc,
+            'cost': func.cost,
+            'ebbs': func.ebbs,
+            'edges': func.edges,
+            'indegree': func.indegree,
+            'nargs': func.nargs,
+            'nbbs': func.nbbs,
+            'nlocals': func.nlocals,
+            'outdegree': func.outdegree,
+            'type': func.type,
+            'opcodes_sha256': func.opcodes_sha256,
+            'opcodes_crc32': func.opcodes_crc32,
+            'cleaned_opcodes_sha256': func.cleaned_opcodes_sha256,
+            'cleaned_opcodes_crc32': func.cleaned_opcodes_crc32,
+            'opcodes': func.opcodes,
+        }
+
     def from_sample(self, sample):
         d = {}
-        if sample.id is not None: d['id'] = sample.id
-        if sample.hash_sha256 is not None: d['hash_sha256'] = sample.hash_sha256
-        if sample.hash_md5 is not None: d['hash_md5'] = sample.hash_md5
-        if sample.hash_sha1 is not None: d['hash_sha1'] = sample.hash_sha1
-        if sample.size is not None: d['size'] = sample.size
-        if sample.code_histogram is not None: d['code_histogram'] = sample.code_histogram
-        if sample.magic is not None: d['magic'] = sample.magic
-        if sample.peyd is not None: d['peyd'] = sample.peyd
-
-        if sample.ssdeep is not None: d['ssdeep'] = sample.ssdeep
-        if sample.imphash is not None: d['imphash'] = sample.imphash
-        if sample.entropy is not None: d['entropy'] = sample.entropy
-
-        if sample.file_size is not None: d['file_size'] = sample.file_size
-        if sample.entry_point is not None: d['entry_point'] = sample.entry_point
-        if sample.first_kb is not None: d['first_kb'] = bytes(sample.first_kb).hex()
-
-        if sample.overlay_sha256 is not None: d['overlay_sha256'] = sample.overlay_sha256
-        if sample.overlay_size is not None: d['overlay_size'] = sample.overlay_size
-        if sample.overlay_ssdeep is not None: d['overlay_ssdeep'] = sample.overlay_ssdeep
-        if sample.overlay_entropy is not None: d['overlay_entropy'] = sample.overlay_entropy
-
-        if sample.build_timestamp is not None: d['build_timestamp'] = '%s UTC' % sample.build_timestamp
-
-        if sample.debug_directories:
-            d['debug_directories'] = [
-                {
-                    'timestamp': '%s UTC' % debug_directory.timestamp,
-                    'path': debug_directory.path,
-                    'age': debug_directory.age,
-                    'signature': debug_directory.signature,
-                    'guid': debug_directory.guid
-                } for debug_directory in sample.debug_directories
-            ]
-
-        if sample.strings_count_of_length_at_least_10 is not None:
-            d['strings_count_of_length_at_least_10'] = sample.strings_count_of_length_at_least_10
-        if sample.strings_count is not None: d['strings_count'] = sample.strings_count
-        if sample.heuristic_iocs is not None: d['heuristic_iocs'] = sample.heuristic_iocs
-
-        if sample.export_name is not None: d['export_name'] = sample.export_name
-        if sample.exports:
-            d['exports'] = [
-                {'address': export.address, 'name': export.name, 'ordinal': export.ordinal}
-                for export in sample.exports
-            ]
-        if sample.imports:
-            d['imports'] = [
-                {'dll_name': export.dll_name, 'address': export.address, 'name': export.name}
-                for export in sample.imports
-            ]
-
-        if sample.sections:
-            d['sections'] = [self.from_section(section) for section in sample.sections]
-
-        if sample.resources:
-            d['resources'] = [self.from_resource(sample_resource) for sample_resource in sample.resources]
-
-        if sample.functions:
-            d['functions'] = []
-            for func in sample.functions:
-                json_func = {
-                    'offset': func.offset,
-                    'size': func.size,
-                    'real_size': func.real_size,
-                    'name': func.name,
-                    'calltype': func.calltype,
-                    'cc': func.cc,
-                    'cost': func.cost,
-                    'ebbs': func.ebbs,
-                    'edges': func.edges,
-                    'indegree': func.indegree,
-                    'nargs': func.nargs,
-                    'nbbs': func.nbbs,
-                    'nlocals': func.nlocals,
-                    'outdegree': func.outdegree,
-                    'type': func.type,
-                    'opcodes_sha256': func.opcodes_sha256,
-                    'opcodes_crc32': func.opcodes_crc32,
-                    'cleaned_opcodes_sha256': func.cleaned_opcodes_sha256,
-                    'cleaned_opcodes_crc32': func.cleaned_opcodes_crc32,
-                    'opcodes': func.opcodes,
-                }
-
-                d['functions'].append(json_func)
-        if sample.processed_at:
-            d['processed_at'] = sample.processed_at
-        if self.filter:
-            d = {k: v for k, v in d.items() if self.filter in k}
+        for key, skip_falsy, conversion, per_item in self._plan:
+            value = getattr(sample, key)
+            if value is None or (skip_falsy and not value):
+                continue
+            if per_item:
+                d[key] = [conversion(item) for item in value]
+            else:
+                d[key] = value if conversion is None else conversion(value)
         return d
+
+    def iter_json(self, sample):
+        """
+        Yields the JSON text of from_sample(sample) in chunks, equal to json.dumps() of it once joined. Lists are
+        converted and encoded `items_per_chunk` items at a time, so only the dicts of that many items exist at once
+        instead of those of the whole sample. Binary fields are always hex encoded, as JSON has no bytes, so
+        `raw_bytes` does not apply.
+
+        :type sample: Sample
+        """
+        separator = '{'
+        for key, skip_falsy, conversion, per_item in self._plan:
+            value = getattr(sample, key)
+            if value is None or (skip_falsy and not value):
+                continue
+            prefix = '%s%s: ' % (separator, encode_json_string(key))
+            separator = ', '
+            if key == 'first_kb':
+                yield prefix + encode_json_string(bytes(value).hex())
+            elif per_item:
+                items = iter(value)
+                item_separator = '['
+                while True:
+                    chunk = [conversion(item) for item in islice(items, self.items_per_chunk)]
+                    if not chunk:
+                        break
+                    # a single encoder call per chunk, the brackets of the chunk list are left out
+                    yield prefix + item_separator + json.dumps(chunk)[1:-1]
+                    prefix = ''
+                    item_separator = ', '
+                yield prefix + ('[]' if item_separator == '[' else ']')
+            else:
+                yield prefix + encode_json_value(value if conversion is None else conversion(value))
+        yield '{}' if separator == '{' else '}'
+
+    def write_sample(self, sample, fp):
+        """
+        Writes the JSON of a sample to a text file (e.g. a socket opened with makefile('w')) while it is encoded.
+        """
+        for chunk in self.iter_json(sample):
+            fp.write(chunk)
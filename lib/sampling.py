@@ -0,0 +1,237 @@
+import random
+
+STRATIFY_NONE = 'all'
+STRATIFY_MAGIC = 'magic'
+STRATIFY_BUILD_MONTH = 'build_month'
+# SQL expressions of the stratum of a row of "sample" joined with "magic"
+STRATUM_SQL = {
+    STRATIFY_NONE: "''",
+    STRATIFY_MAGIC: "COALESCE(magic.description, '')",
+    STRATIFY_BUILD_MONTH: "COALESCE(TO_CHAR(sample.build_timestamp, 'YYYY-MM'), '')",
+}
+
+
+def stratum_sql(stratify_by):
+    if stratify_by not in STRATUM_SQL:
+        raise Exception('Unknown stratification "%s"' % stratify_by)
+    return STRATUM_SQL[stratify_by]
+
+
+class TableSampleSampler(object):
+    """
+    Draws random samples with TABLESAMPLE, which reads a random subset of the table pages instead of the whole
+    table. Needs no preparation, but SYSTEM sampling picks whole pages, so samples stored together are drawn together.
+    Use BERNOULLI for row level sampling at the cost of reading all pages.
+    """
+    MIN_PAGES = 4  # sampled by SYSTEM at least, as the rows of a single page are not enough for a small count
+
+    def __init__(self, db, method='SYSTEM', oversampling=2.0, growth=4.0):
+        if method not in ('SYSTEM', 'BERNOULLI'):
+            raise Exception('Unknown TABLESAMPLE method "%s"' % method)
+        self.db = db
+        self.method = method
+        self.oversampling = oversampling
+        self.growth = growth  # factor of the percentage when a sample contained too few rows
+
+    def _percentage(self, cursor, count):
+        cursor.execute('SELECT reltuples, relpages FROM pg_class WHERE (relname = %s)', ('sample',))
+        row = cursor.fetchone()
+        # both are -1 or 0 for tables never analyzed, the whole table is sampled then
+        approximate_row_count = max(1.0, float(row[0]) if row else 1.0)
+        page_count = max(1.0, float(row[1]) if row else 1.0)
+        percentage = 100.0 * count * self.oversampling / approximate_row_count
+        if self.method == 'SYSTEM':
+            percentage = max(percentage, 100.0 * self.MIN_PAGES / page_count)
+        return min(100.0, percentage)
+
+    def sample_ids(self, count):
+        """
+        Samples again with a growing percentage while too few rows were sampled, up to the whole table.
+
+        :return: `count` random sample ids, fewer only if the table has fewer rows
+        """
+        with self.db.cursor() as cursor:
+            percentage = self._percentage(cursor, count)
+            while True:
+                cursor.execute(
+                    'SELECT id FROM sample TABLESAMPLE %s (%%s) ORDER BY RANDOM() LIMIT %%s' % self.method,
+                    (percentage, count)
+                )
+                ids = [row[0] for row in cursor.fetchall()]
+                if len(ids) >= count or percentage >= 100.0:
+                    return ids
+                percentage = min(100.0, percentage * self.growth)
+
+
+class IdArraySampler(object):
+    """
+    Draws uniform random samples from a snapshot of the sample ids of each stratum, numbered without gaps
+    (sql/0005-sample-sampling-snapshot.sql). Random positions are drawn in Python and resolved with a single index
+    lookup, so the query count does not depend on the table or sample size.
+
+    Samples missing in the snapshot, i.e. stored since the last refresh, are read on every draw and drawn with the same
+    probability, so refresh() should run periodically to keep them few. Deleted samples are skipped when drawing,
+    which can make results smaller than requested once many samples were deleted; refresh(full=True) rebuilds the
+    snapshot then.
+    """
+
+    def __init__(self, db, oversampling=1.1, rng=None, margin=1000):
+        self.db = db
+        self.oversampling = oversampling  # compensates positions of deleted samples
+        self.rng = rng or random.SystemRandom()
+        # ids below the highest id of the last refresh which are checked again, as their transactions might have
+        # committed after the refresh; later commits of lower ids are only found by a full refresh
+        self.margin = margin
+
+    def _missing_after_id(self, cursor, stratify_by):
+        """
+        :return: id above which samples might be missing in the snapshot, None without snapshot
+        """
+        cursor.execute(
+            'SELECT max_sample_id FROM sample_sampling_state WHERE (stratification = %s)', (stratify_by,)
+        )
+        row = cursor.fetchone()
+        return max(0, row[0] - self.margin) if row else None
+
+    @staticmethod
+    def _missing_sql(stratify_by):
+        # samples above an id that are not in the snapshot, with their stratum
+        return '''
+            SELECT
+                sample.id,
+                %s AS stratum
+            FROM sample
+            LEFT JOIN magic ON (magic.id = sample.magic_id)
+            WHERE (sample.id > %%(after_id)s) AND NOT EXISTS (
+                SELECT 1 FROM sample_sampling_snapshot snapshot
+                WHERE (snapshot.stratification = %%(stratification)s) AND (snapshot.sample_id = sample.id)
+            )
+        ''' % stratum_sql(stratify_by)
+
+    def refresh(self, stratify_by=STRATIFY_NONE, full=False):
+        """
+        Updates the snapshot of a stratification, without committing.
+
+        :return: number of appended sample ids
+        """
+        with self.db.cursor() as cursor:
+            if full:
+                for table in ('sample_sampling_snapshot', 'sample_sampling_stratum', 'sample_sampling_state'):
+                    cursor.execute('DELETE FROM %s WHERE (stratification = %%s)' % table, (stratify_by,))
+
+            after_id = self._missing_after_id(cursor, stratify_by) or 0
+            cursor.execute('SELECT MAX(id) FROM sample')
+            max_id = cursor.fetchone()[0]
+            if max_id is None:
+                return 0
+
+            # missing ids get the positions following the current end of their stratum
+            cursor.execute('''
+                WITH missing AS (%s), new_sample AS (
+                    SELECT
+                        id,
+                        stratum,
+                        ROW_NUMBER() OVER (PARTITION BY stratum ORDER BY id) AS rank
+                    FROM missing
+                ), inserted AS (
+                    INSERT INTO sample_sampling_snapshot (stratification, stratum, position, sample_id)
+                    SELECT
+                        %%(stratification)s,
+                        new_sample.stratum,
+                        COALESCE(s.size, 0) + new_sample.rank - 1,
+                        new_sample.id
+                    FROM new_sample
+                    LEFT JOIN sample_sampling_stratum s
+                        ON (s.stratification = %%(stratification)s) AND (s.stratum = new_sample.stratum)
+                    RETURNING stratum
+                )
+                INSERT INTO sample_sampling_stratum (stratification, stratum, size)
+                SELECT %%(stratification)s, stratum, COUNT(*) FROM inserted GROUP BY stratum
+                ON CONFLICT (stratification, stratum) DO UPDATE SET size = sample_sampling_stratum.size + EXCLUDED.size
+                RETURNING (SELECT COUNT(*) FROM inserted)
+            ''' % self._missing_sql(stratify_by), {'stratification': stratify_by, 'after_id': after_id})
+            row = cursor.fetchone()
+            appended = row[0] if row else 0
+
+            cursor.execute('''
+                INSERT INTO sample_sampling_state (stratification, max_sample_id) VALUES (%s, %s)
+                ON CONFLICT (stratification) DO UPDATE SET
+                    max_sample_id = GREATEST(sample_sampling_state.max_sample_id, EXCLUDED.max_sample_id),
+                    refreshed_at = now()
+            ''', (stratify_by, max_id))
+        return appended
+
+    def _positions(self, size, count):
+        count = min(size, int(count * self.oversampling) + 1)
+        return self.rng.sample(range(size), count)
+
+    def _draw(self, cursor, stratify_by, count, after_id):
+        """
+        Draws from the snapshot and the samples missing in it as if they were appended to the snapshot.
+
+        :return: dict stratum => list of up to `count` sample ids
+        """
+        cursor.execute('SELECT stratum, size FROM sample_sampling_stratum WHERE (stratification = %s)', (stratify_by,))
+        sizes = dict(cursor.fetchall())
+        cursor.execute(
+            'SELECT stratum, id FROM (%s) missing ORDER BY id' % self._missing_sql(stratify_by),
+            {'stratification': stratify_by, 'after_id': after_id}
+        )
+        missing = {}
+        for stratum, sample_id in cursor.fetchall():
+            missing.setdefault(stratum, []).append(sample_id)
+
+        strata = []
+        positions = []
+        drawn = {}
+        for stratum in set(sizes) | set(missing):
+            size = sizes.get(stratum, 0)
+            missing_ids = missing.get(stratum, [])
+            drawn[stratum] = []
+            for position in self._positions(size + len(missing_ids), count):
+                if position < size:
+                    strata.append(stratum)
+                    positions.append(position)
+                else:
+                    drawn[stratum].append(missing_ids[position - size])
+
+        if positions:
+            cursor.execute('''
+                SELECT snapshot.stratum, snapshot.sample_id
+                FROM UNNEST(%s::text[], %s::integer[]) AS drawn (stratum, position)
+                JOIN sample_sampling_snapshot snapshot ON (snapshot.stratification = %s)
+                    AND (snapshot.stratum = drawn.stratum) AND (snapshot.position = drawn.position)
+                JOIN sample ON (sample.id = snapshot.sample_id)
+            ''', (strata, positions, stratify_by))
+            for stratum, sample_id in cursor.fetchall():
+                drawn[stratum].append(sample_id)
+
+        # rows come back in index order, so shuffle before dropping the oversampled ones
+        for stratum, sample_ids in drawn.items():
+            self.rng.shuffle(sample_ids)
+            del sample_ids[count:]
+        return {stratum: sample_ids for stratum, sample_ids in drawn.items() if sample_ids}
+
+    def sample_ids(self, count):
+        """
+        Falls back to TableSampleSampler until the snapshot was created by a first refresh.
+
+        :return: `count` uniformly drawn sample ids (fewer if there are fewer samples)
+        """
+        with self.db.cursor() as cursor:
+            after_id = self._missing_after_id(cursor, STRATIFY_NONE)
+            if after_id is None:
+                return TableSampleSampler(self.db).sample_ids(count)
+            return self._draw(cursor, STRATIFY_NONE, count, after_id).get('', [])
+
+    def sample_stratified_ids(self, count_per_stratum, stratify_by):
+        """
+        :return: dict stratum => list of up to `count_per_stratum` uniformly drawn sample ids
+        """
+        with self.db.cursor() as cursor:
+            after_id = self._missing_after_id(cursor, stratify_by)
+            if after_id is None:
+                raise Exception(
+                    'No sampling snapshot for "%s", run tools/refresh-sampling-snapshot.py first' % stratify_by
+                )
+            return self._draw(cursor, stratify_by, count_per_stratum, after_id)
@@ -1,28 +1,33 @@
-import random
 from .flask import InvalidUsage
 from .sample import FrozenClass
 
 
 class TaskRequest(FrozenClass):
-    def __init__(self, task_consumer_id, task_consumer_name, plugins):
+    __slots__ = ('task_consumer_id', 'task_consumer_name', 'plugins', 'count', 'wait')
+
+    def __init__(self, task_consumer_id, task_consumer_name, plugins, count=None, wait=None):
         self.task_consumer_id = task_consumer_id  # type: int
         self.task_consumer_name = task_consumer_name  # type: str
         self.plugins = tuple(plugins) if isinstance(plugins, list) else plugins  # type: tuple(str)
-        self._freeze()
+        self.count = count  # type: None|int
+        self.wait = wait  # type: None|float
 
 
 class TaskResponse(FrozenClass):
+    __slots__ = ('id', 'type', 'payload')
+
     def __init__(self, id, type, payload):
         self.id = id  # type: int
         self.type = type  # type: str
         self.payload = payload  # type: dict
-        self._freeze()
 
     def to_json(self):
         return {'id': self.id, 'type': self.type, 'payload': self.payload}
 
 
 class Task(FrozenClass):
+    __slots__ = ('id', 'type', 'payload', 'created_at', 'assigned_at', 'consumer_name')
+
     def __init__(self, task_id, task_type, payload, created_at, assigned_at, consumer_name):
         self.id = task_id  # type: int
         self.type = task_type  # type: str
@@ -31,31 +36,87 @@ class Task(FrozenClass):
         self.assigned_at = assigned_at  # type: datetime
         self.consumer_name = consumer_name  # type: str
 
-        self._freeze()
+
+CLAIM_ORDER_RANDOM = 'random'
+CLAIM_ORDER_FIFO = 'fifo'
+CLAIM_ORDERS = (CLAIM_ORDER_RANDOM, CLAIM_ORDER_FIFO)
 
 
 class TaskFactory(object):
-    def __init__(self, connection=None):
+    # both statements are served by the partial index task_unassigned_type_id on task (type, id). The tasks are locked
+    # in a CTE, which runs exactly once; a subquery in the WHERE clause of the UPDATE might be re-run and claim more.
+    CLAIM_SQL = '''
+        WITH claimed AS (
+            SELECT id FROM task
+            WHERE (assigned_at IS NULL) AND (type = %%s) AND (id >= %s)
+            ORDER BY id
+            LIMIT %%s
+            FOR UPDATE SKIP LOCKED
+        )
+        UPDATE task t SET assigned_at = now(), consumer_id = %%s
+        FROM claimed c
+        WHERE t.id = c.id
+        RETURNING t.id, t."type", t.payload
+    '''
+    CONSUMER_ID_SQL = 'SELECT id FROM task_consumer WHERE (name = %s)'
+    RANDOM_PIVOT_SQL = '''(
+        SELECT MIN(id) + FLOOR(RANDOM() * (MAX(id) - MIN(id) + 1))
+        FROM task
+        WHERE (assigned_at IS NULL) AND (type = %s)
+    )'''
+
+    def __init__(self, connection=None, claim_order=CLAIM_ORDER_RANDOM):
+        if claim_order not in CLAIM_ORDERS:
+            raise Exception('Unknown task claim order "%s"' % claim_order)
         self.connection = connection
+        self.claim_order = claim_order
 
     @staticmethod
     def get_types_sorted_by_priority():
         return ['PEMetadata', 'R2Disassembly']
 
-    def request_from_json(self, d):
+    @classmethod
+    def parse_request(cls, d, max_count=None, max_wait=None):
+        """
+        Validates a task request.
+
+        :return: tuple of consumer name, plugins, count and wait in seconds (both None if not requested)
+        """
         if 'name' not in d:
             raise InvalidUsage('Key "name" missing in request.')
         if 'plugins' not in d:
             raise InvalidUsage('Key "plugins" missing in request.')
+        if set(d['plugins']) - set(cls.get_types_sorted_by_priority()):
+            raise InvalidUsage('Invalid plugin array')
+
+        count = None
+        if 'count' in d:
+            if not isinstance(d['count'], int) or isinstance(d['count'], bool) or d['count'] < 1:
+                raise InvalidUsage('Key "count" needs to be a positive integer.')
+            if max_count is not None and d['count'] > max_count:
+                raise InvalidUsage('Key "count" may not exceed %i.' % max_count)
+            count = d['count']
+
+        wait = None
+        if 'wait' in d:
+            if not isinstance(d['wait'], (int, float)) or isinstance(d['wait'], bool) or d['wait'] < 0:
+                raise InvalidUsage('Key "wait" needs to be a non-negative number of seconds.')
+            if max_wait is not None and d['wait'] > max_wait:
+                raise InvalidUsage('Key "wait" may not exceed %s seconds.' % max_wait)
+            wait = float(d['wait'])
+        return d['name'], d['plugins'], count, wait
+
+    def request_from_json(self, d, max_count=None, max_wait=None):
+        name, plugins, count, wait = self.parse_request(d, max_count, max_wait)
 
         task_consumer_id = 0
         with self.connection.cursor() as cursor:
-            cursor.execute('SELECT id FROM task_consumer WHERE (name = %s)', (d['name'],))
+            cursor.execute(self.CONSUMER_ID_SQL, (name,))
             row = cursor.fetchone()
             if not row:
-                raise InvalidUsage('Consumer with name "%s" does not exist' % d['name'])
+                raise InvalidUsage('Consumer with name "%s" does not exist' % name)
             task_consumer_id = int(row[0])
-        return TaskRequest(task_consumer_id, d['name'], d['plugins'])
+        return TaskRequest(task_consumer_id, name, plugins, count, wait)
 
     @staticmethod
     def response_from_json(d):
@@ -66,36 +127,54 @@ class TaskFactory(object):
 
         return TaskResponse(d['id'], d['type'], d['payload'])
 
-    def random_unassigned(self, plugin, consumer_id):
+    def claim_statements(self, plugin):
         """
+        :return: list of (sql, params) to run in order until enough tasks are claimed, the number of tasks still
+        missing and the consumer id are appended to the params
+        """
+        statements = []
+        if self.claim_order == CLAIM_ORDER_RANDOM:
+            statements.append((self.CLAIM_SQL % self.RANDOM_PIVOT_SQL, (plugin, plugin)))
+        # FIFO order, also the fallback if not enough tasks above the random pivot are free
+        statements.append((self.CLAIM_SQL % '0', (plugin,)))
+        return statements
+
+    def claim_unassigned(self, plugin, consumer_id, count=1):
+        """
+        Atomically assigns up to `count` unassigned tasks of the given type to the consumer. Rows locked by concurrent
+        claims are skipped instead of waited for, so two consumers never receive the same task.
+
         :type consumer_id: int
         :type plugin: str
-        :return: TaskResponse
+        :type count: int
+        :return: list[TaskResponse]
         """
+        tasks = []
         with self.connection.cursor() as cursor:
-            cursor.execute(
-                'SELECT COUNT(id) FROM task WHERE (assigned_at IS NULL) AND (type = %s)',
-                (plugin,)
-            )
-            count = cursor.fetchone()[0]
-            if not count:
-                return None
-            offset = random.randint(0, count - 1)
-            cursor.execute(
-                'SELECT id, "type", payload FROM task WHERE (assigned_at IS NULL) AND (type = %s) LIMIT 1 OFFSET %s',
-                (plugin, offset)
-            )
-            task_row = cursor.fetchone()
-
-            if not task_row:
-                return None
-            task = TaskResponse(task_row[0], task_row[1], task_row[2])
-            cursor.execute(
-                'UPDATE task SET assigned_at = now(), consumer_id = %s WHERE (id = %s)',
-                (consumer_id, task.id)
-            )
+            for sql, params in self.claim_statements(plugin):
+                if len(tasks) >= count:
+                    break
+                cursor.execute(sql, params + (count - len(tasks), consumer_id))
+                tasks += [TaskResponse(row[0], row[1], row[2]) for row in cursor.fetchall()]
+        return tasks
+
+    def claim_for_request(self, task_request):
+        """
+        Claims tasks for the plugins of the request in order of their priority. Without "count" in the request, at
+        most one task is claimed.
 
-            return task
+        :type task_request: TaskRequest
+        :return: list[TaskResponse]
+        """
+        count = 1 if task_request.count is None else task_request.count
+        tasks = []
+        for task_type in self.get_types_sorted_by_priority():
+            if task_type not in task_request.plugins:
+                continue
+            tasks += self.claim_unassigned(task_type, task_request.task_consumer_id, count - len(tasks))
+            if len(tasks) >= count:
+                break
+        return tasks
 
     @staticmethod
     def by_row(row):
@@ -124,3 +203,40 @@ class TaskFactory(object):
 
             cursor.execute('UPDATE task SET completed_at = now() WHERE (id = %s)', (task.id,))
             return task
+
+
+class AsyncTaskFactory(TaskFactory):
+    """
+    TaskFactory for asyncio connections of psycopg 3, which use the same SQL and parameter style as psycopg2.
+    """
+
+    async def request_from_json(self, d, max_count=None, max_wait=None):
+        name, plugins, count, wait = self.parse_request(d, max_count, max_wait)
+
+        async with self.connection.cursor() as cursor:
+            await cursor.execute(self.CONSUMER_ID_SQL, (name,))
+            row = await cursor.fetchone()
+            if not row:
+                raise InvalidUsage('Consumer with name "%s" does not exist' % name)
+        return TaskRequest(int(row[0]), name, plugins, count, wait)
+
+    async def claim_unassigned(self, plugin, consumer_id, count=1):
+        tasks = []
+        async with self.connection.cursor() as cursor:
+            for sql, params in self.claim_statements(plugin):
+                if len(tasks) >= count:
+                    break
+                await cursor.execute(sql, params + (count - len(tasks), consumer_id))
+                tasks += [TaskResponse(row[0], row[1], row[2]) for row in await cursor.fetchall()]
+        return tasks
+
+    async def claim_for_request(self, task_request):
+        count = 1 if task_request.count is None else task_request.count
+        tasks = []
+        for task_type in self.get_types_sorted_by_priority():
+            if task_type not in task_request.plugins:
+                continue
+            tasks += await self.claim_unassigned(task_type, task_request.task_consumer_id, count - len(tasks))
+            if len(tasks) >= count:
+                break
+        return tasks
@@ -0,0 +1,41 @@
+from datetime import datetime
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+MSGPACK_MIMETYPES = (MSGPACK_MIMETYPE, 'application/x-msgpack')
+
+
+def _encode_default(o):
+    if isinstance(o, datetime):
+        return o.isoformat()
+    if isinstance(o, (bytearray, memoryview)):
+        return bytes(o)
+    raise TypeError('cannot serialize %r to MessagePack' % (o,))
+
+
+def encode_msgpack(data):
+    """
+    Encodes JSON-like data as MessagePack, bytes are kept as raw bin values.
+    """
+    if msgpack is None:
+        raise Exception('MessagePack support requires the msgpack package')
+    return msgpack.packb(data, use_bin_type=True, default=_encode_default)
+
+
+def decode_msgpack(data):
+    if msgpack is None:
+        raise Exception('MessagePack support requires the msgpack package')
+    return msgpack.unpackb(data, raw=False)
+
+
+def iter_msgpack(stream):
+    """
+    Decodes a stream of concatenated MessagePack values one by one.
+    """
+    if msgpack is None:
+        raise Exception('MessagePack support requires the msgpack package')
+    return msgpack.Unpacker(stream, raw=False)
@@ -1,13 +1,19 @@
-from flask import Flask, jsonify, request, g
-from lib.sample import SampleFactory
+from flask import Flask, Response, jsonify, request, g, stream_with_context
 from lib.task import TaskFactory
 from lib.flask import InvalidUsage
 from lib.general import KurasutaDatabase
-from lib.flask import validate_sha256
+from lib.cache import create_sample_cache
+from lib.pool import ConnectionPool, PoolTimeout
+from lib.notify import TaskNotifier
+from lib.json_stream import ijson, parse_object_stream
+from lib.compression import DecompressionMiddleware, compress, supported_encodings
+from lib.wire import msgpack, MSGPACK_MIMETYPE, MSGPACK_MIMETYPES, encode_msgpack, decode_msgpack, iter_msgpack
 import os
+import json
 import logging
+import time
+import threading
 import psycopg2
-from psycopg2.extras import Json
 
 logging.basicConfig(format='%(asctime)s %(message)s')
 logger = logging.getLogger('KurasutaBackendApi')
@@ -20,51 +26,136 @@ app.config.from_object(__name__)  # load config from this file , flaskr.py
 # Load default config and override config from an environment variable
 app.config.update(dict(
     DATABASE=os.environ['POSTGRES_DATABASE_LINK'],
-    SECRET_KEY=os.environ['FLASK_SECRET_KEY']
+    SECRET_KEY=os.environ['FLASK_SECRET_KEY'],
+    TASK_CLAIM_ORDER=os.environ.get('KURASUTA_TASK_CLAIM_ORDER', 'random'),
+    TASK_MAX_COUNT=int(os.environ.get('KURASUTA_TASK_MAX_COUNT', 100)),
+    TASK_MAX_WAIT=float(os.environ.get('KURASUTA_TASK_MAX_WAIT', 60)),
+    DATABASE_POOL_MIN_SIZE=int(os.environ.get('KURASUTA_DATABASE_POOL_MIN_SIZE', 1)),
+    DATABASE_POOL_MAX_SIZE=int(os.environ.get('KURASUTA_DATABASE_POOL_MAX_SIZE', 10)),
+    DATABASE_POOL_TIMEOUT=float(os.environ.get('KURASUTA_DATABASE_POOL_TIMEOUT', 30)),
+    DATABASE_POOL_MAX_AGE=float(os.environ.get('KURASUTA_DATABASE_POOL_MAX_AGE', 3600)),
+    DATABASE_POOL_CHECK_AFTER=float(os.environ.get('KURASUTA_DATABASE_POOL_CHECK_AFTER', 30)),
+    LOOKUP_CACHE_SIZE=int(os.environ.get('KURASUTA_LOOKUP_CACHE_SIZE', 100000)),
+    SAMPLE_CACHE=os.environ.get('KURASUTA_SAMPLE_CACHE', ''),
+    SAMPLE_CACHE_SIZE=int(os.environ.get('KURASUTA_SAMPLE_CACHE_SIZE', 10000)),
+    SAMPLE_CACHE_TTL=float(os.environ.get('KURASUTA_SAMPLE_CACHE_TTL', 3600)),
+    INSERT_PAGE_SIZE=int(os.environ.get('KURASUTA_INSERT_PAGE_SIZE', 1000)),
+    PERSIST_MODE=os.environ.get('KURASUTA_PERSIST_MODE', 'replace'),
+    PERSIST_BATCH_SIZE=int(os.environ.get('KURASUTA_PERSIST_BATCH_SIZE', 100)),
+    STREAMED_JSON_KEYS=os.environ.get('KURASUTA_STREAMED_JSON_KEYS', 'functions,imports,exports').split(','),
+    STREAMED_JSON_SPOOL_SIZE=int(os.environ.get('KURASUTA_STREAMED_JSON_SPOOL_SIZE', 16 * 1024 * 1024)),
+    MAX_DECOMPRESSED_SIZE=int(os.environ.get('KURASUTA_MAX_DECOMPRESSED_SIZE', 1024 * 1024 * 1024)),
+    COMPRESS_MIN_SIZE=int(os.environ.get('KURASUTA_COMPRESS_MIN_SIZE', 1024))
 ))
 app.config.from_envvar('FLASKR_SETTINGS', silent=True)
+app.wsgi_app = DecompressionMiddleware(app.wsgi_app, app.config['MAX_DECOMPRESSED_SIZE'])
+KurasutaDatabase.lookup_cache.max_size = app.config['LOOKUP_CACHE_SIZE']
+KurasutaDatabase.sample_cache = create_sample_cache(
+    app.config['SAMPLE_CACHE'], app.config['SAMPLE_CACHE_SIZE'], app.config['SAMPLE_CACHE_TTL']
+)
+
+
+db_pool = None
+db_pool_lock = threading.Lock()
+
+
+def get_db_pool():
+    global db_pool
+    with db_pool_lock:
+        # connections must not be shared with forked worker processes
+        if db_pool is None or db_pool.pid != os.getpid():
+            db_pool = ConnectionPool(
+                app.config['DATABASE'],
+                min_size=app.config['DATABASE_POOL_MIN_SIZE'],
+                max_size=app.config['DATABASE_POOL_MAX_SIZE'],
+                timeout=app.config['DATABASE_POOL_TIMEOUT'],
+                max_age=app.config['DATABASE_POOL_MAX_AGE'],
+                check_after=app.config['DATABASE_POOL_CHECK_AFTER']
+            )
+        return db_pool
+
 
+task_notifier = None
 
-def connect_db():
-    db = psycopg2.connect(app.config['DATABASE'])
-    return db
+
+def get_task_notifier():
+    global task_notifier
+    with db_pool_lock:
+        if task_notifier is None or task_notifier.pid != os.getpid():
+            task_notifier = TaskNotifier(app.config['DATABASE'])
+        return task_notifier
 
 
 def get_db():
     if not hasattr(g, 'db'):
-        g.db = connect_db()
+        g.db = get_db_pool().getconn()
     return g.db
 
 
+def release_db():
+    if hasattr(g, 'db'):
+        get_db_pool().putconn(g.pop('db'))
+
+
 @app.teardown_appcontext
 def close_db(error):
-    if hasattr(g, 'db'):
-        g.db.close()
+    release_db()
 
 
 @app.route('/task', methods=['POST'])
 def get_task():
-    json_data = request.get_json()
+    json_data = get_request_data()
     if json_data is None:
         raise InvalidUsage('JSON data could not be decoded (None)', status_code=400)
 
-    connection = get_db()
-    task_factory = TaskFactory(connection)
-    task_request = task_factory.request_from_json(json_data)
-    sorted_types = task_factory.get_types_sorted_by_priority()
-    if set(task_request.plugins) - set(sorted_types):
-        raise InvalidUsage('Invalid plugin array')
-
-    for task_type in sorted_types:
-        if task_type not in task_request.plugins:
-            continue
-        task = task_factory.random_unassigned(task_type, task_request.task_consumer_id)
-        if not task:
-            continue
-
-        connection.commit()
-        return jsonify(task.to_json() if task else {})
-    return jsonify({})
+    task_factory = TaskFactory(get_db(), app.config['TASK_CLAIM_ORDER'])
+    task_request = task_factory.request_from_json(json_data, app.config['TASK_MAX_COUNT'], app.config['TASK_MAX_WAIT'])
+    if task_request.wait:
+        tasks = wait_for_tasks(task_request)
+    else:
+        tasks = task_factory.claim_for_request(task_request)
+        get_db().commit()
+
+    if task_request.count is None:
+        return make_data_response(tasks[0].to_json() if tasks else {})
+    return make_data_response([task.to_json() for task in tasks])
+
+
+def wait_for_tasks(task_request):
+    """
+    Claims tasks for the request, waiting up to `task_request.wait` seconds for a NOTIFY about new tasks of the
+    requested types if there are none. The database connection is handed back to the pool while waiting.
+    """
+    deadline = time.monotonic() + task_request.wait
+    with get_task_notifier().subscribe(task_request.plugins) as subscription:
+        while True:
+            subscription.clear()
+            connection = get_db()
+            tasks = TaskFactory(connection, app.config['TASK_CLAIM_ORDER']).claim_for_request(task_request)
+            connection.commit()
+            remaining = deadline - time.monotonic()
+            if tasks or remaining <= 0:
+                return tasks
+
+            release_db()
+            if not subscription.wait(remaining):
+                return []
+
+
+@app.after_request
+def compress_response(response):
+    if response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in ('application/json', MSGPACK_MIMETYPE):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(supported_encodings())
+    if not encoding or (response.content_length or 0) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    response.set_data(compress(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
 
 
 @app.errorhandler(InvalidUsage)
@@ -74,262 +165,136 @@ def handle_invalid_usage(error):
     return response
 
 
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(error):
+    logger.warning('%s (%s)' % (error, get_db_pool().stats()))
+    response = jsonify({'message': 'Database busy, try again later'})
+    response.status_code = 503
+    return response
+
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    return jsonify({
+        'database_pool': get_db_pool().stats(),
+        'lookup_cache': KurasutaDatabase.lookup_cache.stats(),
+        'sample_cache': KurasutaDatabase.sample_cache.stats() if KurasutaDatabase.sample_cache else None,
+        'task_notifier': get_task_notifier().stats(),
+    })
+
+
 @app.route('/sha256/<sha256>', methods=['POST'])
 def persist(sha256):
-    validate_sha256(sha256)
-
-    json_data = request.get_json()
+    json_data = get_sample_data()
     if json_data is None:
         raise InvalidUsage('JSON data could not be decoded (None)', status_code=400)
 
-    connection = get_db()
-    kurasuta_database = KurasutaDatabase(connection)
-    task = TaskFactory(connection).mark_as_completed(int(json_data['task_id'])) if 'task_id' in json_data else None
-    # TODO check if task.consumer_name matches client
-
-    sample = SampleFactory().from_json(json_data)
-    if sha256 != sample.hash_sha256:
-        raise InvalidUsage('SHA256 in URL and body mismatch', status_code=400)
-
-    with connection.cursor() as cursor:
-        cursor.execute('''SELECT id FROM sample WHERE (hash_sha256 = %s)''', (sample.hash_sha256,))
-        row = cursor.fetchone()
-        if row:
-            sample_id = row[0]
-            if not task:
-                return jsonify({'status': 'EXISTS'})
-            if task.type == 'PEMetadata':  # in case of new PE metadata, delete existing database entry
-                kurasuta_database.delete_sample(sample.hash_sha256)
-        else:
-            sample_id = None
-        if task.type == 'PEMetadata':
-            store_metadata(cursor, kurasuta_database, sample)
-        elif task.type == 'R2Disassembly':
-            if sample_id is None:
-                raise InvalidUsage('sample does not exist in database, no R2Disassembly can be stored')
-            store_assembly(cursor, sample, sample_id)
-
-    connection.commit()
-
-    return jsonify({'status': 'ok'})
-
-
-def store_assembly(cursor, sample, sample_id):
-    cursor.execute('DELETE FROM sample_function WHERE (sample_id = %s)', (sample_id,))
-    for f in sample.functions:
-        cursor.execute('''
-            INSERT INTO sample_function
-                (sample_id, "offset", "size", "real_size", name, calltype, cc, cost, ebbs, edges, indegree, nargs,
-                nbbs, nlocals, outdegree, "type", opcodes_sha256, opcodes_crc32, cleaned_opcodes_sha256,
-                cleaned_opcodes_crc32, opcodes)
-            VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ''', (
-            sample_id, f.offset, f.size, f.real_size, f.name, f.calltype, f.cc, f.cost, f.ebbs, f.edges, f.indegree,
-            f.nargs, f.nbbs, f.nlocals, f.outdegree, f.type, f.opcodes_sha256, f.opcodes_crc32,
-            f.cleaned_opcodes_sha256, f.cleaned_opcodes_crc32, Json(f.opcodes)
-        ))
-
-
-def store_metadata(cursor, kurasuta_database, sample):
-    magic_id = kurasuta_database.ensure_row('magic', 'description', sample.magic) if sample.magic else None
-    export_name_id = kurasuta_database.ensure_row('export_name', 'content', sample.export_name) \
-        if sample.export_name else None
-
-    if sample.code_histogram:
-        cursor.execute('INSERT INTO byte_histogram (%s) VALUES(%s) RETURNING id' % (
-            ', '.join(['byte_%02x' % i for i in range(256)]),
-            ', '.join(['%s'] * 256)
-        ), [sample.code_histogram['%s' % i] for i in range(256)])
-        code_histogram_id = cursor.fetchone()[0]
-    else:
-        code_histogram_id = None
-
-    cursor.execute(
-        '''
-        INSERT INTO sample (
-            hash_sha256,
-            hash_md5,
-            hash_sha1,
-            size,
-            code_histogram_id,
-            magic_id,
-            ssdeep,
-            imphash,
-            entropy,
-            file_size,
-            entry_point,
-            first_kb,
-            overlay_sha256,
-            overlay_size,
-            overlay_ssdeep,
-            overlay_entropy,
-            build_timestamp,
-            strings_count_of_length_at_least_10,
-            strings_count,
-            export_name_id
-        ) 
-        VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) 
-        RETURNING id
-        ''', (
-            sample.hash_sha256,
-            sample.hash_md5,
-            sample.hash_sha1,
-            sample.size,
-            code_histogram_id,
-            magic_id,
-            sample.ssdeep,
-            sample.imphash,
-            sample.entropy,
-            sample.file_size,
-            sample.entry_point,
-            bytearray(sample.first_kb),
-            sample.overlay_sha256,
-            sample.overlay_size,
-            sample.overlay_ssdeep,
-            sample.overlay_entropy,
-            sample.build_timestamp,
-            sample.strings_count_of_length_at_least_10,
-            sample.strings_count,
-            export_name_id
-        )
-    )
-    sample_id = cursor.fetchone()[0]
-
-    if sample.peyd:
-        for peyd_description in sample.peyd:
-            peyd_id = kurasuta_database.ensure_row('peyd', 'description', peyd_description)
-            cursor.execute('INSERT INTO sample_has_peyd (sample_id, peyd_id) VALUES(%s, %s)', (sample_id, peyd_id))
-
-    if sample.debug_directories:
-        for debug_directory in sample.debug_directories:
-            path_id = kurasuta_database.ensure_row('path', 'content', debug_directory.path)
-            cursor.execute('''
-                INSERT INTO debug_directory
-                    (sample_id, timestamp, path_id, age, signature, guid)
-                    VALUES(%s, %s, %s, %s, %s, %s)
-            ''', (
-                sample_id,
-                debug_directory.timestamp,
-                path_id,
-                debug_directory.age,
-                debug_directory.signature,
-                debug_directory.guid
-            ))
-
-    if sample.exports:
-        for export in sample.exports:
-            name_id = kurasuta_database.ensure_row('export_symbol_name', 'content', export.name)
-            cursor.execute('''
-                INSERT INTO export_symbol (sample_id, address, ordinal, name_id) VALUES(%s, %s, %s, %s)
-            ''', (sample_id, export.address, export.ordinal, name_id))
-
-    if sample.imports:
-        for imp in sample.imports:
-            import_name_id = kurasuta_database.ensure_row('import_name', 'content', imp.name)
-            dll_name_id = kurasuta_database.ensure_row('dll_name', 'content', imp.dll_name)
-            cursor.execute('''
-                INSERT INTO import 
-                (sample_id, dll_name_id, address, name_id) 
-                VALUES(%s, %s, %s, %s) 
-                RETURNING id
-            ''', (sample_id, dll_name_id, imp.address, import_name_id))
-
-    if sample.heuristic_iocs:
-        for ioc in sample.heuristic_iocs:
-            ioc_id = kurasuta_database.ensure_row('ioc', 'content', ioc)
-            cursor.execute(
-                'INSERT INTO sample_has_heuristic_ioc (sample_id, ioc_id) VALUES(%s, %s)',
-                (sample_id, ioc_id)
-            )
-
-    if sample.sections:
-        for i, section in enumerate(sample.sections):
-            section_name_id = kurasuta_database.ensure_row('section_name', 'content', section.name)
-            cursor.execute('''
-                INSERT INTO section (
-                    sample_id, 
-                    hash_sha256, 
-                    name_id, 
-                    virtual_address, 
-                    virtual_size, 
-                    raw_size, 
-                    entropy, 
-                    ssdeep, 
-                    sort_order
-                ) VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                sample_id,
-                section.hash_sha256,
-                section_name_id,
-                section.virtual_address,
-                section.virtual_size,
-                section.raw_size,
-                section.entropy,
-                section.ssdeep,
-                i
-            ))
-    if sample.resources:
-        for i, resource in enumerate(sample.resources):
-            type_pair_id = kurasuta_database.ensure_resource_pair('type', resource.type_id, resource.type_str) \
-                if resource.type_id and resource.type_str \
-                else None
-
-            name_pair_id = kurasuta_database.ensure_resource_pair('name', resource.type_id, resource.type_str) \
-                if resource.type_id and resource.type_str \
-                else None
-
-            language_pair_id = kurasuta_database.ensure_resource_pair(
-                'language', resource.type_id, resource.type_str
-            ) if resource.type_id and resource.type_str else None
-
-            cursor.execute('''
-                INSERT INTO resource (
-                    sample_id, 
-                    hash_sha256,
-                    "offset",
-                    "size",
-                    actual_size,
-                    entropy,
-                    ssdeep,
-                    type_pair_id,
-                    name_pair_id,
-                    language_pair_id,
-                    sort_order
-                ) VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)                     
-            ''', (
-                sample_id,
-                resource.hash_sha256,
-                resource.offset,
-                resource.size,
-                resource.actual_size,
-                resource.entropy,
-                resource.ssdeep,
-                type_pair_id,
-                name_pair_id,
-                language_pair_id,
-                i
-            ))
-
-    if sample.source_id:
-        cursor.execute(
-            'INSERT INTO sample_has_source (sample_id, source_id) VALUES(%s, %s)',
-            (sample_id, sample.source_id)
+    kurasuta_database = KurasutaDatabase(get_db(), app.config['INSERT_PAGE_SIZE'], app.config['PERSIST_MODE'])
+    status = kurasuta_database.persist_sample(sha256, json_data)
+    kurasuta_database.commit()
+
+    return make_data_response({'status': status})
+
+
+@app.route('/samples', methods=['POST'])
+def persist_many():
+    """
+    Persists newline-delimited sample JSON or concatenated MessagePack samples (each optionally with "task_id"),
+    committing every PERSIST_BATCH_SIZE records. Answers with one status line per record, written once its batch has
+    been committed. "line" in the status is the record number.
+    """
+    kurasuta_database = KurasutaDatabase(get_db(), app.config['INSERT_PAGE_SIZE'], app.config['PERSIST_MODE'])
+    batch_size = app.config['PERSIST_BATCH_SIZE']
+
+    def commit(statuses):
+        try:
+            kurasuta_database.commit()
+        except psycopg2.Error as e:
+            logger.exception('Committing batch failed')
+            kurasuta_database.rollback()
+            for status in statuses:
+                if status['status'] != 'ERROR':
+                    status['status'] = 'ERROR'
+                    status['message'] = 'Commit failed: %s' % e
+        return ''.join('%s\n' % json.dumps(status) for status in statuses)
+
+    def records():
+        if request.mimetype in MSGPACK_MIMETYPES:
+            for record_number, record in enumerate(iter_msgpack(request.stream), 1):
+                yield record_number, record
+            return
+        for line_number, line in enumerate(request.stream, 1):
+            line = line.strip()
+            if line:
+                yield line_number, line
+
+    def generate():
+        statuses = []
+        for line_number, record in records():
+            status = {'line': line_number}
+            try:
+                json_data = json.loads(record.decode('utf-8')) if isinstance(record, bytes) else record
+                if not isinstance(json_data, dict):
+                    raise InvalidUsage('Record is not a JSON object')
+                status['hash_sha256'] = json_data.get('hash_sha256')
+                with kurasuta_database.savepoint():
+                    status['status'] = kurasuta_database.persist_sample(json_data.get('hash_sha256'), json_data)
+            except InvalidUsage as e:
+                status['status'] = 'ERROR'
+                status['message'] = e.message
+            except Exception as e:
+                logger.exception('Persisting record in line %i failed' % line_number)
+                status['status'] = 'ERROR'
+                status['message'] = '%s' % e
+            statuses.append(status)
+
+            if len(statuses) >= batch_size:
+                yield commit(statuses)
+                statuses = []
+        if statuses:
+            yield commit(statuses)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def get_request_data():
+    """
+    Decodes a JSON or MessagePack request body, depending on its Content-Type.
+    """
+    if request.mimetype in MSGPACK_MIMETYPES:
+        try:
+            return decode_msgpack(request.get_data())
+        except ValueError as e:
+            raise InvalidUsage('MessagePack data could not be decoded (%s)' % e, status_code=400)
+    return request.get_json()
+
+
+def make_data_response(data):
+    """
+    Encodes a response as MessagePack if the client prefers it over JSON, as JSON otherwise.
+    """
+    if msgpack and request.accept_mimetypes.best_match(['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE:
+        return Response(encode_msgpack(data), mimetype=MSGPACK_MIMETYPE)
+    return jsonify(data)
+
+
+def get_sample_data():
+    """
+    Decodes the sample in the request body. If ijson is available, JSON bodies are parsed incrementally and the large
+    arrays listed in STREAMED_JSON_KEYS are spooled item by item instead of being held in memory.
+    """
+    if request.mimetype in MSGPACK_MIMETYPES or ijson is None:
+        return get_request_data()
+    if not request.is_json:
+        return None
+    try:
+        return parse_object_stream(
+            request.stream,
+            app.config['STREAMED_JSON_KEYS'],
+            app.config['STREAMED_JSON_SPOOL_SIZE']
         )
-
-    if sample.tags:
-        for tag in sample.tags:
-            tag_id = kurasuta_database.ensure_row('sample_tag', 'name', tag)
-            cursor.execute(
-                'INSERT INTO sample_has_tag (sample_id, tag_id) VALUES(%s, %s)',
-                (sample_id, tag_id)
-            )
-    if sample.file_names:
-        for file_name in sample.file_names:
-            file_name_id = kurasuta_database.ensure_row('sample_file_name', 'name', file_name)
-            cursor.execute(
-                'INSERT INTO sample_has_file_name (sample_id, file_name_id) VALUES(%s, %s)',
-                (sample_id, file_name_id)
-            )
+    except (ijson.JSONError, ValueError, StopIteration) as e:
+        raise InvalidUsage('JSON data could not be decoded (%s)' % e, status_code=400)
 
 
 if __name__ == '__main__':
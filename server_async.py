@@ -0,0 +1,285 @@
+"""
+asyncio serving mode of the API: the same /task and /sha256/<sha256> contract as server.py, but idle workers polling
+for tasks only cost a coroutine and no thread. Task claims run on psycopg 3 async connections, sample bodies are
+persisted through the synchronous KurasutaDatabase in a small thread pool.
+"""
+from aiohttp import web
+from werkzeug.http import parse_accept_header
+from werkzeug.datastructures import MIMEAccept
+from psycopg_pool import AsyncConnectionPool
+from concurrent.futures import ThreadPoolExecutor
+from lib.task import AsyncTaskFactory
+from lib.flask import InvalidUsage
+from lib.general import KurasutaDatabase
+from lib.cache import create_sample_cache
+from lib.compression import compress, supported_encodings
+from lib.pool import ConnectionPool, PoolTimeout
+from lib.notify import AsyncTaskNotifier
+from lib.json_stream import ijson, parse_object_stream
+from lib.wire import msgpack, MSGPACK_MIMETYPE, MSGPACK_MIMETYPES, encode_msgpack, decode_msgpack
+import os
+import json
+import time
+import asyncio
+import logging
+import tempfile
+
+logging.basicConfig(format='%(asctime)s %(message)s')
+logger = logging.getLogger('KurasutaBackendApi')
+debugging_enabled = 'FLASK_DEBUG' in os.environ
+logger.setLevel(logging.DEBUG if debugging_enabled else logging.WARNING)
+
+config = dict(
+    DATABASE=os.environ['POSTGRES_DATABASE_LINK'],
+    PORT=int(os.environ.get('KURASUTA_ASYNC_PORT', 8080)),
+    TASK_CLAIM_ORDER=os.environ.get('KURASUTA_TASK_CLAIM_ORDER', 'random'),
+    TASK_MAX_COUNT=int(os.environ.get('KURASUTA_TASK_MAX_COUNT', 100)),
+    TASK_MAX_WAIT=float(os.environ.get('KURASUTA_TASK_MAX_WAIT', 60)),
+    ASYNC_POOL_MIN_SIZE=int(os.environ.get('KURASUTA_ASYNC_POOL_MIN_SIZE', 1)),
+    ASYNC_POOL_MAX_SIZE=int(os.environ.get('KURASUTA_ASYNC_POOL_MAX_SIZE', 10)),
+    DATABASE_POOL_MAX_SIZE=int(os.environ.get('KURASUTA_DATABASE_POOL_MAX_SIZE', 4)),
+    DATABASE_POOL_TIMEOUT=float(os.environ.get('KURASUTA_DATABASE_POOL_TIMEOUT', 30)),
+    DATABASE_POOL_MAX_AGE=float(os.environ.get('KURASUTA_DATABASE_POOL_MAX_AGE', 3600)),
+    DATABASE_POOL_CHECK_AFTER=float(os.environ.get('KURASUTA_DATABASE_POOL_CHECK_AFTER', 30)),
+    LOOKUP_CACHE_SIZE=int(os.environ.get('KURASUTA_LOOKUP_CACHE_SIZE', 100000)),
+    SAMPLE_CACHE=os.environ.get('KURASUTA_SAMPLE_CACHE', ''),
+    SAMPLE_CACHE_SIZE=int(os.environ.get('KURASUTA_SAMPLE_CACHE_SIZE', 10000)),
+    SAMPLE_CACHE_TTL=float(os.environ.get('KURASUTA_SAMPLE_CACHE_TTL', 3600)),
+    INSERT_PAGE_SIZE=int(os.environ.get('KURASUTA_INSERT_PAGE_SIZE', 1000)),
+    PERSIST_MODE=os.environ.get('KURASUTA_PERSIST_MODE', 'replace'),
+    STREAMED_JSON_KEYS=os.environ.get('KURASUTA_STREAMED_JSON_KEYS', 'functions,imports,exports').split(','),
+    STREAMED_JSON_SPOOL_SIZE=int(os.environ.get('KURASUTA_STREAMED_JSON_SPOOL_SIZE', 16 * 1024 * 1024)),
+    MAX_DECOMPRESSED_SIZE=int(os.environ.get('KURASUTA_MAX_DECOMPRESSED_SIZE', 1024 * 1024 * 1024)),
+    COMPRESS_MIN_SIZE=int(os.environ.get('KURASUTA_COMPRESS_MIN_SIZE', 1024))
+)
+KurasutaDatabase.lookup_cache.max_size = config['LOOKUP_CACHE_SIZE']
+KurasutaDatabase.sample_cache = create_sample_cache(
+    config['SAMPLE_CACHE'], config['SAMPLE_CACHE_SIZE'], config['SAMPLE_CACHE_TTL']
+)
+
+routes = web.RouteTableDef()
+
+
+@routes.post('/task')
+async def get_task(request):
+    json_data = await get_request_data(request)
+    if json_data is None:
+        raise InvalidUsage('JSON data could not be decoded (None)', status_code=400)
+
+    async with request.app['db_pool'].connection() as connection:
+        task_factory = AsyncTaskFactory(connection, config['TASK_CLAIM_ORDER'])
+        task_request = await task_factory.request_from_json(
+            json_data, config['TASK_MAX_COUNT'], config['TASK_MAX_WAIT']
+        )
+        if not task_request.wait:
+            tasks = await task_factory.claim_for_request(task_request)
+            await connection.commit()
+    if task_request.wait:
+        tasks = await wait_for_tasks(request.app, task_request)
+
+    if task_request.count is None:
+        return make_data_response(request, tasks[0].to_json() if tasks else {})
+    return make_data_response(request, [task.to_json() for task in tasks])
+
+
+async def wait_for_tasks(app, task_request):
+    """
+    Claims tasks for the request, waiting up to `task_request.wait` seconds for a NOTIFY about new tasks of the
+    requested types if there are none. No database connection is held while waiting.
+    """
+    deadline = time.monotonic() + task_request.wait
+    with app['task_notifier'].subscribe(task_request.plugins) as subscription:
+        while True:
+            subscription.clear()
+            async with app['db_pool'].connection() as connection:
+                tasks = await AsyncTaskFactory(connection, config['TASK_CLAIM_ORDER']).claim_for_request(task_request)
+                await connection.commit()
+            remaining = deadline - time.monotonic()
+            if tasks or remaining <= 0:
+                return tasks
+            if not await subscription.wait(remaining):
+                return []
+
+
+@routes.post('/sha256/{sha256}')
+async def persist(request):
+    body = await spool_body(request)
+    try:
+        status = await asyncio.get_running_loop().run_in_executor(
+            request.app['executor'], persist_body, request.app, request.match_info['sha256'], request.content_type, body
+        )
+    finally:
+        body.close()
+    return make_data_response(request, {'status': status})
+
+
+@routes.get('/stats')
+async def get_stats(request):
+    return web.json_response({
+        'database_pool': request.app['sync_db_pool'].stats(),
+        'async_database_pool': request.app['db_pool'].get_stats(),
+        'lookup_cache': KurasutaDatabase.lookup_cache.stats(),
+        'sample_cache': KurasutaDatabase.sample_cache.stats() if KurasutaDatabase.sample_cache else None,
+        'task_notifier': request.app['task_notifier'].stats(),
+    })
+
+
+@web.middleware
+async def error_middleware(request, handler):
+    try:
+        return await handler(request)
+    except InvalidUsage as error:
+        return web.json_response(error.to_dict(), status=error.status_code)
+    except PoolTimeout as error:
+        logger.warning('%s (%s)' % (error, request.app['sync_db_pool'].stats()))
+        return web.json_response({'message': 'Database busy, try again later'}, status=503)
+
+
+async def get_request_data(request):
+    """
+    Decodes a JSON or MessagePack request body, depending on its Content-Type.
+    """
+    body = await request.read()
+    if request.content_type in MSGPACK_MIMETYPES:
+        try:
+            return decode_msgpack(body)
+        except ValueError as e:
+            raise InvalidUsage('MessagePack data could not be decoded (%s)' % e, status_code=400)
+    try:
+        return json.loads(body.decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def make_data_response(request, data):
+    """
+    Encodes a response as MessagePack if the client prefers it over JSON, as JSON otherwise. The Accept header is
+    parsed by werkzeug like in server.py, so both servers negotiate the same way.
+    """
+    accept_mimetypes = parse_accept_header(request.headers.get('Accept'), MIMEAccept)
+    if msgpack and accept_mimetypes.best_match(['application/json', MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE:
+        return web.Response(body=encode_msgpack(data), content_type=MSGPACK_MIMETYPE)
+    return web.json_response(data)
+
+
+async def spool_body(request):
+    """
+    Reads the (already decompressed) request body into a temporary file without blocking the event loop, so the
+    synchronous parser can consume it in a worker thread afterwards.
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=config['STREAMED_JSON_SPOOL_SIZE'], mode='w+b')
+    size = 0
+    try:
+        async for chunk in request.content.iter_chunked(64 * 1024):
+            size += len(chunk)
+            if size > config['MAX_DECOMPRESSED_SIZE']:
+                raise InvalidUsage(
+                    'Decompressed request body exceeds %i bytes' % config['MAX_DECOMPRESSED_SIZE'], status_code=413
+                )
+            body.write(chunk)
+    except Exception:
+        body.close()
+        raise
+    body.seek(0)
+    return body
+
+
+def persist_body(app, sha256, content_type, body):
+    if content_type in MSGPACK_MIMETYPES:
+        try:
+            json_data = decode_msgpack(body.read())
+        except ValueError as e:
+            raise InvalidUsage('MessagePack data could not be decoded (%s)' % e, status_code=400)
+    elif ijson is not None:
+        try:
+            json_data = parse_object_stream(body, config['STREAMED_JSON_KEYS'], config['STREAMED_JSON_SPOOL_SIZE'])
+        except (ijson.JSONError, ValueError, StopIteration) as e:
+            raise InvalidUsage('JSON data could not be decoded (%s)' % e, status_code=400)
+    else:
+        try:
+            json_data = json.loads(body.read().decode('utf-8'))
+        except ValueError as e:
+            raise InvalidUsage('JSON data could not be decoded (%s)' % e, status_code=400)
+
+    db_pool = app['sync_db_pool']
+    connection = db_pool.getconn()
+    try:
+        kurasuta_database = KurasutaDatabase(connection, config['INSERT_PAGE_SIZE'], config['PERSIST_MODE'])
+        try:
+            status = kurasuta_database.persist_sample(sha256, json_data)
+            kurasuta_database.commit()
+        except Exception:
+            kurasuta_database.rollback()
+            raise
+    finally:
+        db_pool.putconn(connection)
+    return status
+
+
+async def open_pools(app):
+    app['db_pool'] = AsyncConnectionPool(
+        config['DATABASE'],
+        min_size=config['ASYNC_POOL_MIN_SIZE'],
+        max_size=config['ASYNC_POOL_MAX_SIZE'],
+        timeout=config['DATABASE_POOL_TIMEOUT'],
+        max_lifetime=config['DATABASE_POOL_MAX_AGE'],
+        open=False
+    )
+    await app['db_pool'].open()
+    app['task_notifier'] = AsyncTaskNotifier(config['DATABASE'])
+    await app['task_notifier'].start()
+    # persisting is CPU and round trip heavy, so it keeps using the synchronous store path in a few threads
+    app['sync_db_pool'] = ConnectionPool(
+        config['DATABASE'],
+        min_size=0,
+        max_size=config['DATABASE_POOL_MAX_SIZE'],
+        timeout=config['DATABASE_POOL_TIMEOUT'],
+        max_age=config['DATABASE_POOL_MAX_AGE'],
+        check_after=config['DATABASE_POOL_CHECK_AFTER']
+    )
+    app['executor'] = ThreadPoolExecutor(max_workers=config['DATABASE_POOL_MAX_SIZE'])
+
+
+async def close_pools(app):
+    await app['task_notifier'].close()
+    await app['db_pool'].close()
+    app['executor'].shutdown(wait=True)
+    app['sync_db_pool'].closeall()
+
+
+@web.middleware
+async def compression_middleware(request, handler):
+    """
+    Compresses JSON and MessagePack responses with the encoding of lib/compression.py the client prefers, like
+    compress_response of server.py.
+    """
+    response = await handler(request)
+    if not isinstance(response, web.Response) or not isinstance(response.body, bytes):
+        return response
+    if 'Content-Encoding' in response.headers or response.content_type not in ('application/json', MSGPACK_MIMETYPE):
+        return response
+    vary = [value.strip() for value in response.headers.get('Vary', '').split(',') if value.strip()]
+    if 'Accept-Encoding' not in vary:
+        response.headers['Vary'] = ', '.join(vary + ['Accept-Encoding'])
+    encoding = parse_accept_header(request.headers.get('Accept-Encoding')).best_match(supported_encodings())
+    if not encoding or len(response.body) < config['COMPRESS_MIN_SIZE']:
+        return response
+
+    response.body = compress(response.body, encoding)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def create_app():
+    app = web.Application(
+        middlewares=[compression_middleware, error_middleware], client_max_size=config['MAX_DECOMPRESSED_SIZE']
+    )
+    app.add_routes(routes)
+    app.on_startup.append(open_pools)
+    app.on_cleanup.append(close_pools)
+    return app
+
+
+if __name__ == '__main__':
+    # start several of these processes on the same port, the kernel balances connections between them
+    web.run_app(create_app(), port=config['PORT'], reuse_port=True)
@@ -0,0 +1,2 @@
+-- Serves TaskFactory.claim_unassigned: MIN/MAX pivot lookups and the SKIP LOCKED claim only touch unassigned tasks.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS task_unassigned_type_id ON task ("type", id) WHERE (assigned_at IS NULL);
@@ -0,0 +1,17 @@
+-- ON CONFLICT targets of KurasutaDatabase.ensure_rows and ensure_resource_pairs.
+-- Duplicate values created by the former select-then-insert race need to be merged before these can be created.
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS magic_description_unique ON magic (description);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS export_name_content_unique ON export_name (content);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS peyd_description_unique ON peyd (description);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS path_content_unique ON path (content);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS export_symbol_name_content_unique ON export_symbol_name (content);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS import_name_content_unique ON import_name (content);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS dll_name_content_unique ON dll_name (content);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ioc_content_unique ON ioc (content);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS section_name_content_unique ON section_name (content);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS sample_tag_name_unique ON sample_tag (name);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS sample_file_name_name_unique ON sample_file_name (name);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS resource_type_pair_unique ON resource_type_pair (content_id, content_str);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS resource_name_pair_unique ON resource_name_pair (content_id, content_str);
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS resource_language_pair_unique
+    ON resource_language_pair (content_id, content_str);
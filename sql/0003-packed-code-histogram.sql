@@ -0,0 +1,3 @@
+-- Byte histograms of new samples are stored packed (see lib/histogram.py) instead of in a byte_histogram row.
+-- Existing samples keep their code_histogram_id and are still read from byte_histogram.
+ALTER TABLE sample ADD COLUMN IF NOT EXISTS code_histogram_packed bytea;
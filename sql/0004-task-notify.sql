@@ -0,0 +1,18 @@
+-- Wakes long-polling /task requests (see lib/notify.py): one NOTIFY per task type and inserting statement, so bulk
+-- task creation does not flood the listeners. The payload is the task type.
+CREATE OR REPLACE FUNCTION notify_task_insert() RETURNS trigger AS $$
+DECLARE
+    task_type text;
+BEGIN
+    FOR task_type IN SELECT DISTINCT "type" FROM inserted_task LOOP
+        PERFORM pg_notify('kurasuta_task', task_type);
+    END LOOP;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS task_notify_insert ON task;
+CREATE TRIGGER task_notify_insert
+    AFTER INSERT ON task
+    REFERENCING NEW TABLE AS inserted_task
+    FOR EACH STATEMENT EXECUTE PROCEDURE notify_task_insert();
@@ -0,0 +1,21 @@
+-- Id array snapshots of lib/sampling.py: the ids of each stratum are numbered 0..size-1 by "position", so uniform
+-- random samples are looked up by random positions instead of scanning the sample table.
+CREATE TABLE IF NOT EXISTS sample_sampling_snapshot (
+    stratification text NOT NULL,
+    stratum text NOT NULL,
+    position integer NOT NULL,
+    sample_id integer NOT NULL,
+    PRIMARY KEY (stratification, stratum, position)
+);
+CREATE TABLE IF NOT EXISTS sample_sampling_stratum (
+    stratification text NOT NULL,
+    stratum text NOT NULL,
+    size integer NOT NULL,
+    PRIMARY KEY (stratification, stratum)
+);
+-- highest sample id contained in the snapshot of a stratification, later ids are appended by the next refresh
+CREATE TABLE IF NOT EXISTS sample_sampling_state (
+    stratification text PRIMARY KEY,
+    max_sample_id integer NOT NULL,
+    refreshed_at timestamp NOT NULL DEFAULT now()
+);
@@ -0,0 +1,3 @@
+-- refresh() of lib/sampling.py rescans ids below the last refresh and skips those already in the snapshot
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS sample_sampling_snapshot_sample_id_unique
+    ON sample_sampling_snapshot (stratification, sample_id);
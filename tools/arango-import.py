@@ -25,12 +25,13 @@ arango_database = arango_connection['kurasuta']
 sample_repository = SampleRepository(db)
 json_factory = JsonFactory()
 
-for sha256 in sys.argv[1:]:
-    with db.cursor() as cursor:
-        cursor.execute('SELECT id FROM sample WHERE (hash_sha256 = %s)', (sha256,))
-        sample_id = cursor.fetchall()[0][0]
+with db.cursor() as cursor:
+    cursor.execute('SELECT id FROM sample WHERE (hash_sha256 = ANY(%s))', (sys.argv[1:],))
+    sample_ids = [row[0] for row in cursor.fetchall()]
 
-    sample = sample_repository.by_ids([sample_id])[0]
+for sample in sample_repository.iter_by_ids(sample_ids):
+    sample_id = sample.id
+    sha256 = sample.hash_sha256
 
     json_sample = json_factory.from_sample(sample)
     if 'id' in json_sample:
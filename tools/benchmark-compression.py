@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""
+Compares bytes on the wire and compression time of the supported Content-Encodings for a corpus of sample JSON, e.g.
+the NDJSON output of dump-all.py. Every line is compressed on its own, like one upload to /sha256/<sha256>.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.compression import compress, supported_encodings
+
+parser = argparse.ArgumentParser()
+parser.add_argument('corpus_file', help='one sample JSON per line')
+parser.add_argument('--limit', type=int, default=None, help='only use the first LIMIT samples')
+args = parser.parse_args()
+
+bodies = []
+with open(args.corpus_file, 'rb') as fp:
+    for line in fp:
+        line = line.strip()
+        if line:
+            bodies.append(line)
+        if args.limit and len(bodies) >= args.limit:
+            break
+
+raw_size = sum(len(body) for body in bodies)
+print('%i samples, %i bytes uncompressed' % (len(bodies), raw_size))
+print('%-10s %14s %8s %12s' % ('encoding', 'bytes', 'ratio', 'seconds'))
+print('%-10s %14i %8.3f %12.3f' % ('identity', raw_size, 1.0, 0.0))
+for encoding in supported_encodings():
+    start = time.perf_counter()
+    compressed_size = sum(len(compress(body, encoding)) for body in bodies)
+    duration = time.perf_counter() - start
+    print('%-10s %14i %8.3f %12.3f' % (encoding, compressed_size, compressed_size / float(raw_size or 1), duration))
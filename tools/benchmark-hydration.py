@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+Compares the hydration modes of SampleRepository.by_ids for growing numbers of sample ids. The ids are the newest
+samples, both modes read the same ids and their results are checked to be equal.
+"""
+import os
+import sys
+import time
+import argparse
+import psycopg2
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.repository import SampleRepository, HYDRATIONS
+from lib.sample import JsonFactory
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--id-counts', type=int, nargs='+', default=[1, 100, 10000])
+parser.add_argument('--repetitions', type=int, default=3)
+args = parser.parse_args()
+
+db = psycopg2.connect(os.environ['POSTGRES_DATABASE_LINK'])
+json_factory = JsonFactory()
+print('%8s %14s %12s %12s' % ('ids', 'hydration', 'avg_ms', 'min_ms'))
+for id_count in args.id_counts:
+    with db.cursor() as cursor:
+        cursor.execute('SELECT id FROM sample ORDER BY id DESC LIMIT %s', (id_count,))
+        ids = [row[0] for row in cursor.fetchall()]
+
+    results = {}
+    for hydration in HYDRATIONS:
+        sample_repository = SampleRepository(db, hydration)
+        durations = []
+        for _ in range(args.repetitions):
+            start = time.perf_counter()
+            samples = sample_repository.by_ids(ids)
+            durations.append(time.perf_counter() - start)
+            db.rollback()
+        results[hydration] = [json_factory.from_sample(sample) for sample in samples]
+        print('%8i %14s %12.1f %12.1f' % (
+            len(ids),
+            hydration,
+            1000 * sum(durations) / len(durations),
+            1000 * min(durations)
+        ))
+
+    first, *others = results.values()
+    if any(other != first for other in others):
+        print('WARNING: hydration modes returned different samples for %i ids' % len(ids))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""
+Compares SampleFactory.from_json with the former decoder (create_* per item, dateutil for every timestamp) on a
+synthetic corpus of large samples, after checking that both decode every sample to the same models.
+"""
+import os
+import sys
+import time
+import json
+import hashlib
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dateutil import parser as date_parser
+from lib.sample import Sample, SampleFactory
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--samples', type=int, default=100)
+parser.add_argument('--imports', type=int, default=300)
+parser.add_argument('--exports', type=int, default=20)
+parser.add_argument('--sections', type=int, default=6)
+parser.add_argument('--resources', type=int, default=30)
+parser.add_argument('--functions', type=int, default=1000)
+parser.add_argument('--debug-directories', type=int, default=2)
+parser.add_argument('--repetitions', type=int, default=3)
+args = parser.parse_args()
+
+
+class LegacySampleFactory(SampleFactory):
+    def debug_directory_from_json(self, debug_directory):
+        return self.create_debug_directory(
+            date_parser.parse(debug_directory['timestamp']) if debug_directory['timestamp'] else None,
+            debug_directory['path'],
+            int(debug_directory['age']) if debug_directory['age'] else None,
+            debug_directory['signature'],
+            debug_directory['guid']
+        )
+
+    def export_from_json(self, export):
+        return self.create_export(export['address'], export['name'], export['ordinal'])
+
+    def import_from_json(self, sample_import):
+        return self.create_import(sample_import['dll_name'], sample_import['address'], sample_import['name'])
+
+    def section_from_json(self, section):
+        return self.create_section(
+            section['hash_sha256'], section['name'], section['virtual_address'],
+            section['virtual_size'], section['raw_size'], section['entropy'], section['ssdeep'],
+        )
+
+    def resource_from_json(self, resource):
+        return self.create_resource(
+            resource['hash_sha256'], resource['offset'], resource['size'], resource['actual_size'],
+            resource['ssdeep'], resource['entropy'],
+            resource['type_id'] if 'type_id' in resource else None,
+            resource['type_str'] if 'type_str' in resource else None,
+            resource['name_id'] if 'name_id' in resource else None,
+            resource['name_str'] if 'name_str' in resource else None,
+            resource['language_id'] if 'language_id' in resource else None,
+            resource['language_str'] if 'language_str' in resource else None
+        )
+
+    def function_from_json(self, func):
+        return self.create_function(
+            func['offset'], func['size'], func['real_size'], func['name'], func['calltype'], func['cc'], func['cost'],
+            func['ebbs'], func['edges'], func['indegree'], func['nargs'], func['nbbs'], func['nlocals'],
+            func['outdegree'], func['type'], func['opcodes_sha256'], func['opcodes_crc32'],
+            func['cleaned_opcodes_sha256'], func['cleaned_opcodes_crc32'], func['opcodes']
+        )
+
+    def from_json(self, d):
+        sample = Sample()
+        if 'hash_sha256' in d.keys(): sample.hash_sha256 = d['hash_sha256']
+        if 'hash_md5' in d.keys(): sample.hash_md5 = d['hash_md5']
+        if 'hash_sha1' in d.keys(): sample.hash_sha1 = d['hash_sha1']
+        if 'size' in d.keys(): sample.size = int(d['size'])
+        if 'code_histogram' in d.keys(): sample.code_histogram = d['code_histogram']
+        if 'magic' in d.keys(): sample.magic = d['magic']
+        if 'peyd' in d.keys(): sample.peyd = d['peyd']
+        if 'ssdeep' in d.keys(): sample.ssdeep = d['ssdeep']
+        if 'imphash' in d.keys(): sample.imphash = d['imphash']
+        if 'entropy' in d.keys(): sample.entropy = float(d['entropy'])
+        if 'file_size' in d.keys(): sample.file_size = int(d['file_size'])
+        if 'entry_point' in d.keys(): sample.entry_point = int(d['entry_point'])
+        if 'first_kb' in d.keys(): sample.first_kb = d['first_kb']
+        if 'overlay_sha256' in d.keys(): sample.overlay_sha256 = d['overlay_sha256']
+        if 'overlay_size' in d.keys(): sample.overlay_size = int(d['overlay_size'])
+        if 'overlay_ssdeep' in d.keys(): sample.overlay_ssdeep = d['overlay_ssdeep']
+        if 'overlay_entropy' in d.keys(): sample.overlay_entropy = float(d['overlay_entropy'])
+        if 'build_timestamp' in d.keys(): sample.build_timestamp = date_parser.parse(d['build_timestamp'])
+        if 'debug_directories' in d.keys():
+            sample.debug_directories = self._map_items(d['debug_directories'], self.debug_directory_from_json)
+        if 'strings_count_of_length_at_least_10' in d.keys():
+            sample.strings_count_of_length_at_least_10 = int(d['strings_count_of_length_at_least_10'])
+        if 'strings_count' in d.keys(): sample.strings_count = int(d['strings_count'])
+        if 'heuristic_iocs' in d.keys(): sample.heuristic_iocs = d['heuristic_iocs']
+        if 'export_name' in d.keys(): sample.export_name = d['export_name']
+        if 'exports' in d.keys(): sample.exports = self._map_items(d['exports'], self.export_from_json)
+        if 'imports' in d.keys(): sample.imports = self._map_items(d['imports'], self.import_from_json)
+        if 'sections' in d.keys(): sample.sections = self._map_items(d['sections'], self.section_from_json)
+        if 'resources' in d.keys(): sample.resources = self._map_items(d['resources'], self.resource_from_json)
+        if 'functions' in d.keys(): sample.functions = self._map_items(d['functions'], self.function_from_json)
+        if 'source_id' in d.keys(): sample.source_id = d['source_id']
+        if 'tags' in d.keys(): sample.tags = d['tags']
+        if 'file_names' in d.keys(): sample.file_names = d['file_names']
+        return sample
+
+
+# covers the fast path as well as the formats left to dateutil
+TIMESTAMPS = (
+    '2018-01-31 12:34:56', '2018-01-31T12:34:56', '2018-01-31 12:34:56.123', '2018-01-31 12:34:56.123456',
+    '2018-01-31T12:34:56Z', '2018-01-31 12:34:56+00:00', '2018-01-31 12:34:56+02:00', '2018-01-31T12:34:56-05:30',
+    '2018-01-31 12:34:56 UTC', 'Wed Jan 31 12:34:56 2018', '2018-01-31',
+)
+
+
+def build_json(number):
+    sha256 = hashlib.sha256(b'%i' % number).hexdigest()
+    return {
+        'hash_sha256': sha256,
+        'hash_md5': hashlib.md5(b'%i' % number).hexdigest(),
+        'hash_sha1': hashlib.sha1(b'%i' % number).hexdigest(),
+        'size': 1024 * 1024,
+        'code_histogram': {str(i): i for i in range(256)},
+        'magic': 'PE32 executable (GUI) Intel 80386, for MS Windows',
+        'peyd': ['Microsoft Visual C++ 8'],
+        'ssdeep': '24576:abc:def',
+        'imphash': hashlib.md5(b'imphash%i' % number).hexdigest(),
+        'entropy': '6.5',
+        'file_size': '1048576',
+        'entry_point': 0x401000,
+        'first_kb': 'ff' * 1024,
+        'overlay_sha256': sha256,
+        'overlay_size': 512,
+        'overlay_ssdeep': '3:abc:def',
+        'overlay_entropy': 7.25,
+        'build_timestamp': TIMESTAMPS[number % len(TIMESTAMPS)],
+        'debug_directories': [
+            {
+                'timestamp': TIMESTAMPS[(number + i) % len(TIMESTAMPS)] if i else None,
+                'path': 'C:\\build\\%i.pdb' % i,
+                'age': str(i),
+                'signature': sha256[:32],
+                'guid': sha256[:32],
+            } for i in range(args.debug_directories)
+        ],
+        'strings_count_of_length_at_least_10': '123',
+        'strings_count': 4567,
+        'heuristic_iocs': ['http://example.com/%i' % number],
+        'export_name': 'sample%i.dll' % number,
+        'exports': [
+            {'address': 0x402000 + i, 'name': 'Export%i' % i, 'ordinal': i} for i in range(args.exports)
+        ],
+        'imports': [
+            {'dll_name': 'dll%i.dll' % (i % 20), 'address': 0x401000 + i, 'name': 'Function%i' % i}
+            for i in range(args.imports)
+        ],
+        'sections': [
+            {
+                'hash_sha256': sha256, 'name': '.sect%i' % i, 'virtual_address': i * 0x1000,
+                'virtual_size': 0x1000, 'raw_size': 0x1000, 'entropy': 6.5, 'ssdeep': '3:abc:def',
+            } for i in range(args.sections)
+        ],
+        'resources': [
+            dict(
+                {
+                    'hash_sha256': sha256, 'offset': i * 0x100, 'size': 0x100, 'actual_size': 0x100,
+                    'ssdeep': '3:abc:def', 'entropy': 4.5,
+                },
+                **({'type_id': str(i), 'name_id': str(i), 'language_id': '1033'} if i % 2 else {'type_str': 'ICON'})
+            ) for i in range(args.resources)
+        ],
+        'functions': [
+            {
+                'offset': 0x401000 + i * 0x10, 'size': 0x10, 'real_size': 0x10, 'name': 'fcn.%08x' % i,
+                'calltype': 'cdecl', 'cc': 1, 'cost': 10, 'ebbs': 1, 'edges': 2, 'indegree': 1, 'nargs': 2, 'nbbs': 3,
+                'nlocals': 0, 'outdegree': 1, 'type': 'fcn', 'opcodes_sha256': sha256, 'opcodes_crc32': i,
+                'cleaned_opcodes_sha256': sha256, 'cleaned_opcodes_crc32': i, 'opcodes': '5589e5',
+            } for i in range(args.functions)
+        ],
+        'source_id': 'synthetic',
+        'tags': ['tag%i' % (number % 5)],
+        'file_names': ['sample%i.exe' % number],
+        'unknown_key': 'ignored by both decoders',
+    }
+
+
+def as_comparable(value):
+    # repr() of datetimes includes the type of tzinfo, so tzutc() and tzlocal() are told apart
+    if isinstance(value, list):
+        return [as_comparable(item) for item in value]
+    if hasattr(value, '__slots__'):
+        return (type(value).__name__, [(name, as_comparable(getattr(value, name))) for name in value.__slots__])
+    return repr(value)
+
+
+corpus = [build_json(number) for number in range(args.samples)]
+decoders = (('legacy', LegacySampleFactory()), ('fast', SampleFactory()))
+
+for d in corpus:
+    expected, actual = (as_comparable(factory.from_json(d)) for _, factory in decoders)
+    if expected != actual:
+        raise Exception('Decoders differ for sample %s' % d['hash_sha256'])
+print('%i samples decoded identically' % len(corpus))
+
+print('%8s %12s %12s' % ('decoder', 'total_ms', 'ms/sample'))
+for name, factory in decoders:
+    durations = []
+    for _ in range(args.repetitions):
+        start = time.perf_counter()
+        for d in corpus:
+            factory.from_json(d)
+        durations.append(time.perf_counter() - start)
+    print('%8s %12.1f %12.3f' % (name, 1000 * min(durations), 1000 * min(durations) / len(corpus)))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""
+Compares json.dumps(JsonFactory.from_sample(sample)) with JsonFactory.write_sample on synthetic large samples: checks
+that both produce the same JSON text, then measures time and peak memory of writing the samples to a file.
+"""
+import os
+import sys
+import time
+import json
+import hashlib
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from datetime import datetime
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.sample import Sample, SampleImport, SampleExport, SampleSection, SampleResource, SampleFunction, \
+    SampleDebugDirectory, JsonFactory
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--samples', type=int, default=100)
+parser.add_argument('--imports', type=int, default=300)
+parser.add_argument('--exports', type=int, default=20)
+parser.add_argument('--sections', type=int, default=6)
+parser.add_argument('--resources', type=int, default=30)
+parser.add_argument('--functions', type=int, default=1000)
+parser.add_argument('--opcodes', type=int, default=200, help='opcodes per function')
+parser.add_argument('--filter', default=None, help='filter of the JsonFactory, e.g. "hash"')
+parser.add_argument('--items-per-chunk', type=int, default=25)
+parser.add_argument('--repetitions', type=int, default=3)
+args = parser.parse_args()
+
+
+def build_sample(number):
+    sample = Sample()
+    sample.id = number
+    sample.hash_sha256 = hashlib.sha256(b'%i' % number).hexdigest()
+    sample.hash_md5 = hashlib.md5(b'%i' % number).hexdigest()
+    sample.size = 1024 * 1024
+    sample.code_histogram = np.arange(256, dtype=np.int64)
+    sample.magic = 'PE32 executable (GUI) Intel 80386, for MS Windows'
+    sample.peyd = ['Microsoft Visual C++ 8']
+    sample.entropy = 6.5
+    sample.first_kb = bytearray(range(256)) * 4
+    sample.build_timestamp = datetime(2018, 1, 31, 12, 34, 56)
+    sample.heuristic_iocs = ['http://example.com/\u00e4%i' % number]
+    debug_directory = SampleDebugDirectory()
+    debug_directory.timestamp = sample.build_timestamp
+    debug_directory.path = 'C:\\build\\"sample".pdb'
+    sample.debug_directories = [debug_directory]
+    sample.imports = []
+    for i in range(args.imports):
+        sample_import = SampleImport()
+        sample_import.dll_name = 'dll%i.dll' % (i % 20)
+        sample_import.address = 0x401000 + i
+        sample_import.name = 'Function%i' % i
+        sample.imports.append(sample_import)
+    sample.exports = []
+    for i in range(args.exports):
+        export = SampleExport()
+        export.address = 0x402000 + i
+        export.name = 'Export%i' % i
+        export.ordinal = i
+        sample.exports.append(export)
+    sample.sections = []
+    for i in range(args.sections):
+        section = SampleSection()
+        section.hash_sha256 = sample.hash_sha256
+        section.name = '.sect%i' % i
+        section.virtual_address = i * 0x1000
+        section.virtual_size = section.raw_size = 0x1000
+        section.entropy = 6.5 + i / 3
+        sample.sections.append(section)
+    sample.resources = []
+    for i in range(args.resources):
+        resource = SampleResource()
+        resource.hash_sha256 = sample.hash_sha256
+        resource.offset = i * 0x100
+        resource.size = resource.actual_size = 0x100
+        resource.type_id = resource.name_id = resource.language_id = str(i)
+        sample.resources.append(resource)
+    sample.functions = []
+    for i in range(args.functions):
+        function = SampleFunction()
+        function.offset = 0x401000 + i * 0x10
+        function.size = function.real_size = 0x10
+        function.name = 'fcn.%08x' % function.offset
+        function.cc = function.nargs = function.nlocals = function.nbbs = 1
+        function.opcodes_sha256 = sample.hash_sha256
+        function.opcodes = ['mov', 'push', 'call', 'ret'] * (args.opcodes // 4)
+        sample.functions.append(function)
+    return sample
+
+
+def dump(json_factory, samples, fp):
+    for sample in samples:
+        fp.write('%s\n' % json.dumps(json_factory.from_sample(sample)))
+
+
+def write(json_factory, samples, fp):
+    for sample in samples:
+        json_factory.write_sample(sample, fp)
+        fp.write('\n')
+
+
+samples = [build_sample(number) for number in range(args.samples)]
+json_factory = JsonFactory(args.filter, items_per_chunk=args.items_per_chunk)
+for sample in samples:
+    if json.dumps(json_factory.from_sample(sample)) != ''.join(json_factory.iter_json(sample)):
+        raise Exception('Encoders differ for sample %i' % sample.id)
+print('%i samples encoded identically' % len(samples))
+
+print('%12s %12s %12s %14s' % ('encoder', 'total_ms', 'ms/sample', 'peak_bytes'))
+with tempfile.TemporaryFile('w+') as fp:
+    for name, encode in (('from_sample', dump), ('write_sample', write)):
+        durations = []
+        for _ in range(args.repetitions):
+            fp.seek(0)
+            start = time.perf_counter()
+            encode(json_factory, samples, fp)
+            durations.append(time.perf_counter() - start)
+
+        # measured separately, tracing slows down encoding considerably
+        fp.seek(0)
+        tracemalloc.start()
+        encode(json_factory, samples, fp)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        print('%12s %12.1f %12.3f %14i' % (
+            name, 1000 * min(durations), 1000 * min(durations) / len(samples), peak
+        ))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+Compares construction time and memory of the slotted model classes in lib/sample.py with the former __dict__ based
+FrozenClass, for synthetic samples with a realistic number of imports, exports, sections, resources and functions.
+"""
+import os
+import sys
+import time
+import hashlib
+import argparse
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.sample import Sample, SampleImport, SampleExport, SampleSection, SampleResource, SampleFunction
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--samples', type=int, default=200)
+parser.add_argument('--imports', type=int, default=300)
+parser.add_argument('--exports', type=int, default=20)
+parser.add_argument('--sections', type=int, default=6)
+parser.add_argument('--resources', type=int, default=30)
+parser.add_argument('--functions', type=int, default=1000)
+args = parser.parse_args()
+
+
+class LegacyFrozenClass(object):
+    __isfrozen = False
+
+    def __setattr__(self, key, value):
+        if self.__isfrozen and not hasattr(self, key):
+            raise TypeError('%r is a frozen class, cannot set "%s" to "%s"' % (self, key, value))
+        object.__setattr__(self, key, value)
+
+    def _freeze(self):
+        self.__isfrozen = True
+
+
+def legacy_class(cls):
+    names = cls.__slots__
+
+    def __init__(self):
+        for name in names:
+            setattr(self, name, None)
+        self._freeze()
+
+    return type('Legacy%s' % cls.__name__, (LegacyFrozenClass,), {'__init__': __init__})
+
+
+def build_sample(classes, number):
+    sample = classes[Sample]()
+    sample.hash_sha256 = hashlib.sha256(b'%i' % number).hexdigest()
+    sample.hash_md5 = hashlib.md5(b'%i' % number).hexdigest()
+    sample.size = 1024 * 1024
+    sample.entropy = 6.5
+    sample.imports = []
+    for i in range(args.imports):
+        sample_import = classes[SampleImport]()
+        sample_import.dll_name = 'dll%i.dll' % (i % 20)
+        sample_import.address = 0x401000 + i
+        sample_import.name = 'Function%i' % i
+        sample.imports.append(sample_import)
+    sample.exports = []
+    for i in range(args.exports):
+        export = classes[SampleExport]()
+        export.address = 0x402000 + i
+        export.name = 'Export%i' % i
+        export.ordinal = i
+        sample.exports.append(export)
+    sample.sections = []
+    for i in range(args.sections):
+        section = classes[SampleSection]()
+        section.hash_sha256 = sample.hash_sha256
+        section.name = '.sect%i' % i
+        section.virtual_address = i * 0x1000
+        section.virtual_size = section.raw_size = 0x1000
+        section.entropy = 6.5
+        sample.sections.append(section)
+    sample.resources = []
+    for i in range(args.resources):
+        resource = classes[SampleResource]()
+        resource.hash_sha256 = sample.hash_sha256
+        resource.offset = i * 0x100
+        resource.size = resource.actual_size = 0x100
+        resource.type_id = resource.name_id = resource.language_id = str(i)
+        sample.resources.append(resource)
+    sample.functions = []
+    for i in range(args.functions):
+        function = classes[SampleFunction]()
+        function.offset = 0x401000 + i * 0x10
+        function.size = function.real_size = 0x10
+        function.name = 'fcn.%08x' % function.offset
+        function.cc = function.nargs = function.nlocals = function.nbbs = 1
+        function.opcodes_sha256 = sample.hash_sha256
+        sample.functions.append(function)
+    return sample
+
+
+slotted = {cls: cls for cls in (Sample, SampleImport, SampleExport, SampleSection, SampleResource, SampleFunction)}
+legacy = {cls: legacy_class(cls) for cls in slotted}
+
+print('%8s %12s %12s %14s' % ('models', 'total_ms', 'us/object', 'bytes/sample'))
+objects_per_sample = 1 + args.imports + args.exports + args.sections + args.resources + args.functions
+for name, classes in (('frozen', legacy), ('slotted', slotted)):
+    start = time.perf_counter()
+    samples = [build_sample(classes, number) for number in range(args.samples)]
+    duration = time.perf_counter() - start
+    del samples
+
+    # measured separately, tracing slows down construction considerably
+    tracemalloc.start()
+    samples = [build_sample(classes, number) for number in range(args.samples)]
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del samples
+
+    print('%8s %12.1f %12.3f %14i' % (
+        name,
+        1000 * duration,
+        1e6 * duration / (args.samples * objects_per_sample),
+        memory / args.samples
+    ))
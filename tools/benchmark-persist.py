@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Measures KurasutaDatabase.store_metadata for synthetic samples with a growing number of imports. Every sample is
+stored in its own transaction which is rolled back afterwards, so the database is left unchanged.
+"""
+import os
+import sys
+import time
+import random
+import hashlib
+import argparse
+import psycopg2
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.general import KurasutaDatabase
+from lib.sample import SampleFactory, Sample
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--import-counts', type=int, nargs='+', default=[10, 100, 1000, 5000, 20000])
+parser.add_argument('--page-sizes', type=int, nargs='+', default=[1, 100, 1000])
+parser.add_argument('--repetitions', type=int, default=3)
+args = parser.parse_args()
+
+
+def synthetic_sample(import_count):
+    factory = SampleFactory()
+    seed = os.urandom(16)
+    sample = Sample()
+    sample.hash_sha256 = hashlib.sha256(seed).hexdigest()
+    sample.hash_md5 = hashlib.md5(seed).hexdigest()
+    sample.hash_sha1 = hashlib.sha1(seed).hexdigest()
+    sample.size = 1024 * 1024
+    sample.first_kb = os.urandom(1024)
+    sample.imports = [
+        factory.create_import('dll%i.dll' % (i % 50), 0x401000 + i, 'Function%i' % random.randint(0, 4 * import_count))
+        for i in range(import_count)
+    ]
+    sample.exports = [factory.create_export(0x402000 + i, 'Export%i' % i, i) for i in range(import_count // 10)]
+    sample.sections = [
+        factory.create_section(hashlib.sha256(b'%i' % i).hexdigest(), '.sect%i' % i, i * 0x1000, 0x1000, 0x1000, 6.5, '')
+        for i in range(8)
+    ]
+    return sample
+
+
+db = psycopg2.connect(os.environ['POSTGRES_DATABASE_LINK'])
+print('%8s %10s %12s %12s' % ('imports', 'page_size', 'avg_ms', 'min_ms'))
+for import_count in args.import_counts:
+    samples = [synthetic_sample(import_count) for _ in range(args.repetitions)]
+    for page_size in args.page_sizes:
+        durations = []
+        for sample in samples:
+            kurasuta_database = KurasutaDatabase(db, page_size)
+            start = time.perf_counter()
+            kurasuta_database.store_metadata(sample)
+            durations.append(time.perf_counter() - start)
+            kurasuta_database.rollback()
+        print('%8i %10i %12.1f %12.1f' % (
+            import_count,
+            page_size,
+            1000 * sum(durations) / len(durations),
+            1000 * min(durations)
+        ))
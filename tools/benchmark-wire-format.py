@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Compares payload size and encode/decode time of JSON and MessagePack for a corpus of samples, e.g. the NDJSON output
+of dump-all.py. Decoding includes SampleFactory.from_json, encoding includes JsonFactory.from_sample.
+"""
+import os
+import sys
+import time
+import json
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.sample import SampleFactory, JsonFactory
+from lib.wire import encode_msgpack, decode_msgpack
+
+parser = argparse.ArgumentParser()
+parser.add_argument('corpus_file', help='one sample JSON per line')
+parser.add_argument('--limit', type=int, default=None, help='only use the first LIMIT samples')
+parser.add_argument('--repetitions', type=int, default=3)
+args = parser.parse_args()
+
+sample_factory = SampleFactory()
+samples = []
+with open(args.corpus_file, 'r') as fp:
+    for line in fp:
+        if not line.strip():
+            continue
+        sample = sample_factory.from_json(json.loads(line))
+        if isinstance(sample.first_kb, str):
+            sample.first_kb = bytes.fromhex(sample.first_kb)
+        samples.append(sample)
+        if args.limit and len(samples) >= args.limit:
+            break
+
+formats = [
+    ('json', JsonFactory(), lambda d: json.dumps(d).encode('utf-8'), lambda b: json.loads(b.decode('utf-8'))),
+    ('msgpack', JsonFactory(raw_bytes=True), encode_msgpack, decode_msgpack),
+]
+
+print('%i samples' % len(samples))
+print('%-10s %14s %12s %12s' % ('format', 'bytes', 'encode_s', 'decode_s'))
+for name, json_factory, encode, decode in formats:
+    encode_durations = []
+    decode_durations = []
+    for _ in range(args.repetitions):
+        start = time.perf_counter()
+        payloads = [encode(json_factory.from_sample(sample)) for sample in samples]
+        encode_durations.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for payload in payloads:
+            sample_factory.from_json(decode(payload))
+        decode_durations.append(time.perf_counter() - start)
+    print('%-10s %14i %12.3f %12.3f' % (
+        name,
+        sum(len(payload) for payload in payloads),
+        min(encode_durations),
+        min(decode_durations)
+    ))
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""
+Deletes samples listed in a hash file (SHA256, MD5 or SHA1, one per line) and/or all samples of a source. Samples are
+deleted in batches, each batch in its own transaction, and the deleted rows per table are logged.
+"""
+import os
+import sys
+import logging
+import argparse
+import psycopg2
+from collections import Counter
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.general import KurasutaDatabase, SampleSourceRepository
+from lib.repository import SampleRepository
+
+logging.basicConfig(format='%(asctime)s %(message)s')
+logger = logging.getLogger('KurasutaDeleteSamples')
+logger.setLevel(logging.INFO)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--hash-file', help='file with one hash per line')
+parser.add_argument('--source', help='identifier of a sample source whose samples are deleted')
+parser.add_argument('--batch-size', type=int, default=1000)
+args = parser.parse_args()
+if not args.hash_file and not args.source:
+    parser.error('--hash-file or --source is required')
+
+db = psycopg2.connect(os.environ['POSTGRES_DATABASE_LINK'])
+sample_ids = set()
+if args.hash_file:
+    with open(args.hash_file, 'rb') as fp:
+        for chunk in SampleRepository(db).resolve_hashes(fp):
+            sample_ids.update(sample_id for _, sample_id, _ in chunk if sample_id is not None)
+if args.source:
+    source_id = SampleSourceRepository(db).get_by_identifier(args.source)
+    with db.cursor() as cursor:
+        cursor.execute('SELECT sample_id FROM sample_has_source WHERE (source_id = %s)', (source_id,))
+        sample_ids.update(row[0] for row in cursor.fetchall())
+db.rollback()
+sample_ids = sorted(sample_ids)
+logger.info('Deleting %i samples...' % len(sample_ids))
+
+kurasuta_database = KurasutaDatabase(db)
+total = Counter()
+for start in range(0, len(sample_ids), args.batch_size):
+    deleted = kurasuta_database.delete_samples(ids=sample_ids[start:start + args.batch_size])
+    kurasuta_database.commit()
+    total.update(deleted)
+    logger.info('Deleted %i of %i samples.' % (total['sample'], len(sample_ids)))
+
+for table, count in sorted(total.items()):
+    logger.info('%s: %i rows' % (table, count))
+logger.info('All done.')
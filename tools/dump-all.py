@@ -1,48 +1,269 @@
 #!/usr/bin/env python
+"""
+Exports all samples as NDJSON shards into a target directory, hydrated by a pool of worker processes which all read
+the same exported Postgres snapshot. Each shard holds the samples of one id range and is renamed into place once
+complete; the completed id ranges are kept in a checkpoint file, so a restarted export continues where it stopped and
+a later run exports samples stored since.
+
+Ids within --recheck-margin of the highest id of the snapshot are only completed one by one, since transactions
+still running when the snapshot was taken might commit samples with lower ids; a later run exports those then.
+Samples stored again under an existing id (KURASUTA_PERSIST_MODE=update) are not exported again, use a new target
+directory for a complete export with their current data.
+"""
 import os
+import io
+import re
+import bisect
 import sys
-import psycopg2
+import json
+import time
 import logging
 import argparse
-import json
+import psycopg2
+import multiprocessing
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from lib.repository import SampleRepository
+from lib.repository import SampleRepository, HYDRATIONS, HYDRATION_SINGLE_QUERY
 from lib.sample import JsonFactory
+from lib.compression import compressing_writer, decompressing_reader, supported_encodings
 
-logging.basicConfig()
+logging.basicConfig(format='%(asctime)s %(message)s')
 logger = logging.getLogger('KurasutaDumper')
-logger.setLevel(logging.DEBUG)
-
-parser = argparse.ArgumentParser()
-parser.add_argument('target_file_name')
-args = parser.parse_args()
-
-target_file_name = args.target_file_name
-existing_ids = []
-if os.path.exists(target_file_name):
-    with open(target_file_name, 'r') as fp:
-        for line in fp:
-            line = line.strip()
-            if not line:
-                continue
-            existing_ids.append(json.loads(line)['id'])
-
-db = psycopg2.connect(os.environ['POSTGRES_DATABASE_LINK'])
-sample_repository = SampleRepository(db)
-json_factory = JsonFactory()
-with db.cursor() as cursor:
-    logger.info('Selecting all ids...')
-    cursor.execute('SELECT id FROM sample')
-    logger.info('Found %i ids.' % cursor.rowcount)
-    for row in cursor:
-        id = row[0]
-        if id in existing_ids:
+logger.setLevel(logging.INFO)
+
+CHECKPOINT_FILE_NAME = 'checkpoint.json'
+SHARD_EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+SHARD_COMPRESSIONS = {extension: compression for compression, extension in SHARD_EXTENSIONS.items()}
+SHARD_FILE_NAME = re.compile(r'^samples-(\d+)-(\d+)\.ndjson(\.gz|\.zst)?$')
+TEMPORARY_SUFFIX = '.tmp'
+
+
+def shard_file_name(first_id, last_id, compression):
+    return 'samples-%012i-%012i.ndjson%s' % (first_id, last_id, SHARD_EXTENSIONS[compression])
+
+
+def merge_ranges(ranges):
+    """
+    :param ranges: (first_id, last_id) pairs, both inclusive
+    :return: sorted list of [first_id, last_id] without overlapping or adjacent ranges
+    """
+    merged = []
+    for first_id, last_id in sorted(ranges):
+        if merged and first_id <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last_id)
+        else:
+            merged.append([first_id, last_id])
+    return merged
+
+
+def is_completed(completed, first_id, last_id):
+    position = bisect.bisect_right(completed, [first_id, float('inf')]) - 1
+    return position >= 0 and completed[position][0] <= first_id and last_id <= completed[position][1]
+
+
+def read_shard_ids(file_name):
+    compression = SHARD_COMPRESSIONS.get(SHARD_FILE_NAME.match(os.path.basename(file_name)).group(3) or '')
+    with open(file_name, 'rb') as raw:
+        stream = decompressing_reader(raw, compression) if compression else raw
+        return [json.loads(line)['id'] for line in io.TextIOWrapper(stream, encoding='utf-8') if line.strip()]
+
+
+def read_checkpoint(target_directory):
+    """
+    Completed ranges are read from the checkpoint and from the names of the shards, which are only renamed into place
+    once complete. The latter covers shards completed right before the checkpoint could be written.
+
+    :return: (completed ranges, id up to which ranges were completed as a whole by the run writing the checkpoint)
+    """
+    completed = []
+    safe_id = 0
+    checkpoint_file_name = os.path.join(target_directory, CHECKPOINT_FILE_NAME)
+    if os.path.exists(checkpoint_file_name):
+        with open(checkpoint_file_name, 'r') as fp:
+            checkpoint = json.load(fp)
+        completed = merge_ranges(tuple(completed_range) for completed_range in checkpoint['completed'])
+        safe_id = checkpoint.get('safe_id', 0)
+
+    recovered = []
+    for file_name in os.listdir(target_directory):
+        if file_name.endswith(TEMPORARY_SUFFIX):
+            # left behind by an interrupted worker
+            os.remove(os.path.join(target_directory, file_name))
+            continue
+        match = SHARD_FILE_NAME.match(file_name)
+        if not match:
+            continue
+        first_id, last_id = int(match.group(1)), int(match.group(2))
+        if is_completed(completed, first_id, last_id):
+            continue
+        if first_id <= safe_id:
+            recovered.append((first_id, min(last_id, safe_id)))
+        if last_id > safe_id:
+            recovered += [
+                (sample_id, sample_id) for sample_id in read_shard_ids(os.path.join(target_directory, file_name))
+                if sample_id > safe_id
+            ]
+    return merge_ranges(completed + recovered), safe_id
+
+
+def write_checkpoint(target_directory, completed, safe_id):
+    file_name = os.path.join(target_directory, CHECKPOINT_FILE_NAME)
+    with open(file_name + TEMPORARY_SUFFIX, 'w') as fp:
+        json.dump({'safe_id': safe_id, 'completed': completed}, fp)
+    os.replace(file_name + TEMPORARY_SUFFIX, file_name)
+
+
+def completed_ranges(first_id, last_id, safe_id, tail_ids):
+    """
+    Ranges completed by exporting the range from `first_id` to `last_id`: the part up to `safe_id` as a whole, above
+    only the exported ids, so ids committed later in between are exported by the next run.
+
+    :param tail_ids: sorted ids above `safe_id` of the snapshot
+    """
+    ranges = [[first_id, min(last_id, safe_id)]] if first_id <= safe_id else []
+    start = bisect.bisect_left(tail_ids, max(first_id, safe_id + 1))
+    end = bisect.bisect_right(tail_ids, last_id)
+    return ranges + [[sample_id, sample_id] for sample_id in tail_ids[start:end]]
+
+
+def batch_ranges(ids, completed, batch_size):
+    """
+    Splits the id space into ranges of up to `batch_size` samples, skipping completed ranges. Consecutive ranges are
+    adjacent (the next one starts right after the last id of the previous one), so completed ranges merge into few.
+
+    :param ids: all sample ids in ascending order
+    :param completed: sorted, merged completed ranges
+    """
+    first_id = 1
+    last_id = None
+    count = 0
+    position = 0
+    for sample_id in ids:
+        while position < len(completed) and completed[position][1] < sample_id:
+            position += 1
+        if position < len(completed) and completed[position][0] <= sample_id:
+            if count:
+                yield first_id, completed[position][0] - 1
+                count = 0
+            first_id = completed[position][1] + 1
             continue
-        samples = sample_repository.by_ids([id])
-        logger.info('Dumping sample with id %s...' % id)
-        with open(target_file_name, 'a') as fp:
-            for sample in samples:
-                fp.write('%s\n' % json.dumps(json_factory.from_sample(sample)))
-logger.info('All done.')
+        count += 1
+        last_id = sample_id
+        if count >= batch_size:
+            yield first_id, last_id
+            first_id = last_id + 1
+            count = 0
+    if count:
+        yield first_id, last_id
+
+
+worker = {}
+
+
+def init_worker(snapshot_id, target_directory, compression, hydration, chunk_size):
+    db = psycopg2.connect(os.environ['POSTGRES_DATABASE_LINK'])
+    db.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    with db.cursor() as cursor:
+        # has to be the first statement of the transaction, which stays open for the lifetime of the worker
+        cursor.execute('SET TRANSACTION SNAPSHOT %s', (snapshot_id,))
+    worker.update(
+        sample_repository=SampleRepository(db, hydration),
+        json_factory=JsonFactory(),
+        target_directory=target_directory,
+        compression=compression,
+        chunk_size=chunk_size,
+    )
+
+
+def export_range(id_range):
+    """
+    Writes the samples of an id range into a shard, which is renamed into place once complete.
+
+    :return: (first_id, last_id, number of exported samples)
+    """
+    first_id, last_id = id_range
+    sample_repository = worker['sample_repository']
+    json_factory = worker['json_factory']
+    file_name = os.path.join(worker['target_directory'], shard_file_name(first_id, last_id, worker['compression']))
+    count = 0
+    with open(file_name + TEMPORARY_SUFFIX, 'wb') as raw:
+        writer = compressing_writer(raw, worker['compression']) if worker['compression'] else raw
+        fp = io.TextIOWrapper(writer, encoding='utf-8', write_through=False)
+        for sample in sample_repository.iter_by_ids(sample_repository.ids_between(first_id, last_id),
+                                                    worker['chunk_size']):
+            json_factory.write_sample(sample, fp)
+            fp.write('\n')
+            count += 1
+        fp.flush()
+        fp.detach()
+        if writer is not raw:
+            writer.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(file_name + TEMPORARY_SUFFIX, file_name)
+    return first_id, last_id, count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('target_directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--batch-size', type=int, default=10000, help='samples per shard')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='samples hydrated at a time')
+    parser.add_argument('--compression', choices=supported_encodings(), default=None)
+    parser.add_argument('--hydration', choices=HYDRATIONS, default=HYDRATION_SINGLE_QUERY)
+    parser.add_argument(
+        '--recheck-margin', type=int, default=10000,
+        help='ids below the highest one which are checked again by the next run'
+    )
+    args = parser.parse_args()
+
+    os.makedirs(args.target_directory, exist_ok=True)
+    completed, safe_id = read_checkpoint(args.target_directory)
+
+    db = psycopg2.connect(os.environ['POSTGRES_DATABASE_LINK'])
+    db.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    with db.cursor() as cursor:
+        cursor.execute('SELECT pg_export_snapshot()')
+        snapshot_id = cursor.fetchone()[0]
+        cursor.execute('SELECT MAX(id) FROM sample')
+        safe_id = max(safe_id, (cursor.fetchone()[0] or 0) - args.recheck_margin)
+    write_checkpoint(args.target_directory, completed, safe_id)
+
+    # the snapshot can be imported as long as this transaction is open
+    tail_ids = []
+
+    def iter_ids():
+        for sample_id in SampleRepository(db).iter_ids():
+            if sample_id > safe_id:
+                tail_ids.append(sample_id)
+            yield sample_id
+
+    ranges = list(batch_ranges(iter_ids(), completed, args.batch_size))
+    logger.info('Exporting %i batches of up to %i samples with snapshot %s...' % (
+        len(ranges), args.batch_size, snapshot_id
+    ))
+
+    # spawned instead of forked workers, so they do not share the connection of this process
+    context = multiprocessing.get_context('spawn')
+    exported = 0
+    start = time.time()
+    with context.Pool(args.workers, init_worker, (
+        snapshot_id, args.target_directory, args.compression, args.hydration, args.chunk_size
+    )) as pool:
+        for done, (first_id, last_id, count) in enumerate(pool.imap_unordered(export_range, ranges), 1):
+            completed = merge_ranges(completed + completed_ranges(first_id, last_id, safe_id, tail_ids))
+            write_checkpoint(args.target_directory, completed, safe_id)
+            exported += count
+            logger.info('Exported %i of %i batches, %i samples (%.1f samples/s)...' % (
+                done, len(ranges), exported, exported / max(time.time() - start, 1e-6)
+            ))
+    db.rollback()
+    # every id up to safe_id is exported now, which merges the ranges and the ids of earlier runs below it
+    write_checkpoint(args.target_directory, merge_ranges(completed + [[1, safe_id]]) if safe_id else completed, safe_id)
+    logger.info('All done.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+"""
+Appends samples stored since the last run to the id array snapshots used by SampleRepository.random_by_id and
+random_stratified. Meant to run periodically, e.g. from cron; --full rebuilds the snapshots after many deletions.
+"""
+import os
+import sys
+import logging
+import argparse
+import psycopg2
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.sampling import IdArraySampler, STRATUM_SQL
+
+logging.basicConfig(format='%(asctime)s %(message)s')
+logger = logging.getLogger('KurasutaSamplingSnapshot')
+logger.setLevel(logging.INFO)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--stratifications', nargs='+', choices=sorted(STRATUM_SQL.keys()), default=sorted(STRATUM_SQL))
+parser.add_argument('--full', action='store_true', help='rebuild the snapshots instead of appending new samples')
+args = parser.parse_args()
+
+db = psycopg2.connect(os.environ['POSTGRES_DATABASE_LINK'])
+sampler = IdArraySampler(db)
+for stratify_by in args.stratifications:
+    appended = sampler.refresh(stratify_by, args.full)
+    db.commit()
+    logger.info('Appended %i samples to the "%s" snapshot.' % (appended, stratify_by))
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""
+Resolves a file of SHA256, MD5 or SHA1 hashes (one per line) to samples and writes tab separated lines of input hash,
+sample id and sample SHA256. Hashes without sample are written with empty id and SHA256 and counted.
+"""
+import os
+import sys
+import logging
+import argparse
+import psycopg2
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.repository import SampleRepository
+
+logging.basicConfig(format='%(asctime)s %(message)s')
+logger = logging.getLogger('KurasutaResolveHashes')
+logger.setLevel(logging.INFO)
+
+parser = argparse.ArgumentParser()
+parser.add_argument('hash_file_name')
+parser.add_argument('target_file_name')
+parser.add_argument('--chunk-size', type=int, default=10000)
+args = parser.parse_args()
+
+db = psycopg2.connect(os.environ['POSTGRES_DATABASE_LINK'])
+sample_repository = SampleRepository(db)
+resolved = 0
+not_found = 0
+with open(args.hash_file_name, 'rb') as hash_file, open(args.target_file_name, 'w') as fp:
+    for chunk in sample_repository.resolve_hashes(hash_file, args.chunk_size):
+        for input_hash, sample_id, sha256 in chunk:
+            if sample_id is None:
+                not_found += 1
+                fp.write('%s\t\t\n' % input_hash)
+            else:
+                resolved += 1
+                fp.write('%s\t%i\t%s\n' % (input_hash, sample_id, sha256))
+        logger.info('%i hashes resolved, %i not found...' % (resolved, not_found))
+db.rollback()
+logger.info('All done, %i hashes resolved, %i not found.' % (resolved, not_found))